@@ -6,6 +6,7 @@ from utils.util import create_dir
 from application.oneshot._dataset import select_dataset
 from application.oneshot._models import select_model
 from application.oneshot._train import train_nshot
+from object_pursuit.utils.profiling import PhaseProfiler
 
 def nshot_get_args():
     parser = argparse.ArgumentParser(description='One shot learning',
@@ -61,6 +62,16 @@ def nshot_get_args():
                         help='if true, the weights of the backbone will not be predicted by the hypernet')
     parser.add_argument('-use_dice_loss', '--use_dice_loss', dest='use_dice_loss', action="store_true",
                         help='if true, the accuracy will be reported in dice loss')
+    parser.add_argument('-low_res_loss', '--low_res_loss', dest='low_res_loss', action="store_true",
+                        help='if true, the training loss is computed at the decoder resolution against area-pooled masks')
+    parser.add_argument('-step_sample', '--step_sample', dest='step_sample', type=int, nargs='?', default=0,
+                        help='time every n-th training step (data wait, h2d, forward, backward, optimizer), reported per epoch in the log (0: off)')
+    parser.add_argument('-profile', '--profile', dest='profile', type=str, nargs='*', default=None, choices=["nshot_epoch"],
+                        help='torch.profiler capture of these phases (no phase: all), chrome traces and top operator tables are written to <output dir>/profile')
+    parser.add_argument('-profile_schedule', '--profile_schedule', dest='profile_schedule', type=int, nargs=3, default=[1, 1, 3],
+                        help='wait, warmup and active steps of a profiled phase')
+    parser.add_argument('-profile_captures', '--profile_captures', dest='profile_captures', type=int, default=1,
+                        help='number of profiled occurrences of each phase')
     
     return parser.parse_args()
 
@@ -86,6 +97,10 @@ def main(args):
                                                  n=args.n,
                                                  shuffle_seed=args.shuffle_seed)
     
+    profiler = None
+    if args.profile is not None:
+        profiler = PhaseProfiler(os.path.join(args.output_dir, "profile"), args.profile or ["nshot_epoch"], *args.profile_schedule, captures=args.profile_captures)
+    
     train_nshot(net,
                 default_device,
                 train_dataset,
@@ -98,4 +113,7 @@ def main(args):
                 save_ckpt=args.save_ckpt,
                 save_viz=args.save_viz,
                 use_dice=args.use_dice_loss,
+                low_res_loss=args.low_res_loss,
+                step_sample=args.step_sample,
+                profiler=profiler,
                 args=args)
@@ -9,10 +9,14 @@ from torch.utils.data import DataLoader
 from tqdm import tqdm
 
 from evaluation.eval_net import eval_net
+from loss.seg_loss import seg_loss
 
 from dataset.visualize import vis_predict
 
 from utils.util import create_dir, write_log
+from utils.step_profiler import StepTimer
+# the models label their forward passes in object_pursuit.utils.profiling, the captures have to be opened there
+from object_pursuit.utils.profiling import begin_capture, label_iter, step as profile_step
 
 def train_nshot(net,
                 device,
@@ -26,6 +30,9 @@ def train_nshot(net,
                 save_ckpt=False, # save checkpoint (model param)
                 save_viz=False, # save visualization results
                 use_dice=False,
+                low_res_loss=False,
+                step_sample=0,
+                profiler=None,
                 args=None):
     # dataset
     n_train = len(train_dataset)
@@ -48,6 +55,8 @@ def train_nshot(net,
         save checkpoint: {save_ckpt}
         save visualize:  {save_viz}
         use dice loss:   {use_dice}
+        low res loss:    {low_res_loss}
+        step sampling:   {step_sample}
         parameter number of the network: {sum(x.numel() for x in net.parameters() if x.requires_grad)}
     \n""")
     write_log(logf, info_text)
@@ -71,6 +80,9 @@ def train_nshot(net,
     optimizer = optim.RMSprop(filter(lambda p: p.requires_grad, net.parameters()), lr=lr, weight_decay=1e-7, momentum=0.9)
     global_step = 0
     max_val_acc = 0
+    # sampled step timing (data wait / h2d / forward / loss / backward / optimizer), reported per epoch
+    step_timer = StepTimer(device, sample_every=step_sample, modules={"hypernet": getattr(net, "hypernet", None), "backbone": getattr(net, "backbone", None)},
+                           log=lambda s: write_log(logf, s))
     
     # start training
     for epoch in range(epochs):
@@ -78,38 +90,48 @@ def train_nshot(net,
         net.train()
         val_acc_list = [] # record validation accuracy in one epoch
         loss_list = [] # record loss in one epoch
-        with tqdm(total=n_train, desc=f("Epoch {epoch + 1}/{epochs}', unit='img")) as pbar:
-            for batch in train_loader:
-                imgs = batch['image']
-                masks = batch['mask']
+        # torch.profiler capture of the first epochs (with --profile)
+        with begin_capture(profiler, "nshot_epoch", tag=epoch):
+            with tqdm(total=n_train, desc=f("Epoch {epoch + 1}/{epochs}', unit='img")) as pbar:
+                for batch in step_timer.iter(label_iter(train_loader)):
+                    imgs = batch['image']
+                    masks = batch['mask']
                 
-                assert imgs.shape[1] == 3 # deal with rgb image only (for now)
+                    assert imgs.shape[1] == 3 # deal with rgb image only (for now)
                 
-                imgs = imgs.to(device=device, dtype=torch.float32)
-                masks = masks.to(device=device, dtype=torch.float32) # torch.float32 for single object seg (n_class=1), else should be torch.long
+                    with step_timer.segment("h2d"):
+                        imgs = imgs.to(device=device, dtype=torch.float32)
+                        masks = masks.to(device=device, dtype=torch.float32) # torch.float32 for single object seg (n_class=1), else should be torch.long
                 
-                # forward
-                pred = net(imgs)
-                # backward
-                loss = F.binary_cross_entropy_with_logits(pred, masks)
-                loss_list.append(loss.item())
-                pbar.set_postfix(**{'loss (batch)': loss.item()})
-                optimizer.zero_grad()
-                loss.backward()
-                nn.utils.clip_grad_value_(net.parameters(), 0.1)
-                optimizer.step()
+                    # forward (with low_res_loss, the loss is computed at the decoder resolution)
+                    with step_timer.segment("forward"):
+                        pred = net(imgs, upsample=not low_res_loss)
+                    # backward
+                    with step_timer.segment("loss"):
+                        loss = seg_loss(pred, masks)
+                    loss_list.append(loss.item())
+                    pbar.set_postfix(**{'loss (batch)': loss.item()})
+                    with step_timer.segment("backward"):
+                        optimizer.zero_grad()
+                        loss.backward()
+                    with step_timer.segment("optimizer"):
+                        nn.utils.clip_grad_value_(net.parameters(), 0.1)
+                        optimizer.step()
                 
-                # update
-                pbar.update(imgs.shape[0])
-                global_step += 1
+                    # update
+                    pbar.update(imgs.shape[0])
+                    global_step += 1
+                    step_timer.step(imgs.shape[0])
+                    profile_step()
                 
-                # eval
-                if global_step % int(eval_step * int(n_train / (batch_size))) == 0:
-                    val_score, d = eval_net(net, val_loader, device, use_IOU=(not use_dice))
-                    val_acc_list.append(val_score)
-                    write_log(logf, f("Validation Dice Coeff: {val_score}, decay: {d[0]}, current loss: {sum(loss_list)/len(loss_list)}"))
-                    loss_list = []
+                    # eval
+                    if global_step % int(eval_step * int(n_train / (batch_size))) == 0:
+                        val_score, d = eval_net(net, val_loader, device, use_IOU=(not use_dice))
+                        val_acc_list.append(val_score)
+                        write_log(logf, f("Validation Dice Coeff: {val_score}, decay: {d[0]}, current loss: {sum(loss_list)/len(loss_list)}"))
+                        loss_list = []
                     
+        step_timer.epoch_end(epoch)
         # An epoch finished & save ckpt
         if len(val_acc_list) > 0: # eval acc has been recorded
             avg_val_acc = sum(val_acc_list)/len(val_acc_list)
@@ -125,6 +147,7 @@ def train_nshot(net,
                     write_log(logf, f("save visualization predict result to {save_path}"))
                 max_val_acc = avg_val_acc
     
+    step_timer.close()
     write_log(logf, "Training ends!") 
     logf.close()    
 
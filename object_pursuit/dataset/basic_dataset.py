@@ -1,6 +1,7 @@
 import os
 from os.path import splitext
 from os import listdir
+import math
 import random
 import numpy as np
 from glob import glob
@@ -9,18 +10,30 @@ from PIL import Image
 from torchvision import transforms
 
 import object_pursuit.dataset.custom_transforms as tr 
+from object_pursuit.dataset.batch_transforms import BatchTransform
+from object_pursuit.dataset.dedup import dedup_frames
 # import custom_transforms as tr 
 
 class BasicDataset(Dataset):
-    def __init__(self, imgs_dir, masks_dir, resize = None, mask_suffix='', train=False, shuffle_seed=None, random_crop=False):
+    def __init__(self, imgs_dir, masks_dir, resize = None, mask_suffix='', train=False, shuffle_seed=None, random_crop=False, batch_transform=False, fast_decode=True, dedup_threshold=None):
         self.imgs_dir = self._parse_dirs(imgs_dir)
         self.masks_dir = self._parse_dirs(masks_dir)
         self.resize = resize
         self.mask_suffix = mask_suffix
         self.random_crop = random_crop
+        # decode jpeg images at reduced size (DCT scaling) if resize is at most half the source size
+        self.fast_decode = fast_decode
+        # if batch_transform, samples are returned as uncropped uint8 tensors, 
+        # crop/resize/normalization are done on whole batches by self.batch_transform (see batch_transforms.py)
+        self.batch_transform = BatchTransform(resize=resize, random_crop=random_crop) if batch_transform else None
         
         self._get_ids()
         
+        # collapse near-duplicate consecutive frames, kept/dropped indices (into the original id list) are recorded
+        self.dedup_record = None
+        if dedup_threshold is not None:
+            self._dedup(dedup_threshold)
+        
         if shuffle_seed is not None:
             r = random.random
             random.seed(shuffle_seed)
@@ -38,12 +51,36 @@ class BasicDataset(Dataset):
         length = min(img.size[0], img.size[1])
         bias = random.randint(0, max(img.size[0], img.size[1])-length)
         if img.size[0] > length:
-            img = img.crop([bias, 0, bias+length, length])
-            mask = mask.crop([bias, 0, bias+length, length])
+            box = [bias, 0, bias+length, length]
         else:
-            img = img.crop([0, bias, length, bias+length])
-            mask = mask.crop([0, bias, length, bias+length])
+            box = [0, bias, length, bias+length]
+        img_size = img.size
+        img = img.crop(box)
+        # the image may have been decoded at reduced size (see _draft), map the crop box to mask coordinates
+        mask = mask.crop(self._scale_box(box, img_size, mask.size))
         return img, mask
+    
+    def _scale_box(self, box, src_size, dst_size):
+        if src_size == dst_size:
+            return box
+        sx = dst_size[0] / src_size[0]
+        sy = dst_size[1] / src_size[1]
+        return [int(round(box[0]*sx)), int(round(box[1]*sy)), int(round(box[2]*sx)), int(round(box[3]*sy))]
+    
+    def _draft(self, img):
+        """Configure the jpeg decoder to decode at reduced size (1/2, 1/4 or 1/8) when the requested resize 
+        is at most half of the (cropped) source size. The decoded image is never smaller than what resize needs."""
+        if self.resize is None or img.format != 'JPEG':
+            return
+        w, h = img.size
+        if self.random_crop:
+            length = min(w, h)
+            scale_x = scale_y = max(self.resize[0], self.resize[1]) / length
+        else:
+            scale_x = self.resize[0] / w
+            scale_y = self.resize[1] / h
+        if scale_x <= 0.5 and scale_y <= 0.5:
+            img.draft('RGB', (int(math.ceil(w*scale_x)), int(math.ceil(h*scale_y))))
         
     def _get_ids(self):
         self.ids = [] # each data specified with a file path
@@ -70,6 +107,22 @@ class BasicDataset(Dataset):
             count += 1
         
 
+    def _dedup(self, threshold):
+        kept, dropped = [], []
+        start = 0
+        while start < len(self.ids):
+            # frames of the same image dir are consecutive in self.ids
+            end = start
+            while end < len(self.ids) and self.ids[end][1] == self.ids[start][1]:
+                end += 1
+            img_files = [glob(os.path.join(idx[1], idx[0] + '.*'))[0] for idx in self.ids[start:end]]
+            record = dedup_frames(img_files, threshold)
+            kept += [start + i for i in record["kept"]]
+            dropped += [[start + i, start + j] for i, j in record["dropped"]]
+            start = end
+        self.dedup_record = {"threshold": threshold, "total": len(self.ids), "kept": kept, "dropped": dropped}
+        self.ids = [self.ids[i] for i in kept]
+
     def __len__(self):
         return len(self.ids)
 
@@ -95,7 +148,8 @@ class BasicDataset(Dataset):
     def _get_idx(self, index):
         return self.ids[index]
     
-    def _make_img_gt_point_pair(self, index):
+    def _load_pair(self, index):
+        """open (and decode) the image and mask of a sample, without crop and resize"""
         idx = self._get_idx(index)
         mask_file = glob(os.path.join(os.path.join(idx[2], idx[0] + self.mask_suffix + '.*')))
         img_file = glob(os.path.join(idx[1], idx[0] + '.*'))
@@ -105,12 +159,26 @@ class BasicDataset(Dataset):
         assert len(img_file) == 1, \
             f("Either no image or multiple images found for the ID {idx}: {img_file}")
         
-        _img = Image.open(img_file[0]).convert('RGB')
+        _img = Image.open(img_file[0])
         _mask = Image.open(mask_file[0])
         
         assert _img.size == _mask.size, \
             f("Image and mask {idx} should be the same size, but are {_img.size} and {_mask.size}")
         
+        if self.fast_decode:
+            self._draft(_img)
+        _img = _img.convert('RGB')
+        return _img, _mask, img_file[0], mask_file[0]
+    
+    def _make_img_gt_point_pair(self, index):
+        _img, _mask, img_file, mask_file = self._load_pair(index)
+        
+        if self.batch_transform is not None:
+            # samples are collated before cropping, image and mask should share the same coordinates
+            if _mask.size != _img.size:
+                _mask = _mask.resize(_img.size, Image.NEAREST)
+            return _img, _mask, img_file, mask_file
+        
         if self.random_crop:
             _img, _mask = self._random_crop(_img, _mask)
         
@@ -118,7 +186,7 @@ class BasicDataset(Dataset):
             _img = _img.resize(self.resize)
             _mask = _mask.resize(self.resize)
 
-        return _img, _mask, img_file[0], mask_file[0]
+        return _img, _mask, img_file, mask_file
 
     def __getitem__(self, i):
         img, mask, img_file, mask_file = self._make_img_gt_point_pair(i)
@@ -131,6 +199,8 @@ class BasicDataset(Dataset):
         return sample
         
     def transform_tr(self, sample):
+        if self.batch_transform is not None:
+            return tr.ToByteTensor()(sample)
         composed_transforms = transforms.Compose([
             tr.MaskExpand(),
             tr.ImgNorm(),
@@ -140,8 +210,8 @@ class BasicDataset(Dataset):
 
 
 class BasicDataset_nshot(BasicDataset):
-    def __init__(self, imgs_dir, masks_dir, n=1, resize=None, mask_suffix='', train=False, shuffle_seed=None, random_crop=False):
-        super().__init__(imgs_dir, masks_dir, resize=resize, mask_suffix=mask_suffix, train=train, shuffle_seed=shuffle_seed, random_crop=random_crop)
+    def __init__(self, imgs_dir, masks_dir, n=1, resize=None, mask_suffix='', train=False, shuffle_seed=None, random_crop=False, batch_transform=False, fast_decode=True, dedup_threshold=None):
+        super().__init__(imgs_dir, masks_dir, resize=resize, mask_suffix=mask_suffix, train=train, shuffle_seed=shuffle_seed, random_crop=random_crop, batch_transform=batch_transform, fast_decode=fast_decode, dedup_threshold=dedup_threshold)
         self.n = n
         
     def _get_idx(self, index):
@@ -0,0 +1,166 @@
+import torch
+import torch.nn.functional as F
+
+# PIL 'L' conversion weights (ITU-R 601-2 luma), used by ImageEnhance.Contrast / Color
+_LUMA = (0.299, 0.587, 0.114)
+
+
+def _resize(x, size, mode):
+    """resize a float batch (B*C*H*W) to size (w, h), PIL convention"""
+    w, h = size
+    if x.size(2) == h and x.size(3) == w:
+        return x
+    if mode == 'nearest':
+        return F.interpolate(x, size=(h, w), mode='nearest')
+    try:
+        # PIL filters are antialiased when downscaling
+        return F.interpolate(x, size=(h, w), mode=mode, align_corners=False, antialias=True)
+    except TypeError:
+        # torch < 1.11 has no antialias option, use a box filter for downscaling instead
+        if x.size(2) > h and x.size(3) > w:
+            return F.interpolate(x, size=(h, w), mode='area')
+        return F.interpolate(x, size=(h, w), mode=mode, align_corners=False)
+
+
+def _per_sample(factors, x):
+    return factors.view(-1, *([1] * (x.dim() - 1)))
+
+
+def _luma(imgs):
+    r, g, b = imgs[:, 0:1], imgs[:, 1:2], imgs[:, 2:3]
+    return _LUMA[0] * r + _LUMA[1] * g + _LUMA[2] * b
+
+
+def _blend(degenerate, imgs, factors):
+    """same as PIL.ImageEnhance: degenerate + factor * (img - degenerate)"""
+    out = degenerate + _per_sample(factors, imgs) * (imgs - degenerate)
+    return out.clamp_(0., 255.)
+
+
+class BatchRandomSquareCrop(object):
+    """Batched version of BasicDataset._random_crop.
+    Crop a square (side = the shorter edge) out of every sample, at a random offset along the longer edge.
+    All samples in the batch should have the same size (B*C*H*W)."""
+
+    def sample_bias(self, batch_size, height, width, device=None):
+        max_bias = max(height, width) - min(height, width)
+        return torch.randint(0, max_bias + 1, (batch_size,), device=device)
+
+    def __call__(self, imgs, masks, bias=None):
+        B, _, H, W = imgs.size()
+        length = min(H, W)
+        if H == W:
+            return imgs, masks
+        if bias is None:
+            bias = self.sample_bias(B, H, W, device=imgs.device)
+        index = bias.to(imgs.device).view(B, 1) + torch.arange(length, device=imgs.device).view(1, length)
+        if W > H:
+            img_index = index.view(B, 1, 1, length)
+            imgs = imgs.gather(3, img_index.expand(B, imgs.size(1), H, length))
+            masks = masks.gather(3, img_index.expand(B, masks.size(1), H, length))
+        else:
+            img_index = index.view(B, 1, length, 1)
+            imgs = imgs.gather(2, img_index.expand(B, imgs.size(1), length, W))
+            masks = masks.gather(2, img_index.expand(B, masks.size(1), length, W))
+        return imgs, masks
+
+
+class BatchResize(object):
+    """Resize images (bilinear) and masks (nearest) of a whole batch to size (w, h)"""
+    def __init__(self, size):
+        self.size = size
+
+    def __call__(self, imgs, masks):
+        imgs = _resize(imgs.float(), self.size, mode='bilinear')
+        masks = _resize(masks.float(), self.size, mode='nearest')
+        return imgs, masks
+
+
+class BatchColorJitter(object):
+    """Batched version of dataset.color_jitter.ColorJitter, works on float images in [0, 255].
+    Each sample draws its own factor r in [1-alpha, 1+alpha) for every enhancement,
+    enhancements are applied in the same order as ColorJitter (brightness, contrast, sharpness, color)"""
+    def __init__(self, brightness=0, contrast=0, sharpness=0, color=0):
+        self.transforms = [(self._brightness, brightness),
+                           (self._contrast, contrast),
+                           (self._sharpness, sharpness),
+                           (self._color, color)]
+
+    def _brightness(self, imgs, factors):
+        return _blend(torch.zeros_like(imgs), imgs, factors)
+
+    def _contrast(self, imgs, factors):
+        mean = _luma(imgs).mean(dim=(1, 2, 3), keepdim=True).round()
+        return _blend(mean.expand_as(imgs), imgs, factors)
+
+    def _sharpness(self, imgs, factors):
+        # PIL ImageFilter.SMOOTH, border pixels are left untouched
+        kernel = torch.tensor([[1., 1., 1.], [1., 5., 1.], [1., 1., 1.]], device=imgs.device) / 13.
+        kernel = kernel.view(1, 1, 3, 3).repeat(imgs.size(1), 1, 1, 1)
+        degenerate = imgs.clone()
+        degenerate[:, :, 1:-1, 1:-1] = F.conv2d(imgs, kernel, groups=imgs.size(1))
+        return _blend(degenerate, imgs, factors)
+
+    def _color(self, imgs, factors):
+        return _blend(_luma(imgs).expand_as(imgs), imgs, factors)
+
+    def __call__(self, imgs):
+        rand_num = torch.rand((len(self.transforms), imgs.size(0)), device=imgs.device)
+        for i, (transformer, alpha) in enumerate(self.transforms):
+            if alpha == 0:
+                continue
+            r = alpha * (rand_num[i]*2.0 - 1.0) + 1   # r in [1-alpha, 1+alpha)
+            imgs = transformer(imgs, r)
+        return imgs
+
+
+class BatchNorm01(object):
+    """Batched ImgNorm + MaskExpand normalization: every sample whose max value is larger than 1 is divided by 255"""
+    def _norm(self, x):
+        x = x.float()
+        x_max = x.amax(dim=tuple(range(1, x.dim())), keepdim=True)
+        return torch.where(x_max > 1, x / 255.0, x)
+
+    def __call__(self, imgs, masks):
+        return self._norm(imgs), self._norm(masks)
+
+
+class BatchTransform(object):
+    """Augmentation stage that works on collated uint8 batches (see BasicDataset(batch_transform=True)).
+    It replaces the per-sample PIL pipeline: random square crop -> resize -> (color jitter) -> normalization,
+    the normalization is done once at the end, on the device the batch lives on.
+
+    Args:
+        resize (tuple, optional): output size (w, h), same as BasicDataset's resize. Defaults to None.
+        random_crop (bool, optional): crop a random square before resizing. Defaults to False.
+        jitter (BatchColorJitter, optional): color jitter applied to the images. Defaults to None.
+    """
+    def __init__(self, resize=None, random_crop=False, jitter=None):
+        self.resize = resize
+        self.random_crop = random_crop
+        self.crop = BatchRandomSquareCrop()
+        self.resizer = BatchResize(resize) if resize is not None else None
+        self.jitter = jitter
+        self.norm = BatchNorm01()
+
+    def __call__(self, imgs, masks, bias=None):
+        if self.random_crop:
+            imgs, masks = self.crop(imgs, masks, bias)
+        imgs, masks = imgs.float(), masks.float()
+        if self.resizer is not None:
+            imgs, masks = self.resizer(imgs, masks)
+        if self.jitter is not None:
+            imgs = self.jitter(imgs)
+        return self.norm(imgs, masks)
+
+
+def batch_to_device(batch, device, batch_transform=None):
+    """move a collated batch to device, run the batch transform (if any) there, return float32 images and masks"""
+    imgs, masks = batch['image'], batch['mask']
+    if batch_transform is not None:
+        imgs = imgs.to(device=device, non_blocking=True)
+        masks = masks.to(device=device, non_blocking=True)
+        imgs, masks = batch_transform(imgs, masks)
+    imgs = imgs.to(device=device, dtype=torch.float32)
+    masks = masks.to(device=device, dtype=torch.float32)
+    return imgs, masks
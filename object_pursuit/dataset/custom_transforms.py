@@ -76,4 +76,18 @@ class ToTensor(object):
         mask = torch.from_numpy(mask).float()
 
         return {'image': img,
-                'mask': mask}
\ No newline at end of file
+                'mask': mask}
+        
+class ToByteTensor(object):
+    """Convert PIL image and mask to uint8 Tensors without normalization (for the batched transforms)"""
+
+    def __call__(self, sample):
+        img = np.array(sample['image'], dtype=np.uint8)
+        mask = np.array(sample['mask'], dtype=np.uint8)
+        if len(mask.shape) == 3:
+            mask = mask[:,:,0]
+        img = torch.from_numpy(np.ascontiguousarray(img.transpose((2, 0, 1))))
+        mask = torch.from_numpy(np.ascontiguousarray(mask)).unsqueeze(0)
+
+        return {'image': img,
+                'mask': mask}
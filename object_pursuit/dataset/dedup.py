@@ -0,0 +1,51 @@
+'''Near-duplicate frame removal for video-derived object datasets'''
+import numpy as np
+from PIL import Image
+
+
+def dhash(img, hash_size=8):
+    """difference hash of a PIL image: sign of horizontal gradients on a (hash_size+1)*hash_size grayscale thumbnail
+
+    Returns:
+        ndarray: bool array of hash_size*hash_size bits
+    """
+    img = img.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR)
+    px = np.asarray(img, dtype=np.int16)
+    return (px[:, 1:] > px[:, :-1]).reshape(-1)
+
+
+def frame_hash(img_file, hash_size=8):
+    """hash an image file, jpeg frames are decoded at reduced size (only a thumbnail is needed)"""
+    img = Image.open(img_file)
+    img.draft('L', (hash_size * 8, hash_size * 8))
+    return dhash(img, hash_size)
+
+
+def hamming(h1, h2):
+    return int(np.count_nonzero(h1 != h2))
+
+
+def dedup_frames(img_files, threshold=4, hash_size=8):
+    """Collapse runs of near-duplicate consecutive frames.
+    Frames are visited in order, a frame is kept if the hamming distance between its hash and the hash
+    of the last kept frame is larger than threshold, otherwise it is dropped (represented by that kept frame).
+
+    Args:
+        img_files (list): image files, in temporal order
+        threshold (int, optional): max hamming distance (in bits, out of hash_size^2) of near-duplicates. Defaults to 4.
+        hash_size (int, optional): hash grid size. Defaults to 8.
+
+    Returns:
+        dict: {"threshold", "kept": [index], "dropped": [[dropped index, kept index]]}, indices into img_files
+    """
+    kept = []
+    dropped = []
+    last_hash = None
+    for i, img_file in enumerate(img_files):
+        h = frame_hash(img_file, hash_size)
+        if last_hash is not None and hamming(h, last_hash) <= threshold:
+            dropped.append([i, kept[-1]])
+        else:
+            kept.append(i)
+            last_hash = h
+    return {"threshold": threshold, "kept": kept, "dropped": dropped}
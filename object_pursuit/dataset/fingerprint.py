@@ -0,0 +1,51 @@
+'''Content fingerprints of object datasets (exact repeats of a capture get the same fingerprint)'''
+import os
+import json
+import hashlib
+from os.path import splitext
+
+
+def _file_hash(file_path, chunk_size=1 << 20):
+    h = hashlib.sha1()
+    with open(file_path, 'rb') as f_data:
+        for chunk in iter(lambda: f_data.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def dataset_fingerprint(dataset, samples=8):
+    """sha1 of the manifest of a BasicDataset (sample ids, image and mask file sizes, in order), the content of
+    samples evenly spaced image/mask files and the dataset settings (resize, crop, dedup threshold).
+    Paths are not part of it: the same capture uploaded again to another dir gets the same fingerprint.
+
+    Args:
+        dataset (BasicDataset): object dataset (after dedup)
+        samples (int, optional): number of samples whose files are hashed. Defaults to 8.
+
+    Returns:
+        str: hex digest
+    """
+    h = hashlib.sha1()
+    settings = {
+        "resize": list(dataset.resize) if dataset.resize is not None else None,
+        "random_crop": dataset.random_crop,
+        "dedup_threshold": dataset.dedup_record["threshold"] if dataset.dedup_record is not None else None
+    }
+    h.update(json.dumps(settings, sort_keys=True).encode())
+    # id -> file name of every dir, listed once
+    dir_files = {}
+    def file_of(d, idx):
+        if d not in dir_files:
+            dir_files[d] = {splitext(file)[0]: file for file in os.listdir(d) if not file.startswith('.')}
+        return os.path.join(d, dir_files[d][idx])
+    pairs = []
+    for idx, img_dir, mask_dir in dataset.ids:
+        img_file = file_of(img_dir, idx)
+        mask_file = file_of(mask_dir, idx + dataset.mask_suffix)
+        h.update(("%s:%d:%d;" % (idx, os.path.getsize(img_file), os.path.getsize(mask_file))).encode())
+        pairs.append((img_file, mask_file))
+    n = len(pairs)
+    for i in sorted(set(int(k * n / samples) for k in range(min(samples, n)))):
+        h.update(_file_hash(pairs[i][0]).encode())
+        h.update(_file_hash(pairs[i][1]).encode())
+    return h.hexdigest()
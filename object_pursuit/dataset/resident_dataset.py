@@ -0,0 +1,132 @@
+import math
+import random
+import weakref
+import numpy as np
+import torch
+from PIL import Image
+from tqdm import tqdm
+
+from object_pursuit.dataset.batch_transforms import BatchTransform, BatchRandomSquareCrop
+
+# bit order of np.packbits (big endian)
+_BITS = torch.tensor([128, 64, 32, 16, 8, 4, 2, 1], dtype=torch.uint8)
+
+# resident copies, one per dataset object, built on first use
+_resident_cache = weakref.WeakKeyDictionary()
+
+
+def _storage_size(img_size, resize, random_crop):
+    """The size (w, h) samples are kept at.
+    With random crop, the shorter edge is scaled to the crop side, so that cropping a square from the stored
+    image is the same as cropping from the source image and then resizing (the crop is a pure slice)."""
+    if not random_crop:
+        return tuple(resize)
+    assert resize[0] == resize[1], "resident mode with random crop needs a square resize"
+    side = resize[0]
+    w, h = img_size
+    if w >= h:
+        return (int(round(w * side / h)), side)
+    else:
+        return (side, int(round(h * side / w)))
+
+
+class ResidentDataset(object):
+    """Decode the samples of a (small, per-object) BasicDataset once and keep them in memory:
+    images as a single uint8 tensor N*3*H*W, masks bit-packed (N*ceil(H*W/8) uint8).
+    Batches are produced by ResidentLoader via index slicing in the main process, no DataLoader workers involved.
+
+    Args:
+        dataset (BasicDataset): source dataset, its resize should be set
+        indices (list, optional): indices of the samples to keep. Defaults to all samples.
+        crop_bank_size (int, optional): number of pre-sampled random crop offsets. Defaults to 4096.
+    """
+    def __init__(self, dataset, indices=None, crop_bank_size=4096):
+        assert dataset.resize is not None, "resident mode needs a fixed resize"
+        self.resize = dataset.resize
+        self.random_crop = dataset.random_crop
+        self.indices = list(range(len(dataset))) if indices is None else list(indices)
+        self._decode(dataset, self.indices)
+        # crops are sampled once and reused
+        self.crop = BatchRandomSquareCrop()
+        self.crop_bank = self.crop.sample_bias(crop_bank_size, self.height, self.width)
+        # normalization only, crop and resize are done at decode/batch time
+        self.batch_transform = BatchTransform()
+
+    def _decode(self, dataset, indices):
+        n = len(indices)
+        self.width, self.height = None, None
+        self.img_files, self.mask_files = [], []
+        for i, index in enumerate(tqdm(indices, desc='Resident dataset', unit='img', leave=False)):
+            img, mask, img_file, mask_file = dataset._load_pair(index)
+            if self.width is None:
+                self.width, self.height = _storage_size(img.size, self.resize, self.random_crop)
+                self.images = torch.empty((n, 3, self.height, self.width), dtype=torch.uint8)
+                self.masks = torch.empty((n, int(math.ceil(self.height * self.width / 8))), dtype=torch.uint8)
+            img = np.array(img.resize((self.width, self.height)), dtype=np.uint8)
+            mask = np.array(mask.resize((self.width, self.height), Image.NEAREST), dtype=np.uint8)
+            if len(mask.shape) == 3:
+                mask = mask[:,:,0]
+            self.images[i] = torch.from_numpy(np.ascontiguousarray(img.transpose((2, 0, 1))))
+            self.masks[i] = torch.from_numpy(np.packbits(mask.reshape(-1) > 0))
+            self.img_files.append(img_file)
+            self.mask_files.append(mask_file)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def unpack_masks(self, packed):
+        """bit-packed masks (B*nbytes) -> uint8 masks (B*1*H*W) of 0/1"""
+        bits = (packed.unsqueeze(-1) & _BITS.to(packed.device)) != 0
+        bits = bits.view(packed.size(0), -1)[:, :self.height * self.width]
+        return bits.view(packed.size(0), 1, self.height, self.width).to(torch.uint8)
+
+    def get_batch(self, batch_index):
+        """slice a batch (uint8 images and masks) out of the resident tensors"""
+        batch_index = torch.as_tensor(batch_index, dtype=torch.long)
+        imgs = self.images.index_select(0, batch_index)
+        masks = self.unpack_masks(self.masks.index_select(0, batch_index))
+        if self.random_crop:
+            start = random.randint(0, len(self.crop_bank) - 1)
+            bias = self.crop_bank[(start + torch.arange(len(batch_index))) % len(self.crop_bank)]
+            imgs, masks = self.crop(imgs, masks, bias)
+        return imgs, masks
+
+
+class ResidentLoader(object):
+    """A DataLoader-like iterable over a ResidentDataset, yields {'image', 'mask', 'img_file', 'mask_file'} batches
+    with uint8 images/masks, normalize them with resident.batch_transform (see batch_transforms.batch_to_device)"""
+    def __init__(self, resident, batch_size, indices=None, shuffle=False, drop_last=True):
+        self.resident = resident
+        self.batch_size = batch_size
+        self.indices = list(range(len(resident))) if indices is None else list(indices)
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.indices) // self.batch_size
+        return int(math.ceil(len(self.indices) / self.batch_size))
+
+    def __iter__(self):
+        order = list(self.indices)
+        if self.shuffle:
+            random.shuffle(order)
+        for b in range(len(self)):
+            batch_index = order[b*self.batch_size:(b+1)*self.batch_size]
+            imgs, masks = self.resident.get_batch(batch_index)
+            yield {'image': imgs,
+                   'mask': masks,
+                   'img_file': [self.resident.img_files[i] for i in batch_index],
+                   'mask_file': [self.resident.mask_files[i] for i in batch_index]}
+
+
+def get_resident(dataset, max_len=None):
+    """Get the resident copy of dataset, decode it on first use (at most max_len random samples)"""
+    resident = _resident_cache.get(dataset)
+    if resident is None:
+        indices = list(range(len(dataset)))
+        if max_len is not None and len(indices) > max_len:
+            indices = sorted(random.sample(indices, max_len))
+        resident = ResidentDataset(dataset, indices)
+        _resident_cache[dataset] = resident
+    return resident
@@ -2,8 +2,7 @@ import torch
 import torch.nn.functional as F
 from tqdm import tqdm
 
-from loss.dice_loss import dice_coeff
-from loss.criterion import jaccard
+from loss.metrics import MetricAccumulator, batch_dice, batch_jaccard, binarize
 
 def eval_net(net, loader, device, use_IOU=False):
     """Evaluation without the densecrf with the dice coefficient"""
@@ -11,8 +10,9 @@ def eval_net(net, loader, device, use_IOU=False):
     # net.eval()
     mask_type = torch.float32 if net.n_classes == 1 else torch.long
     n_val = len(loader)  # the number of batch
-    tot = 0
-    records = []
+    # metrics are accumulated on the device, synchronized once at the end
+    metrics = MetricAccumulator()
+    files = []
     
     with tqdm(total=n_val, desc='Validation round', unit='batch', leave=False) as pbar:
         for batch in loader:
@@ -25,19 +25,18 @@ def eval_net(net, loader, device, use_IOU=False):
                 mask_pred = net(imgs)
 
                 if net.n_classes > 1:
-                    res = F.cross_entropy(mask_pred, true_masks).item()
-                    tot += res
+                    metrics.update(acc=F.cross_entropy(mask_pred, true_masks))
                 else:
-                    pred = torch.sigmoid(mask_pred)
-                    pred = (pred > 0.5).float()
+                    pred = binarize(mask_pred)
                     if use_IOU:
-                        res = jaccard(true_masks, pred)
+                        metrics.update(acc=batch_jaccard(pred, true_masks))
                     else:
-                        res = dice_coeff(pred, true_masks).item()
-                    tot += res
-                    records.append((res, img_file[0], mask_file[0]))
+                        metrics.update(acc=batch_dice(pred, true_masks))
+                    files.append((img_file[0], mask_file[0]))
             pbar.update()
 
     net.train()
+    batch_acc = metrics.batch_means("acc")
+    records = [(res, img_file, mask_file) for res, (img_file, mask_file) in zip(batch_acc, files)]
     decay = records[-1][0] - records[0][0]
-    return tot / n_val, (decay, records)
\ No newline at end of file
+    return sum(batch_acc) / n_val, (decay, records)
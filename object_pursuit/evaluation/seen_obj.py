@@ -1,47 +1,131 @@
 '''Re-identification Experiments'''
 import os
 import torch
-import random
 import json
-from object_pursuit.model.coeffnet.coeffnet import Singlenet
+import collections
+from object_pursuit.model.coeffnet.coeffnet import Singlenet, deeplab_forward_no_backbone
 from dataset.basic_dataset import BasicDataset
-from torch.utils.data import DataLoader, sampler
-from evaluation.eval_net import eval_net
+from object_pursuit.dataset.batch_transforms import batch_to_device
+from object_pursuit.dataset.resident_dataset import get_resident, ResidentLoader
+from object_pursuit.loss.metrics import batch_dice, binarize
+from object_pursuit.utils.catalog import ObjectCatalog
 from utils.util import *
 
-def test_unit(data_dir, z_dir, hypernet_path, backbone_path, test_size=400, start_index=0):
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    net = Singlenet(z_dim=100, device=device)
-    net.to(device=device)
-    net.init_hypernet(hypernet_path)
-    net.init_backbone(backbone_path)
+class ReIDEngine(object):
+    """Long-lived re-identification engine: models and the z matrix are loaded once,
+    test subsets are decoded once per data dir (the last max_cached_subsets are kept in memory), and every batch
+    goes through the backbone once and is scored against a whole chunk of zs.
+    Generated weights are cached (LRU) only if all the queried zs fit in the cache: a sweep over more zs than
+    max_cached_weights would evict every entry before it's used again.
+
+    Args:
+        z_dir (str): directory of z files
+        hypernet_path (str): pretrained hypernet
+        backbone_path (str): pretrained backbone
+        z_dim (int, optional): dimension of z. Defaults to 100.
+        device (torch.device, optional): Defaults to cuda if available.
+        test_size (int, optional): number of test samples per data dir. Defaults to 400.
+        batch_size (int, optional): Defaults to 64.
+        max_cached_weights (int, optional): number of generated weight sets kept in memory (LRU). Defaults to 64.
+        chunk_size (int, optional): number of zs scored per pass over the test subset. Defaults to 64.
+        max_cached_subsets (int, optional): number of decoded test subsets kept in memory (LRU). Defaults to 4.
+        eval_mode (bool, optional): run the backbone in eval mode (running batch norm statistics). By default it's kept
+            in train mode (batch statistics), as eval_net does. Defaults to False.
+    """
+    def __init__(self, z_dir, hypernet_path, backbone_path, z_dim=100, device=None, test_size=400, batch_size=64, max_cached_weights=64, chunk_size=64, max_cached_subsets=4, eval_mode=False):
+        self.device = device if device is not None else torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        net = Singlenet(z_dim=z_dim, device=self.device)
+        net.init_hypernet(hypernet_path)
+        net.init_backbone(backbone_path)
+        net.to(device=self.device)
+        if eval_mode:
+            net.eval()
+        else:
+            net.train()
+        self.hypernet = net.hypernet
+        self.backbone = net.backbone
+        self.test_size = test_size
+        self.batch_size = batch_size
+        # z matrix
+        self.z_files = [os.path.join(z_dir, zf) for zf in sorted(os.listdir(z_dir)) if zf.endswith('.json')]
+        self.zs = torch.stack([torch.load(zf, map_location=self.device)['z'] for zf in self.z_files]) if len(self.z_files) > 0 else None
+        # caches
+        self.max_cached_weights = max_cached_weights
+        self.chunk_size = chunk_size
+        self.max_cached_subsets = max_cached_subsets
+        self._weights = collections.OrderedDict()
+        self._subsets = collections.OrderedDict()
+        
+    def _get_weights(self, i):
+        if i in self._weights:
+            self._weights.move_to_end(i)
+            return self._weights[i]
+        weights = self.hypernet(self.zs[i])
+        self._weights[i] = weights
+        if len(self._weights) > self.max_cached_weights:
+            self._weights.popitem(last=False)
+        return weights
     
-    z_files = [os.path.join(z_dir, zf) for zf in sorted(os.listdir(z_dir)) if zf.endswith('.json')]
-    img_dir = os.path.join(data_dir, "imgs")
-    mask_dir = os.path.join(data_dir, "masks")
-    eval_dataset = BasicDataset(img_dir, mask_dir, (256, 256))
+    def _get_subset(self, data_dir):
+        if data_dir in self._subsets:
+            self._subsets.move_to_end(data_dir)
+            return self._subsets[data_dir]
+        img_dir = os.path.join(data_dir, "imgs")
+        mask_dir = os.path.join(data_dir, "masks")
+        dataset = BasicDataset(img_dir, mask_dir, (256, 256))
+        subset = get_resident(dataset, max_len=self.test_size)
+        self._subsets[data_dir] = subset
+        if len(self._subsets) > self.max_cached_subsets:
+            self._subsets.popitem(last=False)
+        return subset
     
-    n_size = len(eval_dataset)
-    indices = [i for i in range(n_size)]
-    random.shuffle(indices)
-    if test_size is not None:
-        eval_sampler = sampler.SubsetRandomSampler(indices[:min(n_size, test_size)])
-    else:
-        eval_sampler = sampler.SubsetRandomSampler(indices[:n_size])
-    eval_loader = DataLoader(eval_dataset, batch_size=64, shuffle=False, num_workers=8, pin_memory=True, drop_last=True, sampler=eval_sampler)
+    def scores(self, data_dir, start_index=0):
+        """mean dice of every z (from start_index) on the test subset of data_dir.
+        zs are scored in chunks of chunk_size, the backbone runs once per batch and chunk."""
+        subset = self._get_subset(data_dir)
+        loader = ResidentLoader(subset, self.batch_size, shuffle=False, drop_last=False)
+        n_z = max(len(self.z_files) - start_index, 0)
+        tot = torch.zeros(n_z, device=self.device)
+        count = 0
+        with torch.no_grad():
+            cached = n_z <= self.max_cached_weights
+            for c in range(0, n_z, self.chunk_size):
+                chunk = range(c, min(c + self.chunk_size, n_z))
+                weights = [self._get_weights(start_index + j) if cached else self.hypernet(self.zs[start_index + j]) for j in chunk]
+                count = 0
+                for batch in loader:
+                    imgs, true_masks = batch_to_device(batch, self.device, subset.batch_transform)
+                    x, low_level_feat = self.backbone(imgs)
+                    for j, w in zip(chunk, weights):
+                        mask_pred = deeplab_forward_no_backbone(imgs, x, low_level_feat, w)
+                        tot[j] += batch_dice(binarize(mask_pred), true_masks).sum()
+                    count += imgs.size(0)
+        return (tot / max(count, 1)).tolist()
+        
+    def query(self, data_dir, start_index=0):
+        """rank zs for the object in data_dir
+
+        Returns:
+            list: [(z index, z file, acc)], sorted by acc (descending), ties by z index (descending):
+            the first entry is the last z with the max acc, as in the sequential scan
+        """
+        accs = self.scores(data_dir, start_index)
+        ranked = [(start_index + j, self.z_files[start_index + j], acc) for j, acc in enumerate(accs)]
+        return sorted(ranked, key=lambda e: (e[2], e[0]), reverse=True)
     
-    max_acc = 0.0
-    argmax_zf = None
-    argmax_index = None
-    for i in range(start_index, len(z_files)):
-        zf = z_files[i]
-        net.load_z(zf)
-        res, _ = eval_net(net, eval_loader, device)
-        print(f("z file: {zf}, test accuracy: {res}"))
-        if res >= max_acc:
-            max_acc = res
-            argmax_zf = zf
-            argmax_index = i
+    def batch_query(self, data_dirs, start_index=0):
+        return {data_dir: self.query(data_dir, start_index) for data_dir in data_dirs}
+
+
+def test_unit(data_dir, z_dir, hypernet_path, backbone_path, test_size=400, start_index=0, engine=None):
+    if engine is None:
+        engine = ReIDEngine(z_dir, hypernet_path, backbone_path, test_size=test_size)
+    ranked = engine.query(data_dir, start_index)
+    for index, zf, acc in ranked:
+        print(f("z file: {zf}, test accuracy: {acc}"))
+    if len(ranked) == 0:
+        return 0.0, None, None
+    argmax_index, argmax_zf, max_acc = ranked[0]
     return max_acc, argmax_index, argmax_zf
     
 def test_seen_obj(obj_info, z_info, z_dir, hypernet_path, backbone_path, log_name, threshold=0.7):
@@ -53,29 +137,33 @@ def test_seen_obj(obj_info, z_info, z_dir, hypernet_path, backbone_path, log_nam
     unseen_count = 0
     correct_count = 0
     false_count = 0
-    with open(obj_info, 'r') as f:
-        obj_info = json.load(f)
+    engine = ReIDEngine(z_dir, hypernet_path, backbone_path)
+    # object name -> z index (the last record wins), from a pursuit catalog (.db) or a z info json
+    if z_info.endswith(".db"):
+        catalog = ObjectCatalog(z_info)
+        z_index_of = catalog.object_index
+    else:
+        with open(z_info, 'r') as z_inf:
+            z_index = {zi["obj_name"]: zi["index"] for zi in json.load(z_inf)}
+        z_index_of = z_index.get
+    with open(obj_info, 'r') as obj_inf:
+        obj_info = json.load(obj_inf)
         for obj in obj_info:
             if obj["acc"] > max_threshold:
                 data_dir = obj["data_dir"]
                 obj_name = obj["obj_name"]
                 write_log(log_file, f("Start testing object {data_dir}, obj name: {obj_name}..."))
-                test_acc, test_index, test_zf = test_unit(data_dir, z_dir, hypernet_path, backbone_path)
+                test_acc, test_index, test_zf = test_unit(data_dir, z_dir, hypernet_path, backbone_path, engine=engine)
                 write_log(log_file, f("The argmax z file is {test_zf}, index: {test_index}, max acc: {test_acc}"))
                 total_count += 1
                 if test_acc > threshold:
                     seen_count += 1
-                    with open(z_info, 'r') as z_inf:
-                        Z_info = json.load(z_inf)
-                        for zi in Z_info:
-                            if zi["obj_name"] == obj_name:
-                                index = zi["index"]
-                        if index == test_index:
-                            write_log(log_file, "correct !")
-                            correct_count += 1
-                        else:
-                            write_log(log_file, "false !")
-                            false_count += 1
+                    if z_index_of(obj_name) == test_index:
+                        write_log(log_file, "correct !")
+                        correct_count += 1
+                    else:
+                        write_log(log_file, "false !")
+                        false_count += 1
                 else:
                     unseen_count += 1
     res_info = f("""test on seen objects:
@@ -95,9 +183,10 @@ def test_unseen_obj(obj_dir, z_dir, hypernet_path, backbone_path, log_name, thre
     total_count = 0
     seen_count = 0
     unseen_count = 0
+    engine = ReIDEngine(z_dir, hypernet_path, backbone_path)
     for data_dir in data_dirs:
         write_log(log_file, f("Start testing object {data_dir}..."))
-        test_acc, test_index, test_zf = test_unit(data_dir, z_dir, hypernet_path, backbone_path, start_index=31)
+        test_acc, test_index, test_zf = test_unit(data_dir, z_dir, hypernet_path, backbone_path, start_index=31, engine=engine)
         total_count += 1
         if test_acc > threshold:
             seen_count += 1
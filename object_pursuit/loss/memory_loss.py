@@ -3,6 +3,8 @@ import random
 import torch
 import torch.nn as nn
 
+from object_pursuit.utils.profiling import label
+
 
 class MemoryLoss(nn.Module):
     """The loss function for forgetting prevention"""
@@ -36,8 +38,9 @@ class MemoryLoss(nn.Module):
         else:
             sample_len = len(index_list)
         index_list = random.sample(index_list, sample_len)
-        for i in index_list:
-            pred_w = hypernet(self.z[i])
-            gt_w = self.weights[i]
-            self._l2_loss(pred_w, gt_w, mem_coeff)
+        with label("memory_loss"):
+            for i in index_list:
+                pred_w = hypernet(self.z[i])
+                gt_w = self.weights[i]
+                self._l2_loss(pred_w, gt_w, mem_coeff)
             
\ No newline at end of file
@@ -0,0 +1,112 @@
+'''Batched segmentation metrics (dice, Jaccard, boundary F), computed per sample on the device'''
+import math
+import collections
+import torch
+import torch.nn.functional as F
+
+
+def binarize(mask_pred, out_threshold=0.5):
+    """logits -> binary float masks"""
+    return (torch.sigmoid(mask_pred) > out_threshold).float()
+
+
+def batch_dice(pred, target, eps=0.0001):
+    """Dice coeff for each sample of a batch (B*1*H*W), returns a tensor of size B"""
+    pred = pred.flatten(1).float()
+    target = target.flatten(1).float()
+    inter = (pred * target).sum(dim=1)
+    union = pred.sum(dim=1) + target.sum(dim=1) + eps
+    return (2 * inter + eps) / union
+
+
+def batch_jaccard(pred, target):
+    """Region similarity J (Jaccard index) for each sample of a batch, 1 if both masks are empty"""
+    pred = pred.flatten(1) != 0
+    target = target.flatten(1) != 0
+    inter = (pred & target).sum(dim=1).float()
+    union = (pred | target).sum(dim=1).float()
+    return torch.where(union == 0, torch.ones_like(union), inter / union.clamp(min=1))
+
+
+def batch_seg2bmap(seg):
+    """Batched version of criterion.seg2bmap: binary masks (B*H*W) -> 1 pixel wide boundary maps (B*H*W, bool).
+    The boundary pixels are offset by 1/2 pixel towards the origin from the actual segment boundary."""
+    seg = seg != 0
+    e = torch.zeros_like(seg)
+    s = torch.zeros_like(seg)
+    se = torch.zeros_like(seg)
+    e[:, :, :-1] = seg[:, :, 1:]
+    s[:, :-1, :] = seg[:, 1:, :]
+    se[:, :-1, :-1] = seg[:, 1:, 1:]
+
+    b = (seg ^ e) | (seg ^ s) | (seg ^ se)
+    b[:, -1, :] = seg[:, -1, :] ^ e[:, -1, :]
+    b[:, :, -1] = seg[:, :, -1] ^ s[:, :, -1]
+    b[:, -1, -1] = False
+    return b
+
+
+def dilate_disk(bmap, radius):
+    """Binary dilation (B*H*W) with a disk structuring element (same as skimage.morphology.disk).
+    A disk is the union of the centered rectangles {|x| <= floor(sqrt(r^2-h^2)), |y| <= h}, h = 0..r,
+    so the dilation is the max over r+1 max-pools."""
+    x = bmap.float().unsqueeze(1)
+    out = torch.zeros_like(x)
+    for h in range(radius + 1):
+        w = int(math.floor(math.sqrt(radius * radius - h * h)))
+        out = torch.max(out, F.max_pool2d(x, kernel_size=(2*h+1, 2*w+1), stride=1, padding=(h, w)))
+    return out.squeeze(1) > 0
+
+
+def batch_f_boundary(pred, target, bound_th=0.008):
+    """Boundary F-measure for each sample of a batch (B*1*H*W), same definition as criterion.f_boundary"""
+    pred = pred.flatten(0, 1) if pred.dim() == 4 else pred
+    target = target.flatten(0, 1) if target.dim() == 4 else target
+    H, W = pred.size(-2), pred.size(-1)
+    bound_pix = bound_th if bound_th >= 1 else math.ceil(bound_th * math.sqrt(H * H + W * W + 1))
+
+    fg_boundary = batch_seg2bmap(pred)
+    gt_boundary = batch_seg2bmap(target)
+    fg_dil = dilate_disk(fg_boundary, int(bound_pix))
+    gt_dil = dilate_disk(gt_boundary, int(bound_pix))
+
+    gt_match = (gt_boundary & fg_dil).flatten(1).sum(dim=1).float()
+    fg_match = (fg_boundary & gt_dil).flatten(1).sum(dim=1).float()
+    n_fg = fg_boundary.flatten(1).sum(dim=1).float()
+    n_gt = gt_boundary.flatten(1).sum(dim=1).float()
+
+    ones = torch.ones_like(n_fg)
+    precision = torch.where(n_fg == 0, ones, fg_match / n_fg.clamp(min=1))
+    recall = torch.where(n_gt == 0, ones, gt_match / n_gt.clamp(min=1))
+    pr = precision + recall
+    return torch.where(pr == 0, torch.zeros_like(pr), 2 * precision * recall / pr.clamp(min=1e-12))
+
+
+class MetricAccumulator(object):
+    """Accumulate per-sample metrics on the device, results are synchronized to the host only once (compute / batch_means)"""
+    def __init__(self):
+        self.values = collections.OrderedDict()
+
+    def update(self, **metrics):
+        for name, value in metrics.items():
+            value = value.detach()
+            if value.dim() == 0:
+                value = value.unsqueeze(0)
+            self.values.setdefault(name, []).append(value)
+
+    def per_sample(self, name):
+        return torch.cat(self.values[name])
+
+    def compute(self):
+        """mean of every metric over all samples"""
+        names = list(self.values)
+        if len(names) == 0:
+            return {}
+        means = torch.stack([self.per_sample(name).float().mean() for name in names]).tolist()
+        return dict(zip(names, means))
+
+    def batch_means(self, name):
+        """mean of a metric per update (batch)"""
+        if name not in self.values:
+            return []
+        return torch.stack([v.float().mean() for v in self.values[name]]).tolist()
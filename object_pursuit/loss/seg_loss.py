@@ -0,0 +1,26 @@
+'''Segmentation loss on logits at the decoder resolution'''
+import torch
+import torch.nn.functional as F
+
+
+def downsample_masks(masks, size):
+    """area-pooled (soft) masks: the fraction of foreground pixels of every output cell"""
+    if tuple(masks.shape[-2:]) == tuple(size):
+        return masks
+    return F.adaptive_avg_pool2d(masks, size)
+
+
+def seg_loss(pred, masks, pos_weight=None):
+    """BCE between logits and masks. Logits at a lower resolution than the masks (e.g. the decoder output,
+    stride 4) are compared with area-pooled soft masks, instead of upsampling the logits.
+    Leading dims of pred (e.g. the starts of multi-start nets, S*B*1*h*w) are broadcast.
+
+    Args:
+        pred (tensor): logits (...*B*1*h*w)
+        masks (tensor): full resolution masks (B*1*H*W)
+        pos_weight (tensor, optional): weight of positive examples, compute it from the full resolution masks. Defaults to None.
+    """
+    target = downsample_masks(masks, pred.shape[-2:])
+    while target.dim() < pred.dim():
+        target = target.unsqueeze(0)
+    return F.binary_cross_entropy_with_logits(pred, target.expand_as(pred), pos_weight=pos_weight)
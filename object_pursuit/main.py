@@ -37,8 +37,46 @@ def get_args():
                         help='if true, the weights of the backbone will not be predicted by the hypernet')
     parser.add_argument('-save_interval', '--save_interval', dest='save_interval', type=int, default=0,
                         help='the interval object number of saving checkpoints during pursuit')
+    parser.add_argument('-batch_aug', '--batch_aug', dest='batch_aug', action="store_true",
+                        help='if true, crop/resize/normalize whole uint8 batches on the device instead of per-sample PIL transforms')
+    parser.add_argument('-resident', '--resident', dest='resident', action="store_true",
+                        help='if true, decode each object dataset once into memory and slice batches in the main process (no loader workers)')
+    parser.add_argument('-dedup', '--dedup', dest='dedup', type=int, default=None,
+                        help='if set, collapse near-duplicate consecutive frames whose hash distance (bits out of 64) is at most this value')
+    parser.add_argument('-basis_energy', '--basis_energy', dest='basis_energy', type=float, default=None,
+                        help='if set (e.g. 0.99), coefficient pursuit runs against the smallest SVD-compressed basis explaining this fraction of the bases variance')
+    parser.add_argument('-starts', '--starts', dest='starts', type=int, default=1,
+                        help='number of coefficient vectors trained simultaneously per coefficient pursuit (the best half is kept after each epoch), the base update trains a single z')
+    parser.add_argument('-val_ci', '--val_ci', dest='val_ci', type=float, default=None,
+                        help='if set (e.g. 0.02), validate on a stratified subset sized to this 95%% confidence half width of the mean dice')
+    parser.add_argument('-coarse', '--coarse', dest='coarse', type=int, default=None,
+                        help='if set (e.g. 128), express checks train at this square resolution first and only borderline objects are promoted to full resolution')
+    parser.add_argument('-low_res_loss', '--low_res_loss', dest='low_res_loss', action="store_true",
+                        help='if true, the training loss is computed at the decoder resolution against area-pooled masks (no upsampled logits)')
+    parser.add_argument('-speculative', '--speculative', dest='speculative', action="store_true",
+                        help='if true, the base update of an object runs in a second process alongside its first express check')
+    parser.add_argument('-lookahead', '--lookahead', dest='lookahead', type=int, default=0,
+                        help='number of upcoming objects whose have_seen and first express check run ahead in worker processes (0 means sequential)')
+    parser.add_argument('-resume', '--resume', dest='resume', type=str, default=None,
+                        help='output dir of an interrupted pursuit run, resume it from its last committed object')
+    parser.add_argument('-online', '--online', dest='online', action="store_true",
+                        help='online mode: --data is a spool dir, object dirs are pursued as soon as they contain a READY file (until a STOP file appears)')
+    parser.add_argument('-idle_timeout', '--idle_timeout', dest='idle_timeout', type=float, default=None,
+                        help='online mode: stop after this many seconds without a new object (default: wait forever)')
+    parser.add_argument('-force_reeval', '--force_reeval', dest='force_reeval', action="store_true",
+                        help='pursue exact repeats of objects (same dataset fingerprint) again instead of using their cached verdict')
+    parser.add_argument('-step_sample', '--step_sample', dest='step_sample', type=int, default=0,
+                        help='time every n-th training step (data wait, h2d, forward, backward, optimizer), reported per epoch in the training logs (0: off)')
+    parser.add_argument('-profile', '--profile', dest='profile', type=str, nargs='*', default=None, choices=["have_seen", "express_check", "base_update"],
+                        help='torch.profiler capture of these phases (no phase: all three), chrome traces and top operator tables are written to <output dir>/profile')
+    parser.add_argument('-profile_schedule', '--profile_schedule', dest='profile_schedule', type=int, nargs=3, default=[1, 1, 3],
+                        help='wait, warmup and active steps of a profiled phase')
+    parser.add_argument('-profile_captures', '--profile_captures', dest='profile_captures', type=int, default=1,
+                        help='number of profiled occurrences of each phase')
     parser.add_argument('-eval', '--eval', dest='eval', action="store_true",
                         help='use this flag to evaluate pursuit result (eval mode)')
+    parser.add_argument('-eval_workers', '--eval_workers', dest='eval_workers', type=int, default=0,
+                        help='number of cpu worker processes evaluating objects in parallel (eval mode, cpu only)')
     
     return parser.parse_args()
 
@@ -46,7 +84,7 @@ if __name__ == '__main__':
     args = get_args()
     now = datetime.now()
     now_str = now.strftime("%Y_%m_%d_%H:%M:%S")
-    output_dir = os.path.join(args.output_dir, now_str)
+    output_dir = os.path.join(args.output_dir, now_str) if args.resume is None else args.resume
     if not args.eval:
         pursuit(z_dim=args.z_dim, 
                 data_dir=args.data_dir,
@@ -62,12 +100,31 @@ if __name__ == '__main__':
                 express_threshold=args.thres,
                 use_backbone=args.use_backbone,
                 save_temp_interval=args.save_interval,
+                batch_transform=args.batch_aug,
+                resident=args.resident,
+                dedup_threshold=args.dedup,
+                basis_energy=args.basis_energy,
+                starts=args.starts,
+                val_ci_width=args.val_ci,
+                coarse_size=(args.coarse, args.coarse) if args.coarse is not None else None,
+                low_res_loss=args.low_res_loss,
+                speculative=args.speculative,
+                lookahead=args.lookahead,
+                resume=args.resume is not None,
+                online=args.online,
+                idle_timeout=args.idle_timeout,
+                force_reeval=args.force_reeval,
+                step_sample=args.step_sample,
+                profile=args.profile,
+                profile_schedule=args.profile_schedule,
+                profile_captures=args.profile_captures,
                 log_info=f("Data: {args.order}; threshold: {args.thres}"))
     else:
         evalPursuit(z_dim=args.z_dim, 
                     device=default_device, 
                     dataset=args.dataset, 
                     data_dir=args.data_dir, 
-                    ckpt_dir=output_dir, 
+                    ckpt_dir=args.output_dir, 
                     batch_size=8, 
-                    use_backbone=args.use_backbone)
\ No newline at end of file
+                    use_backbone=args.use_backbone,
+                    num_workers=args.eval_workers)
\ No newline at end of file
@@ -12,23 +12,32 @@ from .deeplab_block.decoder import Decoder
 from .hypernet import Hypernet
 
 from object_pursuit.model.deeplabv3.backbone import build_backbone
+from object_pursuit.utils.profiling import label
 
-def deeplab_forward(input, weights):
+def deeplab_forward(input, weights, upsample=True):
     # backbone forward
-    x, low_level_feat = resnet18("backbone", input, weights, output_stride=16)
+    with label("backbone"):
+        x, low_level_feat = resnet18("backbone", input, weights, output_stride=16)
     # aspp forward
-    x = ASPP("aspp", x, weights, output_stride=16)
+    with label("aspp"):
+        x = ASPP("aspp", x, weights, output_stride=16)
     # decoder forward
-    x = Decoder("decoder", x, low_level_feat, weights)
-    x = F.interpolate(x, size=input.size()[2:], mode='bilinear', align_corners=True)
+    with label("decoder"):
+        x = Decoder("decoder", x, low_level_feat, weights)
+        # without upsample, the logits stay at the decoder resolution (1/4 of the input)
+        if upsample:
+            x = F.interpolate(x, size=input.size()[2:], mode='bilinear', align_corners=True)
     return x
 
-def deeplab_forward_no_backbone(input, x, low_level_feat, weights):
+def deeplab_forward_no_backbone(input, x, low_level_feat, weights, upsample=True):
     # aspp forward
-    out = ASPP("aspp", x, weights, output_stride=16)
+    with label("aspp"):
+        out = ASPP("aspp", x, weights, output_stride=16)
     # decoder forward
-    out = Decoder("decoder", out, low_level_feat, weights)
-    out = F.interpolate(out, size=input.size()[2:], mode='bilinear', align_corners=True)
+    with label("decoder"):
+        out = Decoder("decoder", out, low_level_feat, weights)
+        if upsample:
+            out = F.interpolate(out, size=input.size()[2:], mode='bilinear', align_corners=True)
     return out
 
 class Singlenet(nn.Module):
@@ -97,15 +106,16 @@ class Singlenet(nn.Module):
             for param in self.backbone.parameters():
                 param.requires_grad = False
     
-    def forward(self, input):
+    def forward(self, input, upsample=True):
         z = self.z
         weights = self.hypernet(z)
         if not self.use_backbone:
-            return deeplab_forward(input, weights)
+            return deeplab_forward(input, weights, upsample)
         else:
             # backbone forward
-            x, low_level_feat = self.backbone(input)
-            return deeplab_forward_no_backbone(input, x, low_level_feat, weights)
+            with label("backbone"):
+                x, low_level_feat = self.backbone(input)
+            return deeplab_forward_no_backbone(input, x, low_level_feat, weights, upsample)
 
 
 class Coeffnet(nn.Module):
@@ -206,13 +216,14 @@ class Coeffnet(nn.Module):
             for param in self.backbone.parameters():
                 param.requires_grad = False
     
-    def forward(self, input):
+    def forward(self, input, upsample=True):
         new_z = self.combine_func(self.zs, self.coeffs)
         weights = self.hypernet(new_z)
         
         if not self.use_backbone:
-            return deeplab_forward(input, weights)
+            return deeplab_forward(input, weights, upsample)
         else:
             # backbone forward
-            x, low_level_feat = self.backbone(input)
-            return deeplab_forward_no_backbone(input, x, low_level_feat, weights)
\ No newline at end of file
+            with label("backbone"):
+                x, low_level_feat = self.backbone(input)
+            return deeplab_forward_no_backbone(input, x, low_level_feat, weights, upsample)
\ No newline at end of file
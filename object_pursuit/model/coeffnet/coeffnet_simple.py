@@ -8,6 +8,8 @@ import torch.nn.functional as F
 
 from coeffnet import deeplab_forward_no_backbone, deeplab_forward
 from object_pursuit.model.deeplabv3.backbone import build_backbone
+from object_pursuit.model.coeffnet.hypernet import select_weights
+from object_pursuit.utils.profiling import label
 
 def init_backbone(model_path, backbone, device, freeze=False):
     '''init backbone with pretrained model'''
@@ -81,6 +83,10 @@ class Singlenet(nn.Module):
             else:
                 raise IOError
             
+    def get_z(self):
+        with torch.no_grad():
+            return self.z.clone().detach()
+        
     def save_z(self, file_path, hypernet=None):
         with torch.no_grad():
             z = self.z.clone().detach()
@@ -90,14 +96,15 @@ class Singlenet(nn.Module):
             else:
                 torch.save({'z':z}, file_path)
         
-    def forward(self, input, hypernet, backbone=None):
+    def forward(self, input, hypernet, backbone=None, upsample=True):
         z = self.z
         weights = hypernet(z)
         if backbone is not None:
-            x, low_level_feat = backbone(input)
-            out = deeplab_forward_no_backbone(input, x, low_level_feat, weights)
+            with label("backbone"):
+                x, low_level_feat = backbone(input)
+            out = deeplab_forward_no_backbone(input, x, low_level_feat, weights, upsample)
         else:
-            out = deeplab_forward(input, weights)
+            out = deeplab_forward(input, weights, upsample)
         return out
     
     def L1_loss(self, coeff):
@@ -130,14 +137,15 @@ class Coeffnet(nn.Module):
             z += zs[i] * coeffs[i]
         return z
     
-    def forward(self, input, bases_z, hypernet, backbone=None):
+    def forward(self, input, bases_z, hypernet, backbone=None, upsample=True):
         new_z = self.combine_func(bases_z, self.coeffs)
         weights = hypernet(new_z)
         if backbone is not None:
-            x, low_level_feat = backbone(input)
-            out = deeplab_forward_no_backbone(input, x, low_level_feat, weights)
+            with label("backbone"):
+                x, low_level_feat = backbone(input)
+            out = deeplab_forward_no_backbone(input, x, low_level_feat, weights, upsample)
         else:
-            out = deeplab_forward(input, weights)
+            out = deeplab_forward(input, weights, upsample)
         return out
     
     def L1_loss(self, coeff):
@@ -155,3 +163,89 @@ class Coeffnet(nn.Module):
                 torch.save({'z':z, 'weights':weights}, file_path)
             else:
                 torch.save({'z':z}, file_path)
+
+
+def multi_forward(input, weights, num, backbone=None, upsample=True):
+    """forward a batch with the weights of num zs (generated as one batch by the hypernet), the backbone runs once
+
+    Returns:
+        tensor: num*B*1*H*W
+    """
+    if backbone is not None:
+        with label("backbone"):
+            x, low_level_feat = backbone(input)
+    outs = []
+    for s in range(num):
+        w = select_weights(weights, s)
+        if backbone is not None:
+            outs.append(deeplab_forward_no_backbone(input, x, low_level_feat, w, upsample))
+        else:
+            outs.append(deeplab_forward(input, w, upsample))
+    return torch.stack(outs)
+
+
+class MultiStart(object):
+    """Successive halving over S starts trained simultaneously: prune() keeps the better half of the alive starts,
+    the winner is the best alive start"""
+    def _init_starts(self, starts):
+        self.starts = starts
+        self.alive = list(range(starts))
+        self.scores = [0.0] * starts
+        
+    def prune(self, scores):
+        """scores: validation scores of the alive starts (in the order of self.alive)"""
+        for i, score in zip(self.alive, scores):
+            self.scores[i] = score
+        ranked = sorted(self.alive, key=lambda i: self.scores[i], reverse=True)
+        keep = int(math.ceil(len(ranked) / 2))
+        self.alive = sorted(ranked[:keep])
+        return ranked[keep:]
+    
+    @property
+    def winner(self):
+        return max(self.alive, key=lambda i: self.scores[i])
+
+
+class MultiCoeffnet(nn.Module, MultiStart):
+    """
+    S Coeffnets (coefficient vectors) trained simultaneously, the output of forward is S_alive*B*1*H*W.
+    The first start is the uniform init of Coeffnet, the others are random perturbations of it.
+    """
+    n_channels = 3
+    n_classes = 1
+    def __init__(self, bases_num, starts, nn_init=True):
+        super(MultiCoeffnet, self).__init__()
+        self.base_num = bases_num
+        coeffs = torch.randn(starts, self.base_num)
+        if nn_init:
+            init_value = 1.0/math.sqrt(self.base_num)
+            noise = coeffs * init_value
+            noise[0] = 0.0
+            coeffs = init_value + noise
+        self.coeffs = nn.Parameter(coeffs)
+        self._init_starts(starts)
+        
+    def _combine(self, bases, coeffs):
+        return torch.mm(coeffs, torch.stack(bases))
+    
+    def forward(self, input, bases_z, hypernet, backbone=None, upsample=True):
+        new_z = self._combine(bases_z, self.coeffs[self.alive])
+        weights = hypernet(new_z)
+        return multi_forward(input, weights, len(self.alive), backbone, upsample)
+    
+    def L1_loss(self, coeff):
+        coeffs = self.coeffs[self.alive]
+        return coeff * len(self.alive) * F.l1_loss(coeffs, torch.zeros(coeffs.size()).to(coeffs.device))
+    
+    def get_z(self, bases):
+        with torch.no_grad():
+            return self._combine(bases, self.coeffs[self.winner].unsqueeze(0))[0]
+        
+    def save_z(self, file_path, bases, hypernet=None):
+        with torch.no_grad():
+            z = self.get_z(bases)
+            if hypernet is not None:
+                weights = hypernet(z)
+                torch.save({'z':z, 'weights':weights}, file_path)
+            else:
+                torch.save({'z':z}, file_path)
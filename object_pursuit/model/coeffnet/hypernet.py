@@ -4,6 +4,7 @@ import collections
 
 from object_pursuit.model.coeffnet.config.deeplab_param import *
 from object_pursuit.model.coeffnet.hypernet_block import HypernetConvBlock
+from object_pursuit.utils.profiling import label
     
 class Hypernet(nn.Module):
     def __init__(self, z_dim, param_dict=deeplab_param):
@@ -20,9 +21,16 @@ class Hypernet(nn.Module):
         return nn.ModuleDict(hypernet_dict)
     
     def forward(self, z):
+        # a batch of zs (S*z_dim) generates all weights with a leading dim S, see select_weights
         weights = collections.OrderedDict()
-        for param in self.blocks:
-            weight_param = param.replace('-', '.')
-            weights[weight_param+'.weight'], weights[weight_param+'.bn_weight'], weights[weight_param+'.bn_bias'] = self.blocks[param](z)
+        with label("hypernet"):
+            for param in self.blocks:
+                weight_param = param.replace('-', '.')
+                weights[weight_param+'.weight'], weights[weight_param+'.bn_weight'], weights[weight_param+'.bn_bias'] = self.blocks[param](z)
         return weights
     
+
+
+def select_weights(weights, index):
+    """weights of the index-th z, from weights generated for a batch of zs"""
+    return collections.OrderedDict((k, v[index]) for k, v in weights.items())
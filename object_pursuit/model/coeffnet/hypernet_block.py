@@ -145,10 +145,18 @@ class HypernetConvBlock(nn.Module):
         return nn.Conv2d(in_channels=channels, out_channels=channels, kernel_size=kernel_size, stride=1)
     
     def forward(self, z):
-        out = self.expand_linear(z)
-        out = out.view(1,1,self.init_block,self.init_block)
-        out = self.conv_kernel_gen(out)
-        out = out.permute(2,3,0,1).view(self.out_size, self.in_size, self.kernel_size, self.kernel_size)
+        # z: z_dim, or S*z_dim for a batch of S zs (weights are then generated with a leading dim S)
+        if z.dim() == 2:
+            S = z.size(0)
+            out = self.expand_linear(z)
+            out = out.view(S,1,self.init_block,self.init_block)
+            out = self.conv_kernel_gen(out)
+            out = out.permute(0,2,3,1).contiguous().view(S, self.out_size, self.in_size, self.kernel_size, self.kernel_size)
+        else:
+            out = self.expand_linear(z)
+            out = out.view(1,1,self.init_block,self.init_block)
+            out = self.conv_kernel_gen(out)
+            out = out.permute(2,3,0,1).view(self.out_size, self.in_size, self.kernel_size, self.kernel_size)
         bn_w = self.bn_weight(z)
         bn_b = self.bn_bias(z)
         return out, bn_w, bn_b
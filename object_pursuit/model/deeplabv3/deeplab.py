@@ -8,6 +8,7 @@ from object_pursuit.model.deeplabv3.sync_batchnorm.batchnorm import Synchronized
 from object_pursuit.model.deeplabv3.aspp import build_aspp
 from object_pursuit.model.deeplabv3.decoder import build_decoder
 from object_pursuit.model.deeplabv3.backbone import build_backbone
+from object_pursuit.utils.profiling import label
 
 class DeepLab(nn.Module):
     def __init__(self, backbone='resnet', output_stride=16, num_classes=21,
@@ -40,11 +41,15 @@ class DeepLab(nn.Module):
         
         self.freeze_bn = freeze_bn
 
-    def forward(self, input):
-        x, low_level_feat = self.backbone(input)
-        x = self.aspp(x)
-        x = self.decoder(x, low_level_feat)
-        x = F.interpolate(x, size=input.size()[2:], mode='bilinear', align_corners=True)
+    def forward(self, input, upsample=True):
+        with label("backbone"):
+            x, low_level_feat = self.backbone(input)
+        with label("aspp"):
+            x = self.aspp(x)
+        with label("decoder"):
+            x = self.decoder(x, low_level_feat)
+            if upsample:
+                x = F.interpolate(x, size=input.size()[2:], mode='bilinear', align_corners=True)
 
         return x
 
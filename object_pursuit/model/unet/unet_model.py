@@ -24,7 +24,8 @@ class UNet(nn.Module):
         self.up4 = Up(128, 64, bilinear)
         self.outc = OutConv(64, n_classes)
 
-    def forward(self, x):
+    def forward(self, x, upsample=True):
+        # the logits are at the input resolution anyway, upsample is accepted for a common interface with deeplab
         x1 = self.inc(x)
         x2 = self.down1(x1)
         x3 = self.down2(x2)
@@ -0,0 +1,219 @@
+import os
+import json
+import queue
+import hashlib
+import threading
+import collections
+import torch
+
+from object_pursuit.utils.util import *
+
+
+class TensorStore(object):
+    """Content addressed tensor files: a tensor is saved once under the sha1 of its dtype, shape and data
+    (root/<hash[:2]>/<hash>.pth), state dicts are saved as manifests (key -> hash)."""
+    def __init__(self, root):
+        self.root = root
+        create_dir(root)
+
+    def _path(self, digest):
+        return os.path.join(self.root, digest[:2], digest + ".pth")
+
+    @staticmethod
+    def digest(tensor):
+        tensor = tensor.detach().cpu().contiguous()
+        h = hashlib.sha1()
+        h.update(f("{tensor.dtype}{tuple(tensor.size())}").encode())
+        h.update(tensor.numpy().tobytes() if tensor.dtype != torch.bfloat16 else tensor.float().numpy().tobytes())
+        return h.hexdigest()
+
+    def put(self, tensor, digest=None):
+        """save tensor (if it's not in the store yet), returns its hash"""
+        tensor = tensor.detach().cpu()
+        if digest is None:
+            digest = self.digest(tensor)
+        path = self._path(digest)
+        if not os.path.isfile(path):
+            create_dir(os.path.dirname(path))
+            tmp_file = f("{path}.{os.getpid()}.{threading.get_ident()}.tmp")
+            torch.save(tensor.clone(), tmp_file)
+            os.rename(tmp_file, path)
+        return digest
+
+    def get(self, digest, device='cpu'):
+        return torch.load(self._path(digest), map_location=device)
+
+    def put_state(self, state_dict):
+        return collections.OrderedDict((k, self.put(v)) for k, v in state_dict.items())
+
+    def get_state(self, manifest, device='cpu'):
+        return collections.OrderedDict((k, self.get(h, device)) for k, h in manifest.items())
+
+
+class CheckpointStore(object):
+    """Incremental pursuit checkpoints on a TensorStore (checkpoint_dir/store), all writes run on a background thread.
+
+    - modules (hypernet, backbone) are saved as manifests, tensors unchanged since the last save (same parameter,
+      same version counter) are neither copied nor hashed again: of the frozen backbone, only the batch norm
+      buffers are stored again (training runs it in train mode, its running statistics change with every object)
+    - zs and bases are appended as deltas to checkpoint_dir/<zs|Bases>_delta.jsonl (file name, hash)
+    - a round checkpoint (checkpoint_dir/rounds/round_<n>.json) is the hypernet manifest and the lengths of
+      the delta logs, export_round rebuilds the full checkpoint dir (hypernet.pth, zs, Bases) of a round
+
+    Args:
+        checkpoint_dir (str): checkpoint dir of the pursuit
+    """
+    delta_logs = ("zs", "Bases")
+
+    def __init__(self, checkpoint_dir):
+        self.checkpoint_dir = checkpoint_dir
+        self.tensors = TensorStore(os.path.join(checkpoint_dir, "store"))
+        create_dir(os.path.join(checkpoint_dir, "rounds"))
+        # (tag, key) -> (parameter, version, hash)
+        self._known = {}
+        self._manifests = {}
+        self._lengths = {}
+        for name in self.delta_logs:
+            log_path = self._log_path(name)
+            self._lengths[name] = sum(1 for _ in open(log_path)) if os.path.isfile(log_path) else 0
+        self._jobs = queue.Queue()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name="pursuit-checkpoint")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _log_path(self, name):
+        return os.path.join(self.checkpoint_dir, f("{name}_delta.jsonl"))
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            try:
+                if job is None:
+                    return
+                job()
+            except Exception as e:
+                self._error = e
+            finally:
+                self._jobs.task_done()
+
+    def _submit(self, job):
+        if self._error is not None:
+            raise self._error
+        self._jobs.put(job)
+
+    def save_module(self, tag, module, file_path=None):
+        """save the state of module, and a full state dict to file_path if anything changed since the last save
+        (the state dict is copied from the module, unchanged tensors are not read back from the store)
+
+        Returns:
+            bool: the module has changed
+        """
+        changed = collections.OrderedDict()
+        manifest = collections.OrderedDict()
+        for key, param in module.state_dict(keep_vars=True).items():
+            known = self._known.get((tag, key))
+            if known is not None and known[0] is param and known[1] == param._version:
+                manifest[key] = known[2]
+            else:
+                # the copy is hashed and written in the background
+                changed[key] = (param, param._version, param.detach().cpu().clone())
+                manifest[key] = None
+        if len(changed) == 0:
+            return False
+        state = None
+        if file_path is not None:
+            state = collections.OrderedDict((k, changed[k][2] if k in changed else v.detach().cpu().clone())
+                                            for k, v in module.state_dict(keep_vars=True).items())
+
+        def job():
+            for key, (param, version, tensor) in changed.items():
+                manifest[key] = self.tensors.put(tensor)
+                self._known[(tag, key)] = (param, version, manifest[key])
+            self._manifests[tag] = manifest
+            if state is not None:
+                tmp_file = file_path + ".tmp"
+                torch.save(state, tmp_file)
+                os.rename(tmp_file, file_path)
+        self._submit(job)
+        return True
+
+    def append(self, name, file_name, z):
+        """append z (saved as file_name in the zs or Bases dir) to the delta log name"""
+        z = z.detach().cpu().clone()
+        self._lengths[name] += 1
+
+        def job():
+            digest = self.tensors.put(z)
+            with open(self._log_path(name), "a") as log:
+                log.write(json.dumps({"file": file_name, "hash": digest}) + "\n")
+                log.flush()
+                os.fsync(log.fileno())
+        self._submit(job)
+
+    def delta_lengths(self):
+        """lengths of the delta logs, with the appends submitted so far"""
+        return dict(self._lengths)
+
+    def truncate_deltas(self, lengths):
+        """cut the delta logs to lengths (a resumed run drops the entries of the uncommitted object)"""
+        self.flush()
+        for name, length in lengths.items():
+            log_path = self._log_path(name)
+            if not os.path.isfile(log_path):
+                continue
+            with open(log_path) as log:
+                lines = log.readlines()[:length]
+            with open(log_path + ".tmp", "w") as log:
+                log.writelines(lines)
+                log.flush()
+                os.fsync(log.fileno())
+            os.rename(log_path + ".tmp", log_path)
+            self._lengths[name] = len(lines)
+
+    def save_round(self, round_index):
+        """checkpoint of the current state, in the order of the previous saves"""
+        lengths = dict(self._lengths)
+
+        def job():
+            record = {"round": round_index, "modules": dict(self._manifests), "deltas": lengths}
+            path = os.path.join(self.checkpoint_dir, "rounds", f("round_{round_index}.json"))
+            with open(path + ".tmp", "w") as f_round:
+                json.dump(record, f_round)
+            os.rename(path + ".tmp", path)
+        self._submit(job)
+
+    def flush(self):
+        self._jobs.join()
+        if self._error is not None:
+            raise self._error
+
+    def close(self):
+        self.flush()
+        self._jobs.put(None)
+        self._thread.join()
+
+
+def export_round(checkpoint_dir, round_index, target_dir):
+    """write the checkpoint of a round in the layout of a full checkpoint dir: hypernet.pth (and backbone.pth),
+    zs and Bases dirs with the z files ({'z': z}) up to that round"""
+    store = TensorStore(os.path.join(checkpoint_dir, "store"))
+    with open(os.path.join(checkpoint_dir, "rounds", f("round_{round_index}.json"))) as f_round:
+        record = json.load(f_round)
+    create_dir(target_dir)
+    for tag, manifest in record["modules"].items():
+        torch.save(store.get_state(manifest), os.path.join(target_dir, f("{tag}.pth")))
+    for name, length in record["deltas"].items():
+        entries = collections.OrderedDict()
+        log_path = os.path.join(checkpoint_dir, f("{name}_delta.jsonl"))
+        if os.path.isfile(log_path):
+            with open(log_path) as log:
+                for i, line in enumerate(log):
+                    if i >= length:
+                        break
+                    entry = json.loads(line)
+                    # a later entry of the same file (an object pursued again after a resume) replaces the earlier one
+                    entries[entry["file"]] = entry["hash"]
+        create_dir(os.path.join(target_dir, name))
+        for file_name, digest in entries.items():
+            torch.save({'z': store.get(digest)}, os.path.join(target_dir, name, file_name))
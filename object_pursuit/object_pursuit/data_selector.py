@@ -1,14 +1,17 @@
 import os
 import copy
+import time
 import random
 
 from object_pursuit.dataset.basic_dataset import BasicDataset
 
 class iThorDataSelector(object):    
-    def __init__(self, data_dir, strat="sequence", resize=None, shuffle_seed=None, insert_seen=True, limit_num=None):
+    def __init__(self, data_dir, strat="sequence", resize=None, shuffle_seed=None, insert_seen=True, limit_num=None, batch_transform=False, dedup_threshold=None):
         assert os.path.isdir(data_dir)
         self.strat = strat
         self.resize = resize
+        self.batch_transform = batch_transform
+        self.dedup_threshold = dedup_threshold
         self.data_dir = data_dir
         self.dir_path = self._get_obj_paths(shuffle_seed, insert_seen, limit_num)
         self.counter = 0
@@ -51,7 +54,7 @@ class iThorDataSelector(object):
         dir_imgs = os.path.join(d, "imgs")
         dir_masks = os.path.join(d, "masks")
         if os.path.isdir(dir_imgs) and os.path.isdir(dir_masks):
-            return BasicDataset(dir_imgs, dir_masks, resize=self.resize)
+            return BasicDataset(dir_imgs, dir_masks, resize=self.resize, batch_transform=self.batch_transform, dedup_threshold=self.dedup_threshold)
         else:
             return None
         
@@ -69,8 +72,8 @@ class iThorDataSelector(object):
             return None, counter
         
 class CO3DDataSelector(iThorDataSelector): 
-    def __init__(self, data_dir, strat="sequence", resize=None, shuffle_seed=None, insert_seen=True, limit_num=None):
-        super().__init__(data_dir, strat=strat, resize=resize, shuffle_seed=shuffle_seed, insert_seen=insert_seen, limit_num=limit_num)
+    def __init__(self, data_dir, strat="sequence", resize=None, shuffle_seed=None, insert_seen=True, limit_num=None, batch_transform=False, dedup_threshold=None):
+        super().__init__(data_dir, strat=strat, resize=resize, shuffle_seed=shuffle_seed, insert_seen=insert_seen, limit_num=limit_num, batch_transform=batch_transform, dedup_threshold=dedup_threshold)
     
     def _get_obj_paths(self, shuffle_seed=None, insert_seen=True, limit_num=None):
         obj_types = os.listdir(self.data_dir)
@@ -90,14 +93,14 @@ class CO3DDataSelector(iThorDataSelector):
         dir_imgs = os.path.join(d, "images")
         dir_masks = os.path.join(d, "masks")
         if os.path.isdir(dir_imgs) and os.path.isdir(dir_masks):
-            return BasicDataset(dir_imgs, dir_masks, resize=self.resize, random_crop=True)
+            return BasicDataset(dir_imgs, dir_masks, resize=self.resize, random_crop=True, batch_transform=self.batch_transform, dedup_threshold=self.dedup_threshold)
         else:
             print("[DataSelector Warning] found error dir: ", dir_imgs)
             return None
         
 class DavisDataSelector(iThorDataSelector):
-    def __init__(self, data_dir, strat="sequence", resize=None, shuffle_seed=None, insert_seen=True, limit_num=None):
-        super().__init__(data_dir, strat=strat, resize=resize, shuffle_seed=shuffle_seed, insert_seen=insert_seen, limit_num=limit_num)
+    def __init__(self, data_dir, strat="sequence", resize=None, shuffle_seed=None, insert_seen=True, limit_num=None, batch_transform=False, dedup_threshold=None):
+        super().__init__(data_dir, strat=strat, resize=resize, shuffle_seed=shuffle_seed, insert_seen=insert_seen, limit_num=limit_num, batch_transform=batch_transform, dedup_threshold=dedup_threshold)
         
     def _get_obj_paths(self, shuffle_seed=None, insert_seen=True, limit_num=None):
         self.ImgPath = "JPEGImages"
@@ -117,7 +120,75 @@ class DavisDataSelector(iThorDataSelector):
         dir_imgs = os.path.join(self.data_dir, self.ImgPath, self.ResolutionPath, d)
         dir_masks = os.path.join(self.data_dir, self.MaskPath, self.ResolutionPath, d)
         if os.path.isdir(dir_imgs) and os.path.isdir(dir_masks):
-            return BasicDataset(dir_imgs, dir_masks, resize=self.resize, random_crop=True)
+            return BasicDataset(dir_imgs, dir_masks, resize=self.resize, random_crop=True, batch_transform=self.batch_transform, dedup_threshold=self.dedup_threshold)
         else:
             print("[DataSelector Warning] found error dir: ", dir_imgs)
-            return None
\ No newline at end of file
+            return None
+class SpoolDataSelector(iThorDataSelector):
+    """Online data selector consuming objects from a spool dir: a producer writes an object dir
+    (imgs/masks, or images/masks with the CO3D layout) into the spool dir and then creates the file READY in it.
+    Objects are taken in the order they became ready; next() waits for new objects until the file STOP exists
+    in the spool dir or no object arrived for idle_timeout seconds (None: wait forever).
+    """
+    ready_marker = "READY"
+    stop_marker = "STOP"
+    
+    def __init__(self, spool_dir, layout="iThor", resize=None, batch_transform=False, dedup_threshold=None, poll_interval=2.0, idle_timeout=None):
+        self.layout = layout
+        self.poll_interval = poll_interval
+        self.idle_timeout = idle_timeout
+        self.arrivals = {}
+        super().__init__(spool_dir, strat="sequence", resize=resize, insert_seen=False, batch_transform=batch_transform, dedup_threshold=dedup_threshold)
+        
+    def _get_obj_paths(self, shuffle_seed=None, insert_seen=True, limit_num=None):
+        self.dir_path = []
+        self._scan()
+        return self.dir_path
+    
+    def _scan(self):
+        """append the objects that became ready since the last scan"""
+        new = []
+        for dn in os.listdir(self.data_dir):
+            d = os.path.join(self.data_dir, dn)
+            marker = os.path.join(d, self.ready_marker)
+            if d not in self.arrivals and os.path.isfile(marker):
+                new.append((os.path.getmtime(marker), dn, d))
+        for arrival, _, d in sorted(new):
+            self.arrivals[d] = arrival
+            self.dir_path.append(d)
+            
+    def arrival_time(self, d):
+        return self.arrivals.get(d)
+    
+    def available(self):
+        """an object is ready to be taken without waiting"""
+        self._scan()
+        return self.counter < len(self.dir_path)
+    
+    def _get_dataset(self, d):
+        if self.layout == "CO3D":
+            return CO3DDataSelector._get_dataset(self, d)
+        return iThorDataSelector._get_dataset(self, d)
+    
+    def next(self):
+        # objects with invalid dirs are skipped
+        while True:
+            d, self.counter = self._sequence_next(self.counter)
+            if d is None:
+                return None, None
+            ds = self._get_dataset(d)
+            if ds is not None:
+                return ds, d
+    
+    def _sequence_next(self, counter):
+        waited = 0.0
+        while True:
+            if self.counter < len(self.dir_path):
+                return self.dir_path[self.counter], counter+1
+            if os.path.isfile(os.path.join(self.data_dir, self.stop_marker)):
+                return None, counter
+            if self.idle_timeout is not None and waited >= self.idle_timeout:
+                return None, counter
+            time.sleep(self.poll_interval)
+            waited += self.poll_interval
+            self._scan()
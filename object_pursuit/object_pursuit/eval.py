@@ -4,48 +4,179 @@ This script contains tools for evaluating hypernet and bases aquired from the pu
 import os
 import json
 import torch
+import torch.multiprocessing as mp
 from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+from object_pursuit.dataset.basic_dataset import BasicDataset
+from object_pursuit.model.coeffnet.hypernet import Hypernet
+from object_pursuit.model.coeffnet.coeffnet import deeplab_forward, deeplab_forward_no_backbone
+from object_pursuit.model.coeffnet.coeffnet_simple import Backbone, init_backbone, init_hypernet
+from object_pursuit.model.coeffnet.config.deeplab_param import deeplab_param, deeplab_param_decoder
+from object_pursuit.loss.metrics import MetricAccumulator, batch_dice, batch_jaccard, batch_f_boundary, binarize
+from object_pursuit.utils.catalog import ObjectCatalog, load_z_info
+from object_pursuit.utils.profiling import label
+from object_pursuit.utils.util import *
+
+DAVIS_VAL_OBJECTS = ["blackswan", "bmx-trees", "breakdance", "camel", "car-roundabout", "car-shadow", "cows", "dance-twirl", "dog", "drift-chicane", "drift-straight", "goat", "horsejump-high", "kite-surf", "libby", "motocross-jump", "paragliding-launch", "parkour", "scooter-black", "soapbox"]
 
-from dataset.basic_dataset import BasicDataset
-from object_pursuit.model.coeffnet.coeffnet import Singlenet
-from evaluation.eval_net import eval_net
-    
 def getObjDataPath(dataset, data_dir, obj, res="480p"):
     if dataset == "DAVIS":
         img_ent = "JPEGImages"
         mask_ent = "Annotations"
         img_dir = os.path.join(data_dir, img_ent, res, obj)
         mask_dir = os.path.join(data_dir, mask_ent, res, obj)
-        if (not os.path.isdir(img_dir)) or (not os.path.isdir(mask_dir)):
-            print(f("[Warning] {img_dir} or {mask_dir} may not be correct directories"))
-        return img_dir, mask_dir
+    elif dataset == "iThor" or dataset == "CO3D":
+        # the data selectors record the object dir itself
+        obj_dir = obj if os.path.isdir(obj) else os.path.join(data_dir, obj)
+        img_ent = "imgs" if dataset == "iThor" else "images"
+        img_dir = os.path.join(obj_dir, img_ent)
+        mask_dir = os.path.join(obj_dir, "masks")
     else:
         raise NotImplementedError
-    
-def evalPursuit(z_dim, device, dataset, data_dir, ckpt_dir, batch_size=8, use_backbone=False):
+    if (not os.path.isdir(img_dir)) or (not os.path.isdir(mask_dir)):
+        print(f("[Warning] {img_dir} or {mask_dir} may not be correct directories"))
+    return img_dir, mask_dir
+
+
+class PursuitEvaluator(object):
+    """Evaluate the objects of a pursuit result (z_info.json) with a single hypernet / backbone.
+    The hypernet generates the weights of each object once, the backbone is shared by all objects.
+
+    Args:
+        z_dim (int): dimension of z
+        device (torch.device): device to evaluate on
+        dataset (str): "DAVIS", "iThor" or "CO3D"
+        data_dir (str): dataset root
+        ckpt_dir (str): pursuit output dir (contains z_info.json, zs/, checkpoint/)
+        use_backbone (bool, optional): the hypernet generates decoder weights only. Defaults to True.
+        resize (tuple, optional): evaluation image size. Defaults to (256, 256).
+        batch_size (int, optional): Defaults to 8.
+        loader_workers (int, optional): DataLoader workers per object. Defaults to 0.
+    """
+    def __init__(self, z_dim, device, dataset, data_dir, ckpt_dir, use_backbone=True, resize=(256, 256), batch_size=8, loader_workers=0):
+        self.z_dim = z_dim
+        self.device = device
+        self.dataset = dataset
+        self.data_dir = data_dir
+        self.ckpt_dir = ckpt_dir
+        self.resize = resize
+        self.batch_size = batch_size
+        self.loader_workers = loader_workers
+        # build hypernet & backbone once
+        if use_backbone:
+            self.hypernet = Hypernet(z_dim, param_dict=deeplab_param_decoder)
+            self.backbone = Backbone()
+            init_backbone(os.path.join(ckpt_dir, "checkpoint", "backbone.pth"), self.backbone, device, freeze=True)
+            self.backbone.to(device)
+        else:
+            self.hypernet = Hypernet(z_dim, param_dict=deeplab_param)
+            self.backbone = None
+        init_hypernet(os.path.join(ckpt_dir, "checkpoint", "hypernet.pth"), self.hypernet, device, freeze=True)
+        self.hypernet.to(device)
+        self.hypernet.eval()
+
+    def _get_dataset(self, obj):
+        img_dir, mask_dir = getObjDataPath(self.dataset, self.data_dir, obj)
+        return BasicDataset(img_dir, mask_dir, resize=self.resize, random_crop=(self.dataset != "iThor"))
+
+    def eval_object(self, z_inf):
+        z_file = os.path.join(self.ckpt_dir, "zs", z_inf["z_file"])
+        z = torch.load(z_file, map_location=self.device)['z']
+        loader = DataLoader(self._get_dataset(z_inf["data_dir"]), batch_size=self.batch_size, shuffle=False, num_workers=self.loader_workers, drop_last=False)
+        metrics = MetricAccumulator()
+        with torch.no_grad():
+            weights = self.hypernet(z)
+            for batch in loader:
+                imgs = batch['image'].to(device=self.device, dtype=torch.float32)
+                true_masks = batch['mask'].to(device=self.device, dtype=torch.float32)
+                if self.backbone is not None:
+                    with label("backbone"):
+                        x, low_level_feat = self.backbone(imgs)
+                    mask_pred = deeplab_forward_no_backbone(imgs, x, low_level_feat, weights)
+                else:
+                    mask_pred = deeplab_forward(imgs, weights)
+                pred = binarize(mask_pred)
+                metrics.update(J=batch_jaccard(pred, true_masks),
+                               F=batch_f_boundary(pred, true_masks),
+                               dice=batch_dice(pred, true_masks))
+        res = metrics.compute()
+        count = len(metrics.per_sample("J")) if "J" in metrics.values else 0
+        return {
+            "index": z_inf["index"],
+            "data_dir": z_inf["data_dir"],
+            "z_file": z_inf["z_file"],
+            "count": count,
+            "J": res.get("J", 0.0),
+            "F": res.get("F", 0.0),
+            "JF": (res.get("J", 0.0) + res.get("F", 0.0)) / 2,
+            "dice": res.get("dice", 0.0)
+        }
+
+
+# one evaluator per pool worker, built by the pool initializer
+_worker_evaluator = None
+
+def _init_worker(evaluator_kwargs, num_threads):
+    global _worker_evaluator
+    torch.set_num_threads(num_threads)
+    _worker_evaluator = PursuitEvaluator(**evaluator_kwargs)
+
+def _eval_worker(z_inf):
+    return _worker_evaluator.eval_object(z_inf)
+
+
+def _aggregate(records):
+    if len(records) == 0:
+        return {"count": 0}
+    keys = ["J", "F", "JF", "dice"]
+    res = {k: sum(r[k] for r in records) / len(records) for k in keys}
+    res["count"] = len(records)
+    return res
+
+def evalPursuit(z_dim, device, dataset, data_dir, ckpt_dir, batch_size=8, use_backbone=False, num_workers=0, resize=(256, 256)):
+    """Evaluate all objects of the run (its catalog, or z_info.json) (J, F, J&F and dice), write per-object and aggregate
+    results to eval_report.json (and to the catalog).
+    With num_workers > 0 and a cpu device, objects are evaluated by a pool of processes, each loading the models once."""
     assert os.path.isdir(ckpt_dir)
-    with open(os.path.join(ckpt_dir, "z_info.json"), 'r') as f:
-        z_info = json.load(f)
-    record_acc = []
-    for z_inf in z_info:
-        z_file = os.path.join(ckpt_dir, "zs", z_inf["z_file"])
-        if dataset == "DAVIS":
-            img_dir, mask_dir = getObjDataPath("DAVIS", data_dir, z_inf["data_dir"])
-            val_objects = ["blackswan", "bmx-trees", "breakdance", "camel", "car-roundabout", "car-shadow", "cows", "dance-twirl", "dog", "drift-chicane", "drift-straight", "goat", "horsejump-high", "kite-surf(", "libby", "motocross-jump", "paragliding-launch", "parkour", "scooter-black", "soapbox")]
-        Dataset = BasicDataset(img_dir, mask_dir, resize=(256, 256), random_crop=True)
-        net = Singlenet(z_dim, device, use_backbone=use_backbone)
-        net.load_z(z_file)
-        net.init_hypernet(os.path.join(ckpt_dir, "checkpoint", "hypernet.pth"))
-        net.to(device)
-        loader = DataLoader(Dataset, batch_size=batch_size, shuffle=True, num_workers=8, pin_memory=True, drop_last=True)
-        acc, _ = eval_net(net, loader, device, use_IOU=True)
-        print(f("[Pursuit Evaluation] eval acc for obj {z_inf['data_dir']} is {acc}"))
-        if z_inf['data_dir'] in val_objects:
-            record_acc.append(acc)
-            print(f("save {z_inf['data_dir']}'s acc"))
-    print(f("avg acc for val obj is {sum(record_acc)/len(record_acc)}, val obj num: {len(record_acc)}"))
-
-
-
-
-      
\ No newline at end of file
+    z_info = load_z_info(ckpt_dir)
+    evaluator_kwargs = {
+        "z_dim": z_dim,
+        "device": device,
+        "dataset": dataset,
+        "data_dir": data_dir,
+        "ckpt_dir": ckpt_dir,
+        "use_backbone": use_backbone,
+        "resize": resize,
+        "batch_size": batch_size
+    }
+
+    records = []
+    if num_workers > 0 and device.type == 'cpu':
+        num_threads = max(1, torch.get_num_threads() // num_workers)
+        with mp.get_context('fork').Pool(num_workers, initializer=_init_worker, initargs=(evaluator_kwargs, num_threads)) as pool:
+            for rec in tqdm(pool.imap(_eval_worker, z_info), total=len(z_info), desc='Pursuit evaluation', unit='obj'):
+                records.append(rec)
+    else:
+        evaluator = PursuitEvaluator(loader_workers=8, **evaluator_kwargs)
+        for z_inf in tqdm(z_info, desc='Pursuit evaluation', unit='obj'):
+            records.append(evaluator.eval_object(z_inf))
+
+    for rec in records:
+        print(f("[Pursuit Evaluation] obj {rec['data_dir']}: J {rec['J']}, F {rec['F']}, J&F {rec['JF']}, dice {rec['dice']}"))
+
+    aggregate = {"all": _aggregate(records)}
+    if dataset == "DAVIS":
+        aggregate["val"] = _aggregate([rec for rec in records if rec["data_dir"] in DAVIS_VAL_OBJECTS])
+    for split in aggregate:
+        print(f("[Pursuit Evaluation] {split} objects: {aggregate[split]}"))
+
+    catalog = ObjectCatalog.of_run(ckpt_dir)
+    if catalog is not None:
+        for rec in records:
+            catalog.add_evaluation(rec["index"], rec)
+        catalog.close()
+
+    with open(os.path.join(ckpt_dir, "eval_report.json"), 'w') as f_report:
+        json.dump({"dataset": dataset, "objects": records, "aggregate": aggregate}, f_report, indent=2)
+    return records, aggregate
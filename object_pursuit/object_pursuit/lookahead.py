@@ -0,0 +1,250 @@
+import os
+import shutil
+import collections
+import torch
+import torch.multiprocessing as mp
+
+from train import have_seen
+from object_pursuit.model.coeffnet.hypernet import Hypernet
+from object_pursuit.model.coeffnet.coeffnet_simple import Backbone, Coeffnet
+from object_pursuit.utils.basis import compress_bases
+from object_pursuit.utils.util import *
+
+
+def _cpu_state(module):
+    return {k: v.detach().cpu().clone() for k, v in module.state_dict().items()}
+
+def _atomic_save(obj, file_path):
+    tmp_file = file_path + ".tmp"
+    torch.save(obj, tmp_file)
+    os.rename(tmp_file, file_path)
+
+# models of the current version, kept by each worker process between tasks
+_worker_models = {}
+# version published by the main process (shared value), tasks of older versions are dropped
+_current_version = None
+
+def _init_worker(current_version):
+    global _current_version
+    _current_version = current_version
+
+def _outdated(task):
+    return _current_version is not None and _current_version.value != task["version"]
+
+def _load_models(task):
+    if _worker_models.get("state_file") != task["state_file"]:
+        device = task["device"]
+        state = torch.load(task["state_file"], map_location='cpu')
+        hypernet = Hypernet(task["z_dim"], param_dict=task["param_dict"])
+        hypernet.load_state_dict(state["hypernet"])
+        hypernet.to(device)
+        for param in hypernet.parameters():
+            param.requires_grad = False
+        if task["backbone_file"] is not None and "backbone" not in _worker_models:
+            backbone = Backbone(pretrained=False)
+            backbone.load_state_dict(torch.load(task["backbone_file"], map_location='cpu'))
+            for param in backbone.parameters():
+                param.requires_grad = False
+            backbone.to(device)
+            _worker_models["backbone"] = backbone
+        _worker_models["hypernet"] = hypernet
+        _worker_models["bases"] = [z.to(device) for z in state["bases"]]
+        _worker_models["state_file"] = task["state_file"]
+    return _worker_models["hypernet"], _worker_models.get("backbone"), _worker_models["bases"]
+
+def _look_ahead(task):
+    """have_seen and the first express check of one upcoming object, against the hypernet and bases of task["version"]"""
+    # pursuit imports this module
+    from pursuit import coeff_pursuit
+    res = {"version": task["version"], "n_z": len(task["z_files"]), "seen": None, "acc": None, "z_file": None, "z_acc_pairs": None,
+           "check_dir": task["check_dir"], "check_acc": None, "coeffs": None, "outdated": False}
+    # a task queued before a newer version was published is not run (it has been resubmitted)
+    if _outdated(task):
+        res["outdated"] = True
+        return res
+    hypernet, backbone, bases = _load_models(task)
+    device = task["device"]
+    threshold = task["threshold"]
+    seen, acc, z_file, z_acc_pairs = have_seen(task["dataset"], device, None, task["z_dim"], hypernet, backbone, threshold,
+                                               start_index=task["start_index"], test_percent=task["test_percent"], resident=True, z_files=task["z_files"])
+    res.update(seen=seen, acc=acc, z_file=z_file, z_acc_pairs=z_acc_pairs)
+    if seen or len(bases) == 0:
+        return res
+    if _outdated(task):
+        res["outdated"] = True
+        return res
+    coeff_bases = bases
+    if task["basis_energy"] is not None and len(bases) > 1:
+        coeff_bases, _, _ = compress_bases(bases, energy=task["basis_energy"])
+    create_dir(task["check_dir"])
+    log_file = open(os.path.join(task["check_dir"], "lookahead_log.txt"), "w")
+    write_log(log_file, f("lookahead check of {task['data_dir']}, hypernet version {task['version']}"))
+    max_val_acc, coeff_net = coeff_pursuit(task["coarse_size"], threshold, log_file,
+                                           base_num=len(coeff_bases), dataset=task["dataset"], zs=coeff_bases,
+                                           hypernet=hypernet, backbone=backbone, save_cp_path=task["check_dir"], **task["check_kwargs"])
+    write_log(log_file, f("training stop, max validation acc: {max_val_acc}"))
+    log_file.close()
+    res["check_acc"] = max_val_acc
+    if hasattr(coeff_net, "winner"):
+        res["coeffs"] = coeff_net.coeffs[coeff_net.winner].detach().cpu().clone()
+    else:
+        res["coeffs"] = coeff_net.coeffs.detach().cpu().clone()
+    return res
+
+
+class LookaheadScheduler(object):
+    """Run the read-only phases of pursuit (have_seen and the first express check) for the next window objects
+    of a data selector in a pool of (spawned) worker processes, while the main process pursues the current object.
+
+    Only the base update changes the hypernet (and the bases). Every published hypernet and its bases get a version;
+    tasks are run against the version current at submission, and all pending tasks are resubmitted when a new version
+    is published, so results are committed in the order of the data selector and a result is only used if no base
+    update landed since its submission. The workers see the current version (a shared value): tasks of an older
+    version still in the pool queue return at once, running ones stop between have_seen and the check. Version files
+    and check dirs of replaced tasks are removed once these tasks are done. zs added (without a base update) after a task was submitted are checked
+    by the main process when the result is committed, see complete_have_seen.
+
+    Args:
+        dataSelector: data selector, next() -> (dataset, data dir)
+        window (int): number of upcoming objects processed ahead
+        work_dir (str): dir of the version files and the check results
+        z_dir (str): dir of the object zs
+        settings (dict): z_dim, param_dict, device, threshold, start_index, test_percent, coarse_size, basis_energy
+        check_kwargs (dict): keyword arguments of the first check (train_net, without dataset, zs, nets and save path)
+        num_workers (int, optional): number of worker processes. Defaults to window.
+    """
+    def __init__(self, dataSelector, window, work_dir, z_dir, settings, check_kwargs, num_workers=None):
+        self.dataSelector = dataSelector
+        self.window = window
+        self.work_dir = work_dir
+        self.z_dir = z_dir
+        self.settings = settings
+        # data loaders of pool workers can't have worker processes
+        self.check_kwargs = dict(check_kwargs, resident=True)
+        create_dir(work_dir)
+        ctx = mp.get_context('spawn')
+        self.current_version = ctx.Value('i', -1)
+        self.pool = ctx.Pool(num_workers if num_workers is not None else window, initializer=_init_worker, initargs=(self.current_version,))
+        self.pending = collections.deque()
+        # version -> submitted tasks (async results) of that version, for the removal of its file
+        self.version_tasks = {}
+        # (async result, check dir) of replaced tasks, the dir is removed when the task is done
+        self.replaced = []
+        self.version = -1
+        self.state_file = None
+        self.backbone_file = None
+        self.task_counter = 0
+        self.exhausted = False
+
+    def _z_files(self):
+        return [os.path.join(self.z_dir, zf) for zf in sorted(os.listdir(self.z_dir)) if zf.endswith('.json')]
+
+    def _submit(self, dataset, data_dir):
+        check_dir = os.path.join(self.work_dir, f("check_{self.task_counter}"))
+        self.task_counter += 1
+        task = dict(self.settings, version=self.version, state_file=self.state_file, backbone_file=self.backbone_file,
+                    dataset=dataset, data_dir=data_dir, z_files=self._z_files(), check_dir=check_dir, check_kwargs=self.check_kwargs)
+        async_res = self.pool.apply_async(_look_ahead, (task,))
+        self.version_tasks.setdefault(self.version, []).append(async_res)
+        return [dataset, data_dir, async_res, check_dir, self.dataSelector.counter]
+
+    def _collect(self):
+        """remove the check dirs of finished replaced tasks and the files of older versions no task refers to"""
+        still_running = []
+        for async_res, check_dir in self.replaced:
+            if async_res.ready():
+                shutil.rmtree(check_dir, ignore_errors=True)
+            else:
+                still_running.append((async_res, check_dir))
+        self.replaced = still_running
+        for version in sorted(self.version_tasks):
+            if version < self.version and all(r.ready() for r in self.version_tasks[version]):
+                old_file = os.path.join(self.work_dir, f("hypernet_v{version}.pth"))
+                if os.path.isfile(old_file):
+                    os.remove(old_file)
+                del self.version_tasks[version]
+
+    def publish(self, hypernet, backbone, bases):
+        """make the (updated) hypernet and bases the current version, pending objects are resubmitted"""
+        if self.backbone_file is None and backbone is not None:
+            # the backbone is frozen, it's saved once
+            self.backbone_file = os.path.join(self.work_dir, "backbone.pth")
+            _atomic_save(_cpu_state(backbone), self.backbone_file)
+        self.version += 1
+        state_file = os.path.join(self.work_dir, f("hypernet_v{self.version}.pth"))
+        _atomic_save({"hypernet": _cpu_state(hypernet), "bases": [z.detach().cpu().clone() for z in bases]}, state_file)
+        self.state_file = state_file
+        # queued tasks of older versions return at once
+        with self.current_version.get_lock():
+            self.current_version.value = self.version
+        for entry in self.pending:
+            self.replaced.append((entry[2], entry[3]))
+            entry[2:4] = self._submit(entry[0], entry[1])[2:4]
+        self._collect()
+
+    def next(self):
+        """the next object and its lookahead result (None if it failed)
+
+        Returns:
+            tuple: dataset, data dir, result (dict), selector position after the object; (None, None, None, None) at the end
+        """
+        while not self.exhausted and len(self.pending) < self.window:
+            # online selectors: don't wait for objects still to arrive while others are pending
+            if len(self.pending) > 0 and not getattr(self.dataSelector, "available", lambda: True)():
+                break
+            dataset, data_dir = self.dataSelector.next()
+            if dataset is None:
+                self.exhausted = True
+            else:
+                self.pending.append(self._submit(dataset, data_dir))
+        if len(self.pending) == 0:
+            return None, None, None, None
+        dataset, data_dir, async_res, _, position = self.pending.popleft()
+        try:
+            res = async_res.get()
+        except Exception as e:
+            print(f("[Warning] lookahead of {data_dir} failed: {e}"))
+            res = None
+        self._collect()
+        return dataset, data_dir, res, position
+
+    def is_current(self, res):
+        return res is not None and not res["outdated"] and res["version"] == self.version
+
+    def complete_have_seen(self, res, run_have_seen):
+        """have_seen result of a current lookahead result, extended with the zs added since its submission
+
+        Args:
+            res (dict): lookahead result
+            run_have_seen (function): z files -> have_seen result (seen, max acc, max z file, z-acc pairs)
+        """
+        seen, acc, z_file, z_acc_pairs = res["seen"], res["acc"], res["z_file"], list(res["z_acc_pairs"])
+        new_files = self._z_files()[res["n_z"]:]
+        if len(new_files) > 0:
+            new_seen, new_acc, new_z_file, new_pairs = run_have_seen(new_files)
+            z_acc_pairs += new_pairs
+            if new_acc > acc:
+                acc, z_file = new_acc, new_z_file
+            seen = seen or new_seen
+        return seen, acc, z_file, z_acc_pairs
+
+    def take_check(self, res, target_dir, device):
+        """move the first check result of res to target_dir
+
+        Returns:
+            tuple: max validation acc, Coeffnet with the trained coefficients
+        """
+        shutil.move(res["check_dir"], target_dir)
+        coeff_net = Coeffnet(len(res["coeffs"]), nn_init=False)
+        coeff_net.coeffs.data = res["coeffs"].clone()
+        coeff_net.to(device)
+        return res["check_acc"], coeff_net
+
+    def discard(self, res):
+        if res is not None:
+            shutil.rmtree(res["check_dir"], ignore_errors=True)
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
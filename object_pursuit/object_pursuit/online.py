@@ -0,0 +1,47 @@
+import json
+import time
+
+
+class VerdictLog(object):
+    """Per-object verdicts of an online pursuit (one json line per object, flushed immediately), with latency metrics:
+        queue_latency: from the arrival of the object (its READY marker) to the start of its pursuit
+        processing_time: pursuit of the object (have_seen, checks, base update)
+        latency: from arrival to verdict
+    """
+    def __init__(self, file_path):
+        self.file = open(file_path, "a")
+        self.latencies = []
+        self.counts = {}
+
+    def emit(self, data_dir, verdict, acc, start, arrival=None, timings=None, **info):
+        end = time.time()
+        rec = {
+            "data_dir": data_dir,
+            "verdict": verdict,
+            "acc": acc,
+            "time": end,
+            "processing_time": end - start,
+            "queue_latency": start - arrival if arrival is not None else None,
+            "latency": end - arrival if arrival is not None else None,
+            "timings": timings
+        }
+        rec.update(info)
+        self.file.write(json.dumps(rec) + "\n")
+        self.file.flush()
+        self.counts[verdict] = self.counts.get(verdict, 0) + 1
+        if rec["latency"] is not None:
+            self.latencies.append(rec["latency"])
+        return rec
+
+    def summary(self):
+        res = {"objects": sum(self.counts.values()), "verdicts": dict(self.counts)}
+        if len(self.latencies) > 0:
+            latencies = sorted(self.latencies)
+            res["mean_latency"] = sum(latencies) / len(latencies)
+            res["p50_latency"] = latencies[len(latencies) // 2]
+            res["p95_latency"] = latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)]
+            res["max_latency"] = latencies[-1]
+        return res
+
+    def close(self):
+        self.file.close()
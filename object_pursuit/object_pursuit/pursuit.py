@@ -1,18 +1,29 @@
 import os
+import time
 import torch
 import shutil
 import json
 
 from tqdm import tqdm
-from train import train_net, have_seen
+from train import train_net, have_seen, get_coeffs
+from speculative import SpeculativeBaseUpdate, get_rng_state, set_rng_state, get_buffers, set_buffers
+from lookahead import LookaheadScheduler
+from session import PursuitSession
+from checkpoint_store import CheckpointStore
+from online import VerdictLog
 
 
 from object_pursuit.model.coeffnet.hypernet import Hypernet
 from object_pursuit.model.coeffnet.coeffnet_simple import Backbone
 from object_pursuit.model.coeffnet.coeffnet_simple import init_backbone, init_hypernet
-from object_pursuit.object_pursuit.data_selector import iThorDataSelector, DavisDataSelector, CO3DDataSelector
+from object_pursuit.object_pursuit.data_selector import iThorDataSelector, DavisDataSelector, CO3DDataSelector, SpoolDataSelector
 
 from object_pursuit.utils.gen_bases import genBases
+from object_pursuit.utils.basis import compress_bases, BasisProjector
+from object_pursuit.utils.catalog import ObjectCatalog
+from object_pursuit.utils.events import EventWriter
+from object_pursuit.utils.profiling import PhaseProfiler, begin_capture
+from object_pursuit.dataset.fingerprint import dataset_fingerprint
 from object_pursuit.utils.util import *
 from object_pursuit.model.coeffnet.config.deeplab_param import deeplab_param, deeplab_param_decoder
 
@@ -47,16 +58,6 @@ def save_base_as_init_objects(bases, z_dir, hypernet=None):
             else:
                 torch.save({'z':z}, file_path)
                 
-def copy_zs(src_dir, target_dir):
-    create_dir(target_dir)
-    if os.path.isdir(src_dir) and os.path.isdir(target_dir):
-        files = os.listdir(src_dir)
-        for f in files:
-            if f.endswith(".json"):
-                path = os.path.join(src_dir, f)
-                z = torch.load(path, map_location=torch.device('cpu'))['z']
-                torch.save({'z':z}, os.path.join(target_dir, f))
-            
 def freeze(hypernet=None, backbone=None):
     if hypernet is not None:
         for param in hypernet.parameters():
@@ -79,18 +80,30 @@ def can_be_expressed(max_val_acc, threshold):
     else:
         return False
     
-def least_square(bases, target):
-    tar = torch.unsqueeze(target, dim=-1)
-    A = torch.stack(bases, dim=1)
-    coeff_mat = torch.mm(A.T, A)
-    proj = torch.mm(A.T, tar)
-    coeff = torch.mm(torch.inverse(coeff_mat), proj)
-    res = torch.mm(A, coeff)
-    res = torch.squeeze(res)
-    coeff = torch.squeeze(coeff)
-    # distance
-    dist = torch.norm(target-res)/torch.norm(target)
-    return res, coeff, dist
+def least_square(bases, target, projector=None):
+    """project target (z_dim, or M*z_dim for a batch of targets) onto the span of bases, returns (projection, coeff, relative distance).
+    A BasisProjector can be passed to reuse its (incrementally updated) QR factorization across calls."""
+    if projector is None:
+        projector = BasisProjector(bases)
+    else:
+        projector.sync(bases)
+    return projector.project(target)
+
+def coeff_pursuit(coarse_size, threshold, log_file, coarse_margin=0.05, **train_kwargs):
+    """coarse-to-fine coefficient pursuit: train at coarse_size first, objects whose coarse acc is clearly above or
+    below threshold (by coarse_margin) are decided there, the others are promoted to the full resolution,
+    starting from the coarse coefficients. Without coarse_size, this is train_net."""
+    if coarse_size is None:
+        return train_net(**train_kwargs)
+    coarse_dir = os.path.join(train_kwargs["save_cp_path"], "coarse")
+    create_dir(coarse_dir)
+    coarse_kwargs = dict(train_kwargs, save_cp_path=coarse_dir, input_size=coarse_size)
+    max_val_acc, coeff_net = train_net(**coarse_kwargs)
+    if max_val_acc >= threshold + coarse_margin or max_val_acc < threshold - coarse_margin:
+        write_log(log_file, f("decided at coarse resolution {coarse_size}, max validation acc: {max_val_acc}"))
+        return max_val_acc, coeff_net
+    write_log(log_file, f("borderline at coarse resolution {coarse_size} (max validation acc: {max_val_acc}), promote to full resolution"))
+    return train_net(init_coeffs=get_coeffs(coeff_net), **train_kwargs)
 
 def pursuit(z_dim, 
             data_dir, 
@@ -106,7 +119,25 @@ def pursuit(z_dim,
             express_threshold=0.7,
             log_info="default",
             use_backbone=True,
-            save_temp_interval=0):
+            save_temp_interval=0,
+            batch_transform=False,
+            resident=False,
+            dedup_threshold=None,
+            basis_energy=None,
+            starts=1,
+            val_ci_width=None,
+            coarse_size=None,
+            low_res_loss=False,
+            speculative=False,
+            lookahead=0,
+            resume=False,
+            online=False,
+            idle_timeout=None,
+            force_reeval=False,
+            step_sample=0,
+            profile=None,
+            profile_schedule=(1, 1, 3),
+            profile_captures=1):
     # prepare for new pursuit dir
     create_dir(output_dir)
     base_dir = os.path.join(output_dir, "Bases")
@@ -116,14 +147,24 @@ def pursuit(z_dim,
     create_dir(os.path.join(output_dir, "explored_objects"))
     checkpoint_dir = os.path.join(output_dir, "checkpoint")
     create_dir(checkpoint_dir)
-    log_file = open(os.path.join(output_dir, "pursuit_log.txt"), "w")
+    ckpt_store = CheckpointStore(checkpoint_dir)
+    # last committed state of an interrupted run in output_dir
+    record = PursuitSession.load_record(output_dir) if resume else None
+    # objects, bases and verdicts of the run (z_info.json and base_info.json are exported from it)
+    catalog = ObjectCatalog(os.path.join(output_dir, ObjectCatalog.file_name))
+    log_file = open(os.path.join(output_dir, "pursuit_log.txt"), "a" if record is not None else "w")
+    # structured per-phase timing and resource events (utils/event_summary.py aggregates them)
+    events = EventWriter(os.path.join(output_dir, "events.jsonl"), run=os.path.basename(os.path.normpath(output_dir)))
+    # torch.profiler captures of the chosen phases (all of them if profile is empty), in output_dir/profile
+    profiler = None
+    if profile is not None:
+        profiler = PhaseProfiler(os.path.join(output_dir, "profile"), profile or ["have_seen", "express_check", "base_update"], *profile_schedule, captures=profile_captures)
     write_log(log_file, "[Exp Info] "+log_info)
     
-    z_info = []
-    base_info = []
-    
     # prepare bases: if initial_zs is not None, use it as bases; otherwise, generate bases
-    if pretrained_bases is not None and os.path.isfile(pretrained_bases):
+    if record is not None:
+        pass # bases and initial objects are in output_dir already
+    elif pretrained_bases is not None and os.path.isfile(pretrained_bases):
         genBases(pretrained_bases, base_dir, device=device)
     elif pretrained_bases is not None and os.path.isdir(pretrained_bases):
         base_files = [os.path.join(pretrained_bases, file) for file in sorted(os.listdir(pretrained_bases)) if file.endswith(".json")]
@@ -158,31 +199,73 @@ def pursuit(z_dim,
     val_percent = 1.0 # test all data
     # data selector
     if dataset == "iThor":
-        dataSelector = iThorDataSelector(data_dir, strat=select_strat, resize=resize, shuffle_seed=1)
+        dataSelector = iThorDataSelector(data_dir, strat=select_strat, resize=resize, shuffle_seed=1, batch_transform=batch_transform, dedup_threshold=dedup_threshold)
         val_percent = 0.1
     elif dataset == "CO3D":
-        dataSelector = CO3DDataSelector(data_dir, strat=select_strat, resize=resize, shuffle_seed=1, limit_num=300)
+        dataSelector = CO3DDataSelector(data_dir, strat=select_strat, resize=resize, shuffle_seed=1, limit_num=300, batch_transform=batch_transform, dedup_threshold=dedup_threshold)
         batch_size = 8
         new_base_wait_epoch = 30
         new_base_max_epoch = 140 
     elif dataset == "DAVIS":
-        dataSelector = DavisDataSelector(data_dir, strat=select_strat, resize=resize, shuffle_seed=1)
+        dataSelector = DavisDataSelector(data_dir, strat=select_strat, resize=resize, shuffle_seed=1, batch_transform=batch_transform, dedup_threshold=dedup_threshold)
         new_base_wait_epoch = 30
         new_base_max_epoch = 140 
     else:
         raise NotImplementedError
+    # online: objects arrive in the spool dir data_dir (the dataset only selects the settings and the dir layout),
+    # the models and bases stay resident while waiting for them
+    verdict_log = None
+    if online:
+        dataSelector = SpoolDataSelector(data_dir, layout="CO3D" if dataset == "CO3D" else "iThor", resize=resize, batch_transform=batch_transform, dedup_threshold=dedup_threshold, idle_timeout=idle_timeout)
+        verdict_log = VerdictLog(os.path.join(output_dir, "verdicts.jsonl"))
     
-    # initialize bases
-    init_bases = get_z_bases(z_dim, base_dir, device)
-    init_base_num = len(init_bases)
+    # settings of the first check, shared by the main process and the lookahead workers
+    first_check_kwargs = dict(z_dim=z_dim, device=device,
+                      net_type="coeffnet",  # coeffnet uses linear combo of bases
+                      z_dir=z_dir,
+                      batch_size=batch_size,
+                      val_percent=val_percent,
+                      max_epochs=express_max_epoch,
+                      wait_epochs=express_wait_epoch,
+                      lr=1e-4,
+                      l1_loss_coeff=0.2,
+                      decision_threshold=express_threshold,
+                      resident=resident,
+                      starts=starts,
+                      val_ci_width=val_ci_width,
+                      low_res_loss=low_res_loss,
+                      step_sample=step_sample)
     
-    # initialize current object list
-    if initial_zs is None or not os.path.isdir(initial_zs):
-        initial_zs = base_dir
-    init_objects = get_z_bases(z_dim, initial_zs, device)
-    init_objects_num = len(init_objects)
-    save_base_as_init_objects(init_objects, z_dir, hypernet=hypernet)
-    obj_counter = init_objects_num
+    if record is None:
+        # initialize bases
+        init_bases = get_z_bases(z_dim, base_dir, device)
+        init_base_num = len(init_bases)
+        
+        # initialize current object list
+        if initial_zs is None or not os.path.isdir(initial_zs):
+            initial_zs = base_dir
+        init_objects = get_z_bases(z_dim, initial_zs, device)
+        init_objects_num = len(init_objects)
+        save_base_as_init_objects(init_objects, z_dir, hypernet=hypernet)
+        for i, z in enumerate(init_objects):
+            ckpt_store.append("zs", f("z_{'%04d' % i}.json"), z)
+        base_files = [file for file in sorted(os.listdir(base_dir)) if file.endswith(".json")]
+        for file, z in zip(base_files, init_bases):
+            ckpt_store.append("Bases", file, z)
+        session = PursuitSession(output_dir, hypernet, init_bases, init_base_num, init_objects_num, tensors=ckpt_store.tensors, checkpoints=ckpt_store)
+    else:
+        # the hypernet, bases, object records and selector position of the last committed object
+        session = PursuitSession.resume(output_dir, hypernet, device, record, tensors=ckpt_store.tensors, checkpoints=ckpt_store)
+        catalog.truncate(session.round, session.obj_counter)
+        init_base_num = session.init_base_num
+        init_objects_num = session.init_objects_num
+        dataSelector.counter = session.position
+        write_log(log_file, f("[resume] from object index {session.obj_counter}, round {session.round}, data selector position {session.position}"))
+    obj_counter = session.obj_counter
+    # only changed tensors are stored again: the hypernet when it's trained, the batch norm buffers of the frozen backbone
+    ckpt_store.save_module("hypernet", hypernet, os.path.join(checkpoint_dir, "hypernet.pth"))
+    if backbone is not None:
+        ckpt_store.save_module("backbone", backbone, os.path.join(checkpoint_dir, "backbone.pth"))
     
     # pursuit info
     pursuit_info = f("""Starting pursuing:
@@ -201,20 +284,79 @@ def pursuit(z_dim,
         express accuracy threshold:       {express_threshold}
         use backbone:                     {use_backbone}
         save object interval:             {save_temp_interval} (0 means don't save)
+        batched augmentation:             {batch_transform}
+        resident object data:             {resident}
+        resumed run:                      {record is not None}
+        frame dedup threshold:            {dedup_threshold}
+        basis compression energy:         {basis_energy} (None means don't compress)
+        multi-start number:               {starts} (coefficient pursuit only)
+        validation CI half width:         {val_ci_width} (None means validate on all data)
+        coarse express check size:        {coarse_size} (None means full resolution only)
+        loss at decoder resolution:       {low_res_loss}
+        speculative base update:          {speculative}
+        lookahead window:                 {lookahead} (0 means no lookahead)
+        force re-evaluation:              {force_reeval}
+        step timing sample interval:      {step_sample} (0 means no step timing)
+        profiled phases:                  {profiler.phases if profiler is not None else None} (schedule {profile_schedule}, {profile_captures} captures)
+        online (spool dir):               {online} (idle timeout {idle_timeout})
     """)
     write_log(log_file, pursuit_info)
     if backbone is None:
         write_log(log_file, "backbone is None !")
     
-    new_obj_dataset, obj_data_dir = dataSelector.next()
-    counter = 0
+    # the next objects' have_seen and first check run ahead in worker processes
+    scheduler = None
+    if lookahead > 0:
+        scheduler = LookaheadScheduler(dataSelector, lookahead, os.path.join(output_dir, "lookahead"), z_dir,
+                                       settings=dict(z_dim=z_dim, param_dict=hypernet.param_dict, device=device, threshold=express_threshold,
+                                                     start_index=init_objects_num, test_percent=val_percent,
+                                                     coarse_size=coarse_size, basis_energy=basis_energy),
+                                       check_kwargs=first_check_kwargs)
+        scheduler.publish(hypernet, backbone, session.bases)
+    
+    def next_object():
+        """next dataset, data dir, lookahead result and data selector position after the object"""
+        phase = events.begin("next_object")
+        if scheduler is None:
+            obj_dataset, obj_dir = dataSelector.next()
+            res = obj_dataset, obj_dir, None, dataSelector.counter
+        else:
+            res = scheduler.next()
+        phase.end(data_dir=res[1], samples=len(res[0]) if res[0] is not None else 0)
+        return res
+    
+    def record_object(verdict, acc, cached=False, **info):
+        """catalog record (and online verdict) of the current object, its verdict is cached for exact repeats"""
+        catalog.add_object(counter, obj_data_dir, verdict, acc=acc, hypernet_version=session.hypernet_version, timings=timings, fingerprint=fingerprint, cached=cached, **info)
+        obj_phase.update(verdict=verdict, acc=acc, cached=cached)
+        if not cached:
+            if verdict in ("seen", "unqualified"):
+                # hypernet and bases are unchanged
+                catalog.cache_verdict(fingerprint, session.hypernet_version, len(session.bases), verdict, acc, info.get("matched_z_file"), obj_data_dir)
+            else:
+                # a repeat is checked after this object is committed: it's seen, with the z of this object
+                catalog.cache_verdict(fingerprint, session.hypernet_version + (1 if hypernet_updated else 0), len(session.bases), "seen", acc, info["z_file"], obj_data_dir)
+        if verdict_log is not None:
+            arrival = dataSelector.arrival_time(obj_data_dir)
+            rec = verdict_log.emit(obj_data_dir, verdict, acc, obj_start, arrival=arrival, timings=timings, **info)
+            write_log(log_file, f("[online] verdict {verdict}, latency {rec['latency']}, processing time {rec['processing_time']}"))
+    
+    def commit_object(hypernet_updated=False):
+        with obj_events.begin("commit"):
+            catalog.commit()
+            session.obj_counter, session.round, session.position = obj_counter, counter, obj_position
+            session.commit(hypernet_updated)
+        obj_phase.end()
+    
+    new_obj_dataset, obj_data_dir, ahead, obj_position = next_object()
+    counter = session.round
 
     # # NOTE: Manually overwrite the first dataset to be bmx-bumps
     # obj_data_dir = "bmx-bumps"
     # new_obj_dataset = dataSelector._get_dataset(obj_data_dir)
     
     while new_obj_dataset is not None:
-        bases = get_z_bases(z_dim, base_dir, device)
+        bases = list(session.bases)
         base_num = len(bases)
         
         # record checkpoints per 8 round
@@ -222,12 +364,11 @@ def pursuit(z_dim,
         
         if save_temp_interval > 0:
             if counter % save_temp_interval == 0:
-                temp_checkpoint_dir = os.path.join(checkpoint_dir, f("checkpoint_round_{counter}"))
-                create_dir(temp_checkpoint_dir)
-                torch.save(hypernet.state_dict(), os.path.join(temp_checkpoint_dir, f("hypernet.pth")))
-                copy_zs(z_dir, os.path.join(temp_checkpoint_dir, "zs"))
-                copy_zs(base_dir, os.path.join(temp_checkpoint_dir, "Bases"))
-                write_log(log_file, f("[checkpoint] pursuit round {counter} has been saved to {temp_checkpoint_dir}"))
+                # only references to the stored hypernet and z deltas, export_round writes the full checkpoint dir
+                with events.begin("round_checkpoint", round=counter):
+                    ckpt_store.save_round(counter)
+                    catalog.export_json(output_dir)
+                write_log(log_file, f("[checkpoint] pursuit round {counter} has been saved to {os.path.join(checkpoint_dir, 'rounds')}"))
         
         # for each new object, create a new dir
         obj_dir = os.path.join(output_dir, "explored_objects", f("obj_{obj_counter}"))
@@ -241,15 +382,58 @@ def pursuit(z_dim,
             output obj dir:      {obj_dir}
         """)
         max_val_acc = 0.0
+        hypernet_updated = False
+        # phase timings (seconds), recorded in the catalog
+        timings = {}
+        obj_start = time.time()
+        obj_events = events.bind(obj_index=obj_counter, round=counter)
+        obj_phase = obj_events.begin("object", data_dir=obj_data_dir, samples=len(new_obj_dataset))
         write_log(log_file, "\n=============================start new object==============================")
         write_log(log_file, new_obj_info)
+        if new_obj_dataset.dedup_record is not None:
+            write_log(log_file, f("frame dedup: kept {len(new_obj_dataset.dedup_record['kept'])} of {new_obj_dataset.dedup_record['total']} frames"))
+            with open(os.path.join(obj_dir, "dedup.json"), "w") as dedup_file:
+                json.dump(new_obj_dataset.dedup_record, dedup_file)
+        
+        # ========================================================================================================
+        # an exact repeat of an object checked with the same hypernet and bases gets the cached verdict
+        phase = obj_events.begin("fingerprint")
+        fingerprint = dataset_fingerprint(new_obj_dataset)
+        timings["fingerprint"] = phase.end()["wall_time"]
+        cache_hit = catalog.cached_verdict(fingerprint, session.hypernet_version, len(session.bases)) if not force_reeval else None
+        if cache_hit is not None:
+            write_log(log_file, f("Current object is an exact repeat of {cache_hit['data_dir']} (fingerprint {fingerprint}), cached verdict: {cache_hit['verdict']}, acc: {cache_hit['acc']}"))
+            if scheduler is not None:
+                scheduler.discard(ahead)
+            record_object(cache_hit["verdict"], cache_hit["acc"], cached=True, matched_z_file=cache_hit["matched_z_file"])
+            commit_object()
+            new_obj_dataset, obj_data_dir, ahead, obj_position = next_object()
+            shutil.rmtree(obj_dir)
+            write_log(log_file, "\n===============================end object==================================")
+            continue
         
         # ========================================================================================================
         # check if current object has been seen
-        seen, acc, z_file, z_acc_pairs = have_seen(new_obj_dataset, device, z_dir, z_dim, hypernet, backbone, express_threshold, start_index=init_objects_num, test_percent=val_percent)
+        phase = obj_events.begin("have_seen")
+        with begin_capture(profiler, "have_seen", tag=obj_counter):
+            if scheduler is not None and scheduler.is_current(ahead):
+                # only the zs added since the lookahead are left to check
+                seen, acc, z_file, z_acc_pairs = scheduler.complete_have_seen(ahead, lambda z_files: have_seen(new_obj_dataset, device, z_dir, z_dim, hypernet, backbone, express_threshold, test_percent=val_percent, resident=resident, z_files=z_files, events=obj_events))
+                write_log(log_file, f("have_seen result from the lookahead window (hypernet version {ahead['version']})"))
+            else:
+                if scheduler is not None:
+                    write_log(log_file, "lookahead result is outdated or missing, check the object now")
+                    scheduler.discard(ahead)
+                    ahead = None
+                seen, acc, z_file, z_acc_pairs = have_seen(new_obj_dataset, device, z_dir, z_dim, hypernet, backbone, express_threshold, start_index=init_objects_num, test_percent=val_percent, resident=resident, events=obj_events)
+        timings["have_seen"] = phase.end(seen=seen, acc=acc)["wall_time"]
         if seen:
             write_log(log_file, f("Current object has been seen! corresponding z file: {z_file}, express accuracy: {acc}"))
-            new_obj_dataset, obj_data_dir = dataSelector.next()
+            if scheduler is not None:
+                scheduler.discard(ahead)
+            record_object("seen", acc, matched_z_file=os.path.basename(z_file))
+            commit_object()
+            new_obj_dataset, obj_data_dir, ahead, obj_position = next_object()
             shutil.rmtree(obj_dir)
             write_log(log_file, "\n===============================end object==================================")
             continue
@@ -257,68 +441,115 @@ def pursuit(z_dim,
             write_log(log_file, f("Current object is novel, max acc: {acc}, most similiar object: {z_file}, start object pursuit"))
         write_log(log_file, f("Z-acc pairs: {z_acc_pairs}"))
         
+        # ========================================================================================================
+        # coefficient pursuit runs against the compressed (rank r) bases if a budget is given
+        coeff_bases = bases
+        if basis_energy is not None and base_num > 1:
+            coeff_bases, factorization, rank = compress_bases(bases, energy=basis_energy)
+            factorization.save(os.path.join(obj_dir, "basis.json"), rank)
+            write_log(log_file, f("compressed bases: rank {rank} of {base_num}, explained variance {factorization.explained[rank-1]}, reconstruction error {factorization.error(rank)}"))
+        
+        # base update settings, shared by the sequential and the speculative base update
+        base_update_dir = os.path.join(obj_dir, "base_update")
+        base_update_kwargs = dict(z_dim=z_dim, base_num=base_num, dataset=new_obj_dataset, device=device,
+                      net_type="singlenet",
+                      save_cp_path=base_update_dir,
+                      z_dir=z_dir,
+                      batch_size=batch_size,
+                      val_percent=val_percent,
+                      max_epochs=new_base_max_epoch,
+                      wait_epochs=new_base_wait_epoch,
+                      lr=1e-4,
+                      l1_loss_coeff=0.1,
+                      mem_loss_coeff=0.04,
+                      resident=resident,
+                      val_ci_width=val_ci_width,
+                      low_res_loss=low_res_loss,
+                      step_sample=step_sample)
+        speculative_update = None
+        # the base update starts from the generators and the batch norm buffers as they are before the first check,
+        # whether it runs speculatively or after the check
+        base_update_rng = get_rng_state()
+        base_update_buffers = get_buffers(backbone) if backbone is not None else None
+        
         # ========================================================================================================
         # (first check) test if a new object can be expressed by other objects
         if base_num > 0:
+            phase = obj_events.begin("first_check")
             write_log(log_file, "start coefficient pursuit (first check):")
             # freeze the hypernet and backbone
             freeze(hypernet=hypernet, backbone=backbone)
+            precomputed = ahead is not None and ahead["check_acc"] is not None
+            if speculative and not precomputed:
+                # the base update starts now on a copy of the hypernet, it's cancelled if the check succeeds
+                create_dir(base_update_dir)
+                speculative_update = SpeculativeBaseUpdate(hypernet, backbone, base_update_kwargs, base_update_dir, base_update_rng)
+                write_log(log_file, f("speculative base update started, result dir: {base_update_dir}"))
             coeff_pursuit_dir = os.path.join(obj_dir, "coeff_pursuit")
-            create_dir(coeff_pursuit_dir)
-            write_log(log_file, f("coeff pursuit result dir: {coeff_pursuit_dir}"))
-            max_val_acc, coeff_net = train_net(z_dim=z_dim, base_num=base_num, dataset=new_obj_dataset, device=device,
-                      zs=bases, 
-                      net_type="coeffnet",  # coeffnet uses linear combo of bases
-                      hypernet=hypernet, 
-                      backbone=backbone,
-                      save_cp_path=coeff_pursuit_dir,
-                      z_dir=z_dir,
-                      batch_size=batch_size,
-                      val_percent=val_percent,
-                      max_epochs=express_max_epoch,
-                      wait_epochs=express_wait_epoch,
-                      lr=1e-4,
-                      l1_loss_coeff=0.2)
+            if precomputed:
+                max_val_acc, coeff_net = scheduler.take_check(ahead, coeff_pursuit_dir, device)
+                write_log(log_file, f("first check result from the lookahead window, result dir: {coeff_pursuit_dir}"))
+            else:
+                create_dir(coeff_pursuit_dir)
+                write_log(log_file, f("coeff pursuit result dir: {coeff_pursuit_dir}"))
+                with begin_capture(profiler, "express_check", tag=f("{obj_counter}_first")):
+                    max_val_acc, coeff_net = coeff_pursuit(coarse_size, express_threshold, log_file,
+                              base_num=len(coeff_bases), dataset=new_obj_dataset,
+                              zs=coeff_bases, 
+                              hypernet=hypernet, 
+                              backbone=backbone,
+                              save_cp_path=coeff_pursuit_dir,
+                              events=obj_events,
+                              **first_check_kwargs)
             write_log(log_file, f("training stop, max validation acc: {max_val_acc}"))
+            if speculative_update is not None and can_be_expressed(max_val_acc, express_threshold):
+                speculative_update.cancel()
+                shutil.rmtree(base_update_dir)
+                write_log(log_file, "speculative base update cancelled")
+            timings["first_check"] = phase.end(precomputed=precomputed, acc=max_val_acc)["wall_time"]
         # ==========================================================================================================
         # (train as a new base) if not, train this object as a new base
         if not can_be_expressed(max_val_acc, express_threshold): # the condition to retrain a new base
             write_log(log_file, "can't be expressed by bases, start to train as new base:")
             # unfreeze the backbone
             unfreeze(hypernet=hypernet)
-            base_update_dir = os.path.join(obj_dir, "base_update")
             create_dir(base_update_dir)
             write_log(log_file, f("base update result dir: {base_update_dir}"))
-            max_val_acc, z_net = train_net(z_dim=z_dim, base_num=base_num, dataset=new_obj_dataset, device=device,
-                      net_type="singlenet",
-                      hypernet=hypernet,
-                      backbone=backbone,
-                      save_cp_path=base_update_dir,
-                      z_dir=z_dir,
-                      batch_size=batch_size,
-                      val_percent=val_percent,
-                      max_epochs=new_base_max_epoch,
-                      wait_epochs=new_base_wait_epoch,
-                      lr=1e-4,
-                      l1_loss_coeff=0.1,
-                      mem_loss_coeff=0.04)
+            phase = obj_events.begin("base_update")
+            if speculative_update is not None:
+                write_log(log_file, "waiting for the speculative base update")
+                max_val_acc, z_net = speculative_update.result(hypernet, backbone)
+            else:
+                # the main process continues with the generators as they are after the check, on both paths
+                check_rng = get_rng_state()
+                set_rng_state(base_update_rng)
+                if backbone is not None:
+                    set_buffers(backbone, base_update_buffers)
+                with begin_capture(profiler, "base_update", tag=obj_counter):
+                    max_val_acc, z_net = train_net(hypernet=hypernet, backbone=backbone, events=obj_events, **base_update_kwargs)
+                set_rng_state(check_rng)
             write_log(log_file, f("training stop, max validation acc: {max_val_acc}"))
+            timings["base_update"] = phase.end(speculative=speculative_update is not None, acc=max_val_acc)["wall_time"]
+            base_acc = max_val_acc
+            hypernet_updated = True
             
             # if the object is invalid
             # NOTE: this seems unreasonable, for what objects does this happen? Why? Would this happen if this object was the first to be trained on?
             if max_val_acc < express_threshold:
                 write_log(log_file, f("[Warning] current object (data path: {obj_data_dir}) is unqualified! The validation acc should be at least {express_threshold}, current acc {max_val_acc}; All records will be removed !"))
-                # reset backbone and hypernet
-                if backbone is not None:
-                    init_backbone(os.path.join(checkpoint_dir, f("backbone.pth")), backbone, device, freeze=True)
-                init_hypernet(os.path.join(checkpoint_dir, f("hypernet.pth")), hypernet, device, freeze=True)
-                new_obj_dataset, obj_data_dir = dataSelector.next()
+                # reset the hypernet (the backbone is frozen)
+                session.rollback()
+                freeze(hypernet=hypernet)
+                record_object("unqualified", max_val_acc)
+                commit_object()
+                new_obj_dataset, obj_data_dir, ahead, obj_position = next_object()
                 shutil.rmtree(obj_dir)
                 write_log(log_file, "\n===============================end object=================================")
                 continue
             
             # ======================================================================================================
             # (second check) check new z can now be approximated (expressed by coeffs) by current bases
+            phase = obj_events.begin("second_check")
             if base_num > 0:
                 write_log(log_file, f("start to examine whether the object {obj_counter} can be expressed by bases now (second check):"))
                 # freeze the hypernet and backbone
@@ -326,40 +557,51 @@ def pursuit(z_dim,
                 check_express_dir = os.path.join(obj_dir, "check_express")
                 create_dir(check_express_dir)
                 write_log(log_file, f("check express result dir: {check_express_dir}"))
-                max_val_acc, examine_coeff_net = train_net(z_dim=z_dim, base_num=base_num, dataset=new_obj_dataset, device=device,
-                        zs=bases, 
-                        net_type="coeffnet", 
-                        hypernet=hypernet, 
-                        backbone=backbone,
-                        save_cp_path=check_express_dir,
-                        z_dir=z_dir,
-                        max_epochs=express_max_epoch,
-                        batch_size=batch_size,
-                        val_percent=val_percent,
-                        wait_epochs=new_base_wait_epoch,
-                        lr=1e-4,
-                        acc_threshold=1.0,
-                        l1_loss_coeff=0.2)
+                with begin_capture(profiler, "express_check", tag=f("{obj_counter}_second")):
+                    max_val_acc, examine_coeff_net = coeff_pursuit(coarse_size, express_threshold, log_file,
+                            z_dim=z_dim, base_num=len(coeff_bases), dataset=new_obj_dataset, device=device,
+                            zs=coeff_bases, 
+                            net_type="coeffnet", 
+                            hypernet=hypernet, 
+                            backbone=backbone,
+                            save_cp_path=check_express_dir,
+                            events=obj_events,
+                            z_dir=z_dir,
+                            max_epochs=express_max_epoch,
+                            batch_size=batch_size,
+                            val_percent=val_percent,
+                            wait_epochs=new_base_wait_epoch,
+                            lr=1e-4,
+                            acc_threshold=1.0,
+                            l1_loss_coeff=0.2,
+                            decision_threshold=express_threshold,
+                            resident=resident,
+                            starts=starts,
+                            val_ci_width=val_ci_width,
+                            low_res_loss=low_res_loss,
+                            step_sample=step_sample)
             else:
                 max_val_acc = 0.0
+            timings["second_check"] = phase.end(acc=max_val_acc)["wall_time"]
             
             if can_be_expressed(max_val_acc, express_threshold):
                 write_log(log_file, f("new z can be expressed by current bases, redundant! max val acc: {max_val_acc}, don't add it to bases"))
                 # save object's z
                 write_log(log_file, f("object {obj_counter} pursuit complete, save object z 'z_{'%04d' % obj_counter}.json' to {z_dir}"))
-                examine_coeff_net.save_z(os.path.join(z_dir, f("z_{'%04d' % obj_counter}.json")), bases, hypernet)
+                examine_coeff_net.save_z(os.path.join(z_dir, f("z_{'%04d' % obj_counter}.json")), coeff_bases, hypernet)
+                obj_z = examine_coeff_net.get_z(coeff_bases)
+                verdict, obj_acc = "redundant", max_val_acc
             else:
                 # save z as a new base
                 # NOTE: Since hypernetwork has been updated, shouldn't z_net also be updated again? 
                 write_log(log_file, f("new z can't be expressed by current bases, not redundant! express max val acc: {max_val_acc}, add 'base_{'%04d' % base_num}.json' to bases"))
                 z_net.save_z(os.path.join(base_dir, f("base_{'%04d' % base_num}.json")), hypernet)
+                obj_z = z_net.get_z()
+                ckpt_store.append("Bases", f("base_{'%04d' % base_num}.json"), obj_z)
                 # record base info
-                base_info.append({
-                    "index": obj_counter,
-                    "data_dir": obj_data_dir,
-                    "base_file": f("base_{'%04d' % base_num}.json"),
-                    "z_file": f("z_{'%04d' % obj_counter}.json")
-                })
+                session.add_base(obj_z)
+                catalog.add_base(base_num, obj_counter, obj_data_dir, f("base_{'%04d' % base_num}.json"), f("z_{'%04d' % obj_counter}.json"), acc=base_acc)
+                verdict, obj_acc = "new_base", base_acc
                 # save object's z
                 write_log(log_file, f("object {obj_counter} pursuit complete, save object z 'z_{'%04d' % obj_counter}.json' to {z_dir}"))   
                 z_net.save_z(os.path.join(z_dir, f("z_{'%04d' % obj_counter}.json")), hypernet)
@@ -368,30 +610,39 @@ def pursuit(z_dim,
         else:
             # save object's z
             write_log(log_file, f("object {obj_counter} pursuit complete, save object z 'z_{'%04d' % obj_counter}.json' to {z_dir}"))    
-            coeff_net.save_z(os.path.join(z_dir, f("z_{'%04d' % obj_counter}.json")), bases, hypernet)
-        
-        # record object (z) info   
-        z_info.append({
-            "index": obj_counter,
-            "data_dir": obj_data_dir,
-            "z_file": f("z_{'%04d' % obj_counter}.json")
-        })
+            coeff_net.save_z(os.path.join(z_dir, f("z_{'%04d' % obj_counter}.json")), coeff_bases, hypernet)
+            obj_z = coeff_net.get_z(coeff_bases)
+            verdict, obj_acc = "expressed", max_val_acc
+        ckpt_store.append("zs", f("z_{'%04d' % obj_counter}.json"), obj_z)
         
-        # update (save) info files
-        with open(os.path.join(output_dir, "z_info.json"), "w") as f:
-            json.dump(z_info, f)
-        with open(os.path.join(output_dir, "base_info.json"), "w") as f:
-            json.dump(base_info, f)
+        # record object (z) info
+        record_object(verdict, obj_acc, obj_index=obj_counter, z_file=f("z_{'%04d' % obj_counter}.json"))
         
         write_log(log_file, f("save hypernet and backbone to {checkpoint_dir}, move to next object"))     
-        new_obj_dataset, obj_data_dir = dataSelector.next()
         obj_counter += 1
-        # save checkpoint
-        torch.save(hypernet.state_dict(), os.path.join(checkpoint_dir, f("hypernet.pth")))
+        # save checkpoint (in the background, unchanged tensors are skipped)
+        phase = obj_events.begin("checkpoint")
+        ckpt_store.save_module("hypernet", hypernet, os.path.join(checkpoint_dir, "hypernet.pth"))
         if backbone is not None:
-            torch.save(backbone.state_dict(), os.path.join(checkpoint_dir, f("backbone.pth")))
+            ckpt_store.save_module("backbone", backbone, os.path.join(checkpoint_dir, "backbone.pth"))
+        phase.end()
+        commit_object(hypernet_updated)
+        # the lookahead of the next objects restarts from the updated hypernet and bases
+        if scheduler is not None and hypernet_updated:
+            scheduler.publish(hypernet, backbone, session.bases)
+        new_obj_dataset, obj_data_dir, ahead, obj_position = next_object()
         write_log(log_file, "\n===============================end object=================================")
         
+    if scheduler is not None:
+        scheduler.close()
+    session.close()
+    ckpt_store.close()
+    catalog.export_json(output_dir)
+    catalog.close()
+    events.close()
+    if verdict_log is not None:
+        write_log(log_file, f("[online] {verdict_log.summary()}"))
+        verdict_log.close()
     log_file.close()
     
     
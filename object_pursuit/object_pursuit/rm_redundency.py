@@ -1,20 +1,22 @@
 import os
+import copy
 import torch
 import json
+import torch.multiprocessing as mp
 from tqdm import tqdm
 from object_pursuit.model.coeffnet.hypernet import Hypernet
-from object_pursuit.model.coeffnet.coeffnet_simple import Backbone
+from object_pursuit.model.coeffnet.coeffnet_simple import Backbone, Singlenet
 from object_pursuit.model.coeffnet.coeffnet_simple import init_backbone, init_hypernet
 from object_pursuit.pursuit import get_z_bases, freeze
-from object_pursuit.train import train_net
+from object_pursuit.train import train_net, eval_net
 from dataset.basic_dataset import BasicDataset
+from dataset.resident_dataset import get_resident, ResidentLoader
+from utils.basis import BasisProjector
+from utils.catalog import ObjectCatalog
 from utils.util import *
 from object_pursuit.model.coeffnet.config.deeplab_param import deeplab_param, deeplab_param_decoder
 
-def simplify_bases(log_dir, output_dir, base_path, record_path, hypernet_path, backbone_path, use_backbone=True, device=torch.device('cuda' if torch.cuda.is_available() else 'cpu'), z_dim=100, resize=(256, 256), threshold=0.7):
-    create_dir(log_dir)
-    create_dir(output_dir)
-    # init hypernet and backbone
+def build_models(z_dim, hypernet_path, backbone_path, use_backbone, device):
     if use_backbone:
         hypernet = Hypernet(z_dim, param_dict=deeplab_param_decoder)
     else:
@@ -27,44 +29,174 @@ def simplify_bases(log_dir, output_dir, base_path, record_path, hypernet_path, b
         backbone.to(device)
     else:
         backbone = None
+    return hypernet, backbone
+
+def get_obj_dataset(obj, resize):
+    img_dir = os.path.join(obj['data_dir'], "imgs")
+    mask_dir = os.path.join(obj['data_dir'], "masks")
+    return BasicDataset(img_dir, mask_dir, resize)
+
+def retrain_check(obj, zs, cp_dir, hypernet, backbone, device, z_dim, resize, threshold):
+    """full coefficient pursuit of obj against zs, returns the max validation acc"""
+    dataset = get_obj_dataset(obj, resize)
+    freeze(hypernet=hypernet, backbone=backbone)
+    create_dir(cp_dir)
+    max_val_acc, _ = train_net(z_dim=z_dim, base_num=len(zs), dataset=dataset, device=device,
+              zs=zs, 
+              net_type="coeffnet", 
+              hypernet=hypernet, 
+              backbone=backbone,
+              save_cp_path=cp_dir,
+              batch_size=64,
+              max_epochs=200,
+              lr=4e-4,
+              acc_threshold=threshold,
+              resident=True)
+    return max_val_acc
+
+def screen_check(obj, projector, hypernet, backbone, device, z_dim, resize, screen_size=400):
+    """cheap check: least square projection of the base onto the span of the others, and one evaluation of the projected z
+
+    Returns:
+        tuple: relative distance of the projection (z space), dice of the projected z
+    """
+    z = obj['z']
+    proj, _, dist = projector.project(z)
+    dataset = get_obj_dataset(obj, resize)
+    resident = get_resident(dataset, max_len=screen_size)
+    loader = ResidentLoader(resident, 64, shuffle=False, drop_last=False)
+    net = Singlenet(z_dim)
+    net.to(device)
+    with torch.no_grad():
+        net.z.data = proj.to(device=device, dtype=net.z.dtype)
+    acc = eval_net("singlenet", net, loader, device, hypernet, backbone, batch_transform=resident.batch_transform)
+    return dist.item(), acc
+
+
+# models of a pool worker, built by the pool initializer
+_worker_models = None
+
+def _init_worker(model_kwargs):
+    global _worker_models
+    _worker_models = build_models(**model_kwargs)
+
+def _retrain_worker(task):
+    obj, zs, cp_dir, device, z_dim, resize, threshold = task
+    hypernet, backbone = _worker_models
+    zs = [z.to(device) for z in zs]
+    return retrain_check(obj, zs, cp_dir, hypernet, backbone, device, z_dim, resize, threshold)
+
+
+def simplify_bases(log_dir, output_dir, base_path, record_path, hypernet_path, backbone_path, use_backbone=True, device=torch.device('cuda' if torch.cuda.is_available() else 'cpu'), z_dim=100, resize=(256, 256), threshold=0.7,
+                   screen_margin=0.2, screen_dist=0.5, screen_size=400, num_workers=0):
+    """Remove redundant bases (bases that can be expressed by the other valid bases), from low acc to high.
+
+    With a pursuit catalog (.db), the initial bases (not recorded in it) are kept and are not candidates.
+
+    Every candidate is first screened: its z is projected onto the span of the other valid bases (least squares),
+    and the projected z is evaluated once. It is redundant if the projected acc is already above threshold (as for a retrained base), kept if the
+    projected acc is below threshold - screen_margin and the z-space distance is above screen_dist, otherwise
+    (ambiguous) a full coefficient pursuit decides.
+
+    Candidates are processed in waves of max(num_workers, 1), the retrainings of a wave run in a process pool
+    (num_workers > 0). All checks of a wave use the valid bases at the start of the wave, verdicts are applied in
+    order; a 'redundant' verdict is stale (re-queued) if an earlier candidate of the same wave has been removed,
+    since one of the bases it was expressed with is gone. 'keep' verdicts stay valid with fewer bases.
+    """
+    create_dir(log_dir)
+    create_dir(output_dir)
+    # init hypernet and backbone
+    model_kwargs = {"z_dim": z_dim, "hypernet_path": hypernet_path, "backbone_path": backbone_path, "use_backbone": use_backbone, "device": device}
+    hypernet, backbone = build_models(**model_kwargs)
     # load initial bases
     init_bases = get_z_bases(z_dim, base_path, device)
-    # load base info
-    with open(record_path, 'r') as f:
-        base_info = json.load(f)
+    # load base info, from a pursuit catalog (.db) or a base record json
+    catalog = None
+    if record_path.endswith(".db"):
+        catalog = ObjectCatalog(record_path)
+        base_info = catalog.base_info(full=True)
+    else:
+        with open(record_path, 'r') as f_record:
+            base_info = json.load(f_record)
     base_info = sorted(base_info, key=lambda e:e['acc'])
     for inf in base_info:
         inf["valid"] = True
-    # start remove redundancy from low acc to high
+    if catalog is not None:
+        # the initial bases (loaded before the pursuit) are not in the catalog: they stay, and span the other bases
+        recorded = catalog.base_indices()
+        initial = [{"index": i, "base_index": i, "obj_name": f("base_{'%04d' % i}"), "base_file": f("base_{'%04d' % i}.json"), "acc": None, "valid": True, "initial": True, "verdict": "initial"}
+                   for i in range(len(init_bases)) if i not in recorded]
+        base_info = initial + base_info
+    
+    # bases under the threshold are removed directly
+    queue = []
     for obj in base_info:
-        print(f("=============================start to run {obj['obj_name']}======================================="))
+        if obj.get('initial', False):
+            continue
         if obj['acc'] <= threshold:
             obj['valid'] = False
+            obj['verdict'] = "low acc"
             print(f("for obj {obj['obj_name']}, valid: {obj['valid']}"))
         else:
-            img_dir = os.path.join(obj['data_dir'], "imgs")
-            mask_dir = os.path.join(obj['data_dir'], "masks")
-            dataset = BasicDataset(img_dir, mask_dir, resize)
-            freeze(hypernet=hypernet, backbone=backbone)
-            cp_dir = os.path.join(log_dir, str(obj["index"])+"_"+obj["obj_name"])
-            create_dir(cp_dir)
-            zs = []
-            for inf in base_info:
-                if inf['valid'] and inf['index'] != obj['index']:
-                    zs.append(init_bases[inf['index']])
-            max_val_acc, _ = train_net(z_dim=z_dim, base_num=len(zs), dataset=dataset, device=device,
-                      zs=zs, 
-                      net_type="coeffnet", 
-                      hypernet=hypernet, 
-                      backbone=backbone,
-                      save_cp_path=cp_dir,
-                      batch_size=64,
-                      max_epochs=200,
-                      lr=4e-4,
-                      acc_threshold=threshold)
-            if max_val_acc > threshold:
-                obj['valid'] = False
-            print(f("for obj {obj['obj_name']}, current base num {len(zs)}, max acc {max_val_acc}, valid: {obj['valid']}"))
+            queue.append(obj)
+    
+    wave_size = max(num_workers, 1)
+    pool = None
+    if num_workers > 0:
+        pool = mp.get_context('spawn').Pool(num_workers, initializer=_init_worker, initargs=(model_kwargs,))
+    try:
+        while len(queue) > 0:
+            wave, queue = queue[:wave_size], queue[wave_size:]
+            valid = [inf for inf in base_info if inf['valid']]
+            projector = BasisProjector([init_bases[inf['index']] for inf in valid])
+            # screen
+            ambiguous = []
+            for obj in wave:
+                print(f("=============================start to run {obj['obj_name']}======================================="))
+                pos = valid.index(obj)
+                others = copy.deepcopy(projector)
+                others.remove(pos)
+                dist, proj_acc = screen_check(dict(obj, z=init_bases[obj['index']]), others, hypernet, backbone, device, z_dim, resize, screen_size)
+                obj['ls_dist'] = dist
+                obj['proj_acc'] = proj_acc
+                if proj_acc > threshold:
+                    obj['verdict'] = "redundant (screen)"
+                elif proj_acc < threshold - screen_margin and dist > screen_dist:
+                    obj['verdict'] = "keep (screen)"
+                else:
+                    ambiguous.append(obj)
+                print(f("for obj {obj['obj_name']}, least square distance {dist}, projected z acc {proj_acc}"))
+            # retrain ambiguous candidates
+            tasks = []
+            for obj in ambiguous:
+                cp_dir = os.path.join(log_dir, str(obj["index"])+"_"+obj["obj_name"])
+                zs = [init_bases[inf['index']] for inf in valid if inf['index'] != obj['index']]
+                tasks.append((obj, zs, cp_dir))
+            if pool is not None and len(tasks) > 0:
+                accs = pool.map(_retrain_worker, [(obj, [z.cpu() for z in zs], cp_dir, device, z_dim, resize, threshold) for obj, zs, cp_dir in tasks])
+            else:
+                accs = [retrain_check(obj, zs, cp_dir, hypernet, backbone, device, z_dim, resize, threshold) for obj, zs, cp_dir in tasks]
+            for (obj, zs, _), max_val_acc in zip(tasks, accs):
+                obj['retrain_acc'] = max_val_acc
+                obj['verdict'] = "redundant (retrain)" if max_val_acc > threshold else "keep (retrain)"
+                print(f("for obj {obj['obj_name']}, current base num {len(zs)}, max acc {max_val_acc}"))
+            # resolve the verdicts in order
+            requeue = []
+            removed = False
+            for obj in wave:
+                if obj['verdict'].startswith("redundant"):
+                    if removed:
+                        requeue.append(obj)
+                        print(f("for obj {obj['obj_name']}, verdict is stale (an earlier base of the wave was removed), re-queued"))
+                        continue
+                    obj['valid'] = False
+                    removed = True
+                print(f("for obj {obj['obj_name']}, verdict: {obj['verdict']}, valid: {obj['valid']}"))
+            queue = requeue + queue
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
     # save
     new_bases = []
     new_base_info = []
@@ -79,7 +211,15 @@ def simplify_bases(log_dir, output_dir, base_path, record_path, hypernet_path, b
     for i in range(len(new_bases)):
         saved_file_path = os.path.join(output_dir, f("base_{'%04d' % i}.json"))
         torch.save({'z':new_bases[i]}, saved_file_path)
-    with open(os.path.join(log_dir, "base_info.json"), 'w') as f:
-        json.dump(new_base_info, f)
+    with open(os.path.join(log_dir, "base_info.json"), 'w') as f_info:
+        json.dump(new_base_info, f_info)
+    with open(os.path.join(log_dir, "simplify_record.json"), 'w') as f_info:
+        json.dump(base_info, f_info)
+    if catalog is not None:
+        # verdicts of the pursued bases (by their original index)
+        for obj in base_info:
+            if not obj.get('initial', False):
+                catalog.set_base_verdict(obj['base_index'], obj['valid'], obj.get('verdict', "kept"))
+        catalog.close()
     
     
\ No newline at end of file
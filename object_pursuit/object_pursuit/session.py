@@ -0,0 +1,199 @@
+import os
+import threading
+import torch
+
+from object_pursuit.utils.util import *
+
+
+def _cpu_state(module):
+    return {k: v.detach().cpu().clone() for k, v in module.state_dict().items()}
+
+def _fsync_replace(tmp_file, file_path):
+    with open(tmp_file, "rb+") as tmp:
+        os.fsync(tmp.fileno())
+    os.rename(tmp_file, file_path)
+
+def atomic_torch_save(obj, file_path):
+    tmp_file = file_path + ".tmp"
+    torch.save(obj, tmp_file)
+    _fsync_replace(tmp_file, file_path)
+
+
+class JournalWriter(object):
+    """Background thread persisting the latest committed session record: records committed while one is being
+    written replace each other, only the newest one is written (each write is atomic: tmp file, fsync, rename).
+    With a TensorStore, the hypernet snapshot is saved in the store and the record only holds its manifest.
+    barrier (if given) is called before each write, e.g. to wait for the delta log appends the record counts."""
+    def __init__(self, journal_file, tensors=None, barrier=None):
+        self.journal_file = journal_file
+        self.tensors = tensors
+        self.barrier = barrier
+        self._snapshot = None
+        self._manifest = None
+        self._record = None
+        self._busy = False
+        self._closed = False
+        self._error = None
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="pursuit-journal")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, record):
+        with self._cond:
+            if self._error is not None:
+                raise self._error
+            self._record = record
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._record is None and not self._closed:
+                    self._cond.wait()
+                if self._record is None:
+                    return
+                record, self._record = self._record, None
+                self._busy = True
+            try:
+                self._write(record)
+            except Exception as e:
+                with self._cond:
+                    self._error = e
+            with self._cond:
+                self._busy = False
+                self._cond.notify_all()
+
+    def _write(self, record):
+        if self.barrier is not None:
+            self.barrier()
+        if self.tensors is not None:
+            # the snapshot only changes with the hypernet
+            if record["hypernet"] is not self._snapshot:
+                self._snapshot, self._manifest = record["hypernet"], self.tensors.put_state(record["hypernet"])
+            record = dict(record, hypernet=self._manifest)
+        atomic_torch_save(record, self.journal_file)
+
+    def flush(self):
+        """wait until the latest record is on disk"""
+        with self._cond:
+            while self._record is not None or self._busy:
+                self._cond.wait()
+            if self._error is not None:
+                raise self._error
+
+    def close(self):
+        self.flush()
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+
+class PursuitSession(object):
+    """In-memory state of a pursuit run: bases, counters, the position of the data selector, the hypernet version
+    (number of hypernet updates) and a snapshot of the hypernet at the last committed object.
+    The object and base records are kept in the ObjectCatalog of the run.
+
+    The snapshot is the rollback target for unqualified objects (no reload from disk). Every commit is persisted
+    by a background JournalWriter into checkpoint/session_journal.pth, a run is resumed from the last record
+    on disk with PursuitSession.resume (the catalog is truncated to the record).
+    With a TensorStore, the journal references the hypernet tensors in the store. With a CheckpointStore, the record
+    holds the lengths of its delta logs (written before the record), resume cuts the logs back to them.
+
+    Args:
+        output_dir (str): pursuit output dir
+        hypernet (Hypernet): the pursued hypernet
+        bases (list): current bases (z tensors)
+        init_base_num (int): number of pretrained bases
+        init_objects_num (int): number of initial objects (saved zs)
+        record (dict, optional): journal record to resume from. Defaults to None.
+        tensors (TensorStore, optional): store of the hypernet snapshots. Defaults to None.
+        checkpoints (CheckpointStore, optional): incremental checkpoints of the run. Defaults to None.
+    """
+    journal_name = "session_journal.pth"
+
+    def __init__(self, output_dir, hypernet, bases, init_base_num, init_objects_num, record=None, tensors=None, checkpoints=None):
+        self.output_dir = output_dir
+        self.z_dir = os.path.join(output_dir, "zs")
+        self.base_dir = os.path.join(output_dir, "Bases")
+        self.hypernet = hypernet
+        self.bases = list(bases)
+        self.init_base_num = init_base_num
+        self.init_objects_num = init_objects_num
+        self.obj_counter = init_objects_num
+        self.round = 0
+        self.position = 0
+        self.hypernet_version = 0
+        if record is not None:
+            self.hypernet_version = record["hypernet_version"]
+            self.obj_counter = record["obj_counter"]
+            self.round = record["round"]
+            self.position = record["position"]
+        self.snapshot = _cpu_state(hypernet)
+        self.checkpoints = checkpoints
+        self.writer = JournalWriter(os.path.join(output_dir, "checkpoint", self.journal_name), tensors,
+                                    barrier=checkpoints.flush if checkpoints is not None else None)
+
+    @classmethod
+    def load_record(cls, output_dir):
+        """the last committed record of a run, None if there isn't any"""
+        journal_file = os.path.join(output_dir, "checkpoint", cls.journal_name)
+        if not os.path.isfile(journal_file):
+            return None
+        return torch.load(journal_file, map_location='cpu')
+
+    @classmethod
+    def resume(cls, output_dir, hypernet, device, record, tensors=None, checkpoints=None):
+        """restore the state of record: the hypernet is loaded, z and base files written after the record
+        (by the object that was pursued when the run stopped) are removed, and so are their delta log entries
+
+        Returns:
+            PursuitSession
+        """
+        hypernet_state = record["hypernet"]
+        if tensors is not None and all(isinstance(v, str) for v in hypernet_state.values()):
+            hypernet_state = tensors.get_state(hypernet_state)
+        hypernet.load_state_dict(hypernet_state)
+        hypernet.to(device)
+        committed = {"zs": set(record["z_files"]), "Bases": set(record["base_files"])}
+        for sub_dir, names in committed.items():
+            for name in sorted(os.listdir(os.path.join(output_dir, sub_dir))):
+                if name.endswith(".json") and name not in names:
+                    os.remove(os.path.join(output_dir, sub_dir, name))
+        if checkpoints is not None and record.get("delta_lengths") is not None:
+            checkpoints.truncate_deltas(record["delta_lengths"])
+        base_dir = os.path.join(output_dir, "Bases")
+        bases = [torch.load(os.path.join(base_dir, name), map_location=device)['z'] for name in record["base_files"]]
+        return cls(output_dir, hypernet, bases, record["init_base_num"], record["init_objects_num"], record=record, tensors=tensors, checkpoints=checkpoints)
+
+    def rollback(self):
+        """restore the hypernet of the last committed object"""
+        self.hypernet.load_state_dict(self.snapshot)
+
+    def add_base(self, z):
+        self.bases.append(z)
+
+    def commit(self, hypernet_updated=False):
+        """the current object is done (pursued, seen or rejected), its files are written: take the hypernet snapshot
+        (if it changed) and persist the record in the background"""
+        if hypernet_updated:
+            self.snapshot = _cpu_state(self.hypernet)
+            self.hypernet_version += 1
+        record = {
+            "obj_counter": self.obj_counter,
+            "round": self.round,
+            "position": self.position,
+            "init_base_num": self.init_base_num,
+            "init_objects_num": self.init_objects_num,
+            "hypernet_version": self.hypernet_version,
+            "z_files": sorted(zf for zf in os.listdir(self.z_dir) if zf.endswith(".json")),
+            "base_files": sorted(bf for bf in os.listdir(self.base_dir) if bf.endswith(".json")),
+            "delta_lengths": self.checkpoints.delta_lengths() if self.checkpoints is not None else None,
+            # the snapshot tensors are never modified in place, the writer can use them
+            "hypernet": self.snapshot
+        }
+        self.writer.submit(record)
+
+    def close(self):
+        self.writer.close()
@@ -0,0 +1,112 @@
+import os
+import random
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from train import train_net
+from object_pursuit.model.coeffnet.hypernet import Hypernet
+from object_pursuit.model.coeffnet.coeffnet_simple import Backbone, Singlenet
+
+
+def _cpu_state(module):
+    return {k: v.detach().cpu().clone() for k, v in module.state_dict().items()}
+
+def get_rng_state():
+    """torch (cpu and cuda), numpy and random states of this process"""
+    cuda = None
+    if torch.cuda.is_available() and getattr(torch.cuda, "is_initialized", lambda: True)():
+        cuda = torch.cuda.get_rng_state_all()
+    return {"torch": torch.get_rng_state(), "cuda": cuda, "numpy": np.random.get_state(), "random": random.getstate()}
+
+def set_rng_state(state):
+    torch.set_rng_state(state["torch"])
+    if state["cuda"] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+    np.random.set_state(state["numpy"])
+    random.setstate(state["random"])
+
+def get_buffers(module):
+    """copies of the buffers (batch norm statistics) of module"""
+    return {k: v.detach().clone() for k, v in module.named_buffers()}
+
+def set_buffers(module, buffers):
+    with torch.no_grad():
+        for k, v in module.named_buffers():
+            v.copy_(buffers[k].to(v.device))
+
+def _run_base_update(hypernet_state, backbone_state, z_dim, param_dict, train_kwargs, result_file, rng_state):
+    set_rng_state(rng_state)
+    device = train_kwargs["device"]
+    hypernet = Hypernet(z_dim, param_dict=param_dict)
+    hypernet.load_state_dict(hypernet_state)
+    hypernet.to(device)
+    # the base update trains the hypernet, the backbone stays frozen
+    for param in hypernet.parameters():
+        param.requires_grad = True
+    backbone = None
+    if backbone_state is not None:
+        backbone = Backbone(pretrained=False)
+        backbone.load_state_dict(backbone_state)
+        for param in backbone.parameters():
+            param.requires_grad = False
+        backbone.to(device)
+    max_val_acc, z_net = train_net(hypernet=hypernet, backbone=backbone, **train_kwargs)
+    tmp_file = result_file + ".tmp"
+    res = {"max_val_acc": max_val_acc, "hypernet": _cpu_state(hypernet), "net": _cpu_state(z_net)}
+    if backbone is not None:
+        res["backbone_buffers"] = {k: v.cpu() for k, v in get_buffers(backbone).items()}
+    torch.save(res, tmp_file)
+    os.rename(tmp_file, result_file)
+
+
+class SpeculativeBaseUpdate(object):
+    """Run the base update (train_net with net_type "singlenet") of an object in a separate (spawned) process,
+    on a copy of the current hypernet, while the first express check runs in the main process.
+    If the express check succeeds, the base update is cancelled; otherwise its result (the trained hypernet and z,
+    the batch norm buffers of the backbone) is taken over.
+
+    The base update runs from the state before the check on both paths: the child gets the generator states
+    snapshot before the check (get_rng_state) and the backbone as it was then, and the sequential base update
+    restores both (set_rng_state, set_buffers) before it starts. The check only trains coefficients and the hypernet
+    is frozen, so both paths train the same hypernet on the same streams and give the same result.
+
+    Args:
+        hypernet (Hypernet): current hypernet, copied at construction
+        backbone (Backbone): frozen backbone, or None
+        train_kwargs (dict): keyword arguments of train_net for the base update (without hypernet and backbone)
+        result_dir (str): directory of the result file (the base update dir)
+        rng_state (dict): generator states the base update starts from (get_rng_state)
+    """
+    def __init__(self, hypernet, backbone, train_kwargs, result_dir, rng_state):
+        self.z_dim = train_kwargs["z_dim"]
+        self.result_file = os.path.join(result_dir, "speculative_result.pth")
+        backbone_state = _cpu_state(backbone) if backbone is not None else None
+        ctx = mp.get_context('spawn')
+        self.process = ctx.Process(target=_run_base_update,
+                                   args=(_cpu_state(hypernet), backbone_state, hypernet.z_dim, hypernet.param_dict, train_kwargs, self.result_file, rng_state))
+        self.process.start()
+
+    def cancel(self):
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
+
+    def result(self, hypernet, backbone=None):
+        """wait for the base update, load its hypernet into hypernet (and its batch norm buffers into backbone)
+
+        Returns:
+            tuple: max validation acc, trained Singlenet (z)
+        """
+        self.process.join()
+        if self.process.exitcode != 0 or not os.path.isfile(self.result_file):
+            raise RuntimeError(f("speculative base update failed, exit code {self.process.exitcode}"))
+        res = torch.load(self.result_file, map_location=next(hypernet.parameters()).device)
+        hypernet.load_state_dict(res["hypernet"])
+        if backbone is not None:
+            set_buffers(backbone, res["backbone_buffers"])
+        z_net = Singlenet(self.z_dim)
+        z_net.load_state_dict(res["net"])
+        z_net.to(next(hypernet.parameters()).device)
+        os.remove(self.result_file)
+        return res["max_val_acc"], z_net
@@ -1,4 +1,5 @@
 import os
+import inspect
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -7,11 +8,19 @@ from tqdm import tqdm
 from torch.utils.data import DataLoader, random_split
 from torch import optim
 
-from object_pursuit.model.coeffnet.coeffnet_simple import Singlenet, Coeffnet
-from object_pursuit.loss.dice_loss import dice_coeff
+from object_pursuit.model.coeffnet.coeffnet_simple import Singlenet, Coeffnet, MultiCoeffnet
+from object_pursuit.loss.metrics import MetricAccumulator, batch_dice, binarize
 from object_pursuit.loss.IoU_loss import IoULoss
 from object_pursuit.loss.memory_loss import MemoryLoss
+from object_pursuit.loss.seg_loss import seg_loss as seg_loss_func
 from object_pursuit.utils.pos_weight import get_pos_weight_from_batch
+from object_pursuit.utils.early_stop import CurveStopper
+from object_pursuit.utils.val_subset import AdaptiveValSubset, IndexSampler
+from object_pursuit.utils.events import begin_phase
+from object_pursuit.utils.step_profiler import StepTimer
+from object_pursuit.utils.profiling import label_iter, step as profile_step
+from object_pursuit.dataset.batch_transforms import batch_to_device
+from object_pursuit.dataset.resident_dataset import get_resident, ResidentLoader
 from object_pursuit.utils.util import *
 
 def set_eval(primary_net, hypernet, backbone=None):
@@ -26,23 +35,37 @@ def set_train(primary_net, hypernet, backbone=None):
     if backbone is not None:
         backbone.train()
 
-def eval_net(net_type, primary_net, loader, device, hypernet, backbone=None, zs=None):
-    """Evaluation without the densecrf with the dice coefficient"""
+def downscale(imgs, masks, size=None):
+    """train / validate at a reduced resolution (coarse stage of the coarse-to-fine coefficient pursuit)"""
+    if size is None or tuple(imgs.shape[-2:]) == tuple(size):
+        return imgs, masks
+    imgs = F.interpolate(imgs, size=size, mode='area')
+    masks = F.interpolate(masks, size=size, mode='nearest')
+    return imgs, masks
+
+def get_coeffs(primary_net):
+    """the (winner's) coefficients of a trained coeffnet"""
+    with torch.no_grad():
+        if hasattr(primary_net, "winner"):
+            return primary_net.coeffs[primary_net.winner].clone().detach()
+        return primary_net.coeffs.clone().detach()
+
+def eval_net(net_type, primary_net, loader, device, hypernet, backbone=None, zs=None, batch_transform=None, per_sample=False, input_size=None):
+    """Evaluation without the densecrf with the dice coefficient, 
+    multi-start nets get a list of dice coefficients (one per alive start).
+    With per_sample, the per-sample dice (n, or S*n for multi-start nets) is returned as well."""
     # set eval
     set_eval(primary_net, hypernet)
+    num_starts = len(primary_net.alive) if hasattr(primary_net, "alive") else None
 
     n_val = len(loader)  # the number of batch
-    tot = 0
-    
-    # in case there's only one batch
-    if n_val == 0:
-        n_val = 1
+    # per-sample dice is accumulated on the device, synchronized once at the end
+    metrics = MetricAccumulator()
     
     with tqdm(total=n_val, desc='Validation round', unit='batch', leave=False) as pbar:
         for batch in loader:
-            imgs, true_masks = batch['image'], batch['mask']
-            imgs = imgs.to(device=device, dtype=torch.float32)
-            true_masks = true_masks.to(device=device, dtype=torch.float32)
+            imgs, true_masks = batch_to_device(batch, device, batch_transform)
+            imgs, true_masks = downscale(imgs, true_masks, input_size)
 
             # predict mask
             with torch.no_grad():
@@ -55,17 +78,31 @@ def eval_net(net_type, primary_net, loader, device, hypernet, backbone=None, zs=
                     raise NotImplementedError
 
             # cal dice coeff
-            pred = torch.sigmoid(mask_pred)
-            pred = (pred > 0.5).float()
-            res = dice_coeff(pred, true_masks).item()
-            tot += res
+            if num_starts is not None:
+                metrics.update(**{str(s): batch_dice(binarize(mask_pred[s]), true_masks) for s in range(num_starts)})
+            else:
+                metrics.update(dice=batch_dice(binarize(mask_pred), true_masks))
             
             pbar.update()
 
     # set train
     set_train(primary_net, hypernet, backbone)
     
-    return tot / n_val
+    # in case there's no batch
+    res = metrics.compute()
+    if num_starts is not None:
+        score = [res.get(str(s), 0.0) for s in range(num_starts)]
+    else:
+        score = res.get("dice", 0.0)
+    if per_sample:
+        if len(res) == 0:
+            samples = torch.zeros(0) if num_starts is None else torch.zeros(num_starts, 0)
+        elif num_starts is not None:
+            samples = torch.stack([metrics.per_sample(str(s)).cpu() for s in range(num_starts)])
+        else:
+            samples = metrics.per_sample("dice").cpu()
+        return score, samples
+    return score
 
 
 def train_net(z_dim, 
@@ -85,22 +122,45 @@ def train_net(z_dim,
               wait_epochs=3,
               acc_threshold=1.0,
               l1_loss_coeff=0.2,
-              mem_loss_coeff=0.04):
+              mem_loss_coeff=0.04,
+              resident=False,
+              starts=1,
+              decision_threshold=None,
+              val_ci_width=None,
+              input_size=None,
+              init_coeffs=None,
+              low_res_loss=False,
+              events=None,
+              step_sample=0):
     # set logger
     log_file = open(os.path.join(save_cp_path, "log.txt"), "w")
+    # train_net event (samples: training images processed)
+    phase = begin_phase(events, "train_net", net_type=net_type, input_size=input_size, starts=starts)
 
-    # set network
+    # set network (multi-start nets train several coeffs at once and keep the best half of them after each epoch)
     if net_type == "singlenet":
+        # a single z: the summed loss of several starts would also train the hypernet for the losing ones
+        assert starts <= 1, "multi-start is only supported for coeffnet"
         primary_net = Singlenet(z_dim)
     elif net_type == "coeffnet":
         assert zs is not None and len(zs) == base_num
-        primary_net = Coeffnet(base_num, nn_init=True)
+        primary_net = Coeffnet(base_num, nn_init=True) if starts <= 1 else MultiCoeffnet(base_num, starts, nn_init=True)
     else:
         raise NotImplementedError
+    multi_start = starts > 1
+    # carry over coefficients (e.g. from the coarse stage), the other starts of a multi-start net keep their init
+    if init_coeffs is not None:
+        assert net_type == "coeffnet"
+        with torch.no_grad():
+            if multi_start:
+                primary_net.coeffs.data[0] = init_coeffs.to(primary_net.coeffs.device)
+            else:
+                primary_net.coeffs.data = init_coeffs.clone().to(primary_net.coeffs.device)
     
     primary_net.to(device)
     
     # set dataset and dataloader
+    batch_transform = getattr(dataset, "batch_transform", None)
     maximum_len = 2500
     if len(dataset) > maximum_len:
         n_data = maximum_len
@@ -108,7 +168,24 @@ def train_net(z_dim,
         n_data = len(dataset)
     
     # set train/val dataset
-    if val_percent < 1.0:
+    if resident:
+        # samples are decoded once and sliced in the main process, no loader workers
+        resident_set = get_resident(dataset, max_len=maximum_len)
+        batch_transform = resident_set.batch_transform
+        n_data = len(resident_set)
+        indices = torch.randperm(n_data).tolist()
+        if val_percent < 1.0:
+            n_val = int(n_data * val_percent)
+            n_train = int(n_data * (1-val_percent))
+            train_loader = ResidentLoader(resident_set, batch_size, indices[:n_train], shuffle=True, drop_last=True)
+            val_loader = ResidentLoader(resident_set, batch_size, indices[n_train:n_train+n_val], shuffle=False, drop_last=True)
+        else:
+            n_train = n_data
+            n_val = n_data
+            train_loader = ResidentLoader(resident_set, batch_size, indices, shuffle=True, drop_last=True)
+            val_loader = ResidentLoader(resident_set, batch_size, indices, shuffle=False, drop_last=True)
+        make_val_loader = lambda idx: ResidentLoader(resident_set, batch_size, idx, shuffle=False, drop_last=False)
+    elif val_percent < 1.0:
         n_val = int(n_data * val_percent)
         n_train = int(n_data * (1-val_percent))
         n_rest = len(dataset) - n_val - n_train
@@ -120,6 +197,21 @@ def train_net(z_dim,
         n_val = n_data
         train_loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=8, pin_memory=True, drop_last=True)
         val_loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=8, pin_memory=True, drop_last=True)
+    if not resident:
+        # one loader for all the validation subsets, its workers are kept between evaluations where torch supports it
+        val_sampler = IndexSampler()
+        persistent = {"persistent_workers": True} if "persistent_workers" in inspect.signature(DataLoader.__init__).parameters else {}
+        subset_loader = DataLoader(dataset, batch_size=batch_size, sampler=val_sampler, num_workers=8, pin_memory=True, drop_last=False, **persistent)
+        def make_val_loader(idx):
+            val_sampler.indices = list(idx)
+            return subset_loader
+    
+    # validate (the whole training set) on a stratified subset sized by the confidence interval of the mean dice,
+    # grown while the decision against the threshold is open
+    val_subset = None
+    if val_ci_width is not None and val_percent >= 1.0:
+        val_threshold = decision_threshold if decision_threshold is not None else (acc_threshold if acc_threshold < 1.0 else None)
+        val_subset = AdaptiveValSubset(len(resident_set) if resident else len(dataset), threshold=val_threshold, target_width=val_ci_width)
     
     # optimize
     if backbone is not None:
@@ -133,6 +225,9 @@ def train_net(z_dim,
         MemLoss = MemoryLoss(Base_dir=z_dir, device=device)
         mem_coeff = mem_loss_coeff
         
+    # stop as soon as the fitted validation curve is confidently above / below decision_threshold
+    stopper = CurveStopper(decision_threshold, max_epochs) if decision_threshold is not None else None
+        
     global_step = 0
     max_valid_acc = 0
     max_record = None
@@ -146,69 +241,108 @@ def train_net(z_dim,
         Learning rate:   {lr}
         Training size:   {n_train}
         Validation size: {n_val}
+        resident data:   {resident}
+        starts:          {starts}
         Checkpoints:     {save_cp_path}
         Device:          {device}
         z_dir:           {z_dir}
         wait epochs:     {wait_epochs}
         val acc thres:   {acc_threshold}
+        decision thres:  {decision_threshold}
+        val CI width:    {val_ci_width}
+        input size:      {input_size}
+        init coeffs:     {init_coeffs is not None}
+        low res loss:    {low_res_loss}
+        step sampling:   {step_sample} (0 means no step timing)
         trainable parameter number of the primarynet: {sum(x.numel() for x in primary_net.parameters() if x.requires_grad)}
         trainable parameter number of the hypernet: {sum(x.numel() for x in hypernet.parameters() if x.requires_grad)}
     """)
     write_log(log_file, info_text)
         
+    # sampled step timing (data wait / h2d / forward / loss / backward / optimizer), reported per epoch
+    step_timer = StepTimer(device, sample_every=step_sample, modules={"hypernet": hypernet, "backbone": backbone}, log=lambda s: write_log(log_file, s), events=events)
+    
     # training process
+    n_samples = 0
+    n_epochs = 0
     try:
         for epoch in range(max_epochs):
+            n_epochs = epoch + 1
             set_train(primary_net, hypernet, backbone)
             val_list = []
             write_log(log_file, f("Start epoch {epoch}"))
             with tqdm(total=n_train, desc=f("Epoch {epoch + 1}/{max_epochs}', unit='img")) as pbar:
-                for batch in train_loader:
-                    imgs = batch['image']
-                    true_masks = batch['mask']
-                    imgs = imgs.to(device=device, dtype=torch.float32)
-                    true_masks = true_masks.to(device=device, dtype=torch.float32)
+                for batch in step_timer.iter(label_iter(train_loader)):
+                    with step_timer.segment("h2d"):
+                        imgs, true_masks = batch_to_device(batch, device, batch_transform)
+                        imgs, true_masks = downscale(imgs, true_masks, input_size)
                     
-                    if net_type == "singlenet":
-                        masks_pred = primary_net(imgs, hypernet, backbone)
-                    elif net_type == "coeffnet":
-                        masks_pred = primary_net(imgs, zs, hypernet, backbone)
-                    else:
-                        raise NotImplementedError
+                    # with low_res_loss, the logits stay at the decoder resolution and are compared with area-pooled masks
+                    with step_timer.segment("forward"):
+                        if net_type == "singlenet":
+                            masks_pred = primary_net(imgs, hypernet, backbone, upsample=not low_res_loss)
+                        elif net_type == "coeffnet":
+                            masks_pred = primary_net(imgs, zs, hypernet, backbone, upsample=not low_res_loss)
+                        else:
+                            raise NotImplementedError
                     
-                    seg_loss = F.binary_cross_entropy_with_logits(masks_pred, true_masks, pos_weight=torch.tensor([get_pos_weight_from_batch(true_masks)]).to(device))
-                    regular_loss = primary_net.L1_loss(l1_loss_coeff)
-                    loss = seg_loss + regular_loss
+                    with step_timer.segment("loss"):
+                        pos_weight = torch.tensor([get_pos_weight_from_batch(true_masks)]).to(device)
+                        if multi_start:
+                            # sum of the per-start losses, the starts don't share gradients
+                            seg_loss = masks_pred.size(0) * seg_loss_func(masks_pred, true_masks, pos_weight=pos_weight)
+                        else:
+                            seg_loss = seg_loss_func(masks_pred, true_masks, pos_weight=pos_weight)
+                        regular_loss = primary_net.L1_loss(l1_loss_coeff)
+                        loss = seg_loss + regular_loss
                     pbar.set_postfix(**{'seg loss (batch)': loss.item()})
                     
                     # optimize
-                    optimizer.zero_grad()
-                    loss.backward()
-                    if net_type == "singlenet":
-                        MemLoss(hypernet, mem_coeff)
-                        # pass
+                    with step_timer.segment("backward"):
+                        optimizer.zero_grad()
+                        loss.backward()
+                        if net_type == "singlenet":
+                            MemLoss(hypernet, mem_coeff)
+                            # pass
                     
-                    nn.utils.clip_grad_value_(optim_param, 0.1)
-                    optimizer.step()
+                    with step_timer.segment("optimizer"):
+                        nn.utils.clip_grad_value_(optim_param, 0.1)
+                        optimizer.step()
                     
                     pbar.update(imgs.shape[0])
+                    n_samples += imgs.shape[0]
                     global_step += 1
+                    step_timer.step(imgs.shape[0])
+                    profile_step()
                     
                     # eval
                     if global_step % int(n_train / (batch_size)) == 0:
-                        val_score = eval_net(net_type, primary_net, val_loader, device, hypernet, backbone, zs)
+                        if val_subset is not None:
+                            val_score = val_subset.evaluate(lambda idx: eval_net(net_type, primary_net, make_val_loader(idx), device, hypernet, backbone, zs, batch_transform, per_sample=True, input_size=input_size))
+                            write_log(log_file, f("  Validation subset size: {val_subset.size}/{val_subset.n}, CI half width: {val_subset.half_width}"))
+                        else:
+                            val_score = eval_net(net_type, primary_net, val_loader, device, hypernet, backbone, zs, batch_transform, input_size=input_size)
                         val_list.append(val_score)
                         write_log(log_file, f("  Validation Dice Coeff: {val_score}, segmentation loss + l1 loss: {loss}"))
+            step_timer.epoch_end(epoch)
                         
             if save_cp_path is not None:
                 if len(val_list) > 0:
-                    avg_valid_acc = sum(val_list)/len(val_list)
+                    if multi_start:
+                        start_accs = [sum(v[s] for v in val_list)/len(val_list) for s in range(len(primary_net.alive))]
+                        avg_valid_acc = max(start_accs)
+                        write_log(log_file, f("  starts {primary_net.alive}, validation acc: {start_accs}"))
+                        if len(primary_net.alive) > 1:
+                            pruned = primary_net.prune(start_accs)
+                            write_log(log_file, f("  pruned starts {pruned}, alive starts {primary_net.alive}"))
+                    else:
+                        avg_valid_acc = sum(val_list)/len(val_list)
                     if avg_valid_acc > max_valid_acc:
                         if net_type == "singlenet":
                             max_record = primary_net.z
                             torch.save(primary_net.state_dict(), os.path.join(save_cp_path, f("Best_z.pth")))
                         elif net_type == "coeffnet":
-                            max_record = primary_net.coeffs
+                            max_record = primary_net.coeffs[primary_net.winner] if multi_start else primary_net.coeffs
                             torch.save(primary_net.state_dict(), os.path.join(save_cp_path, f("Best_coeff.pth")))
                         max_valid_acc = avg_valid_acc
                         stop_counter = 0
@@ -216,38 +350,63 @@ def train_net(z_dim,
                     else:
                         stop_counter += 1
                     
-                    if stop_counter >= wait_epochs or max_valid_acc > acc_threshold:
+                    decision = None
+                    if stopper is not None:
+                        decision = stopper.update(epoch, avg_valid_acc)
+                        if stopper.prediction is not None:
+                            write_log(log_file, f("  curve prediction: final acc {stopper.prediction} (std {stopper.std}), epoch acc {avg_valid_acc}, best acc {max_valid_acc}"))
+                        if decision is not None:
+                            write_log(log_file, f("early {decision} against decision threshold {decision_threshold}"))
+                    
+                    if stop_counter >= wait_epochs or max_valid_acc > acc_threshold or decision is not None:
                         # stop procedure
                         write_log(log_file, f("training stopped at epoch {epoch}"))
                         write_log(log_file, f("current record value (coeff or z): {max_record}"))
                         log_file.close()
+                        step_timer.close()
+                        phase.end(samples=n_samples, epochs=n_epochs, acc=max_valid_acc)
                         return max_valid_acc, primary_net
     except Exception as e:
         write_log(log_file, f("Error catch during training! info: {e}"))
+        step_timer.close()
+        phase.end(samples=n_samples, epochs=n_epochs, acc=0.0, error=repr(e))
         return 0.0, primary_net
     
     #stop procedure
     write_log(log_file, f("training stopped"))
     write_log(log_file, f("current record value (coeff or z): {max_record}"))
     log_file.close()
+    step_timer.close()
+    phase.end(samples=n_samples, epochs=n_epochs, acc=max_valid_acc)
     return max_valid_acc, primary_net
             
 
-def have_seen(dataset, device, z_dir, z_dim, hypernet, backbone, threshold, start_index=0, test_percent=0.2, batch_size=64):
+def have_seen(dataset, device, z_dir, z_dim, hypernet, backbone, threshold, start_index=0, test_percent=0.2, batch_size=64, resident=False, z_files=None, events=None):
     """
     Checks each existing basis z to see if it represents
     new object well (low segmentation loss)  
+    z_files: check these z files instead of the ones in z_dir
+    events: EventWriter of the have_seen_eval event
     """
+    phase = begin_phase(events, "have_seen_eval")
     primary_net = Singlenet(z_dim)
     primary_net.to(device)
     
-    n_test = int(len(dataset)*test_percent)
-    n_rest = len(dataset) - n_test
-    test_set, _ = random_split(dataset, [n_test, n_rest])
-    test_loader = DataLoader(test_set, batch_size=batch_size, shuffle=False, num_workers=8, pin_memory=True, drop_last=False)
+    if resident:
+        resident_set = get_resident(dataset, max_len=2500)
+        n_test = int(len(resident_set)*test_percent)
+        test_loader = ResidentLoader(resident_set, batch_size, torch.randperm(len(resident_set))[:n_test].tolist(), shuffle=False, drop_last=False)
+        batch_transform = resident_set.batch_transform
+    else:
+        n_test = int(len(dataset)*test_percent)
+        n_rest = len(dataset) - n_test
+        test_set, _ = random_split(dataset, [n_test, n_rest])
+        test_loader = DataLoader(test_set, batch_size=batch_size, shuffle=False, num_workers=8, pin_memory=True, drop_last=False)
+        batch_transform = getattr(dataset, "batch_transform", None)
     
     all_test_acc = []
-    z_files = [os.path.join(z_dir, zf) for zf in sorted(os.listdir(z_dir)) if zf.endswith('.json')]
+    if z_files is None:
+        z_files = [os.path.join(z_dir, zf) for zf in sorted(os.listdir(z_dir)) if zf.endswith('.json')]
     max_acc = 0.0
     max_zf = None
     count = 0
@@ -256,14 +415,17 @@ def have_seen(dataset, device, z_dir, z_dim, hypernet, backbone, threshold, star
             count += 1
             continue
         primary_net.load_z(zf)
-        test_acc = eval_net(net_type="singlenet", primary_net=primary_net, loader=test_loader, device=device, hypernet=hypernet, backbone=backbone)
+        test_acc = eval_net(net_type="singlenet", primary_net=primary_net, loader=test_loader, device=device, hypernet=hypernet, backbone=backbone, batch_transform=batch_transform)
         all_test_acc.append(test_acc)
         if test_acc > max_acc:
             max_acc = test_acc
             max_zf = zf
         count += 1
+        profile_step()
 
-    z_acc_pairs = [(zf, acc) for zf, acc in zip(z_files, all_test_acc)]
+    z_acc_pairs = [(zf, acc) for zf, acc in zip(z_files[start_index:], all_test_acc)]
+    # every z is evaluated on the test samples
+    phase.end(samples=n_test * len(all_test_acc), zs=len(all_test_acc), acc=max_acc)
     if max_acc > threshold:
         return True, max_acc, max_zf, z_acc_pairs
     else:
@@ -7,8 +7,7 @@ import random
 from torch.utils.data import DataLoader, sampler
 from tqdm import tqdm
 
-from object_pursuit.loss.dice_loss import dice_coeff
-from object_pursuit.loss.criterion import jaccard
+from object_pursuit.loss.metrics import MetricAccumulator, batch_dice, batch_jaccard, binarize
 
 from object_pursuit.pretrain._dataset import MultiJointDataset
 from object_pursuit.pretrain._model import Multinet
@@ -19,7 +18,8 @@ def _eval(multinet, loader, ident, device, use_IOU=False):
     multinet.train()
     mask_type = torch.float32 if multinet.n_classes == 1 else torch.long
     n_val = len(loader)  # the number of batch
-    tot = 0
+    # metrics are accumulated on the device, synchronized once at the end
+    metrics = MetricAccumulator()
     
     with tqdm(total=n_val, desc='Validation round', unit='batch', leave=False) as pbar:
         for batch in loader:
@@ -31,22 +31,19 @@ def _eval(multinet, loader, ident, device, use_IOU=False):
                 mask_pred, _ = multinet(imgs, ident) # multinet takes img and ident as input
 
                 if multinet.n_classes > 1:
-                    res = F.cross_entropy(mask_pred, true_masks).item()
-                    tot += res
+                    metrics.update(acc=F.cross_entropy(mask_pred, true_masks))
                 else:
-                    pred = torch.sigmoid(mask_pred)
-                    pred = (pred > 0.5).float()
+                    pred = binarize(mask_pred)
                     if use_IOU:
-                        res = jaccard(true_masks, pred)
+                        metrics.update(acc=batch_jaccard(pred, true_masks))
                     else:
-                        res = dice_coeff(pred, true_masks).item()
-                    tot += res
+                        metrics.update(acc=batch_dice(pred, true_masks))
                     
             pbar.update()
 
     multinet.train()
     
-    return tot / n_val
+    return sum(metrics.batch_means("acc")) / n_val
 
 def getDataloader(dataset, n_val, batch_size):
     n_size = len(dataset)
@@ -5,6 +5,7 @@ import argparse
 from object_pursuit.pretrain._train import *
 from object_pursuit.pretrain._dataset import *
 from object_pursuit.pretrain._model import *
+from object_pursuit.utils.profiling import PhaseProfiler
 
 def pretrain_get_args():
     parser = argparse.ArgumentParser(description='Pretrain hypernet (and backbone, if exist) by multi-object joint training',
@@ -49,6 +50,16 @@ def pretrain_get_args():
                         help='if true, the backbone will not be updated during training')
     parser.add_argument('-trainset_only', '--trainset_only', dest='trainset_only', action="store_true",
                         help='if true, only use training set in the whole dataset during training')
+    parser.add_argument('-low_res_loss', '--low_res_loss', dest='low_res_loss', action="store_true",
+                        help='if true, the training loss is computed at the decoder resolution against area-pooled masks')
+    parser.add_argument('-step_sample', '--step_sample', dest='step_sample', type=int, nargs='?', default=0,
+                        help='time every n-th training step (data wait, h2d, forward, backward, optimizer), reported per epoch in the log (0: off)')
+    parser.add_argument('-profile', '--profile', dest='profile', type=str, nargs='*', default=None, choices=["joint_train_epoch"],
+                        help='torch.profiler capture of these phases (no phase: all), chrome traces and top operator tables are written to <output dir>/profile')
+    parser.add_argument('-profile_schedule', '--profile_schedule', dest='profile_schedule', type=int, nargs=3, default=[1, 1, 3],
+                        help='wait, warmup and active steps of a profiled phase')
+    parser.add_argument('-profile_captures', '--profile_captures', dest='profile_captures', type=int, default=1,
+                        help='number of profiled occurrences of each phase')
     
     return parser.parse_args()
 
@@ -75,6 +86,10 @@ def main(args):
                     freeze_backbone=args.freeze_backbone
                     )
     
+    profiler = None
+    if args.profile is not None:
+        profiler = PhaseProfiler(os.path.join(args.output_dir, "profile"), args.profile or ["joint_train_epoch"], *args.profile_schedule, captures=args.profile_captures)
+    
     # train
     joint_train(net=net,
                 device=default_device,
@@ -88,5 +103,8 @@ def main(args):
                 n_val=args.eval_n,
                 save_ckpt=args.save_ckpt,
                 use_dice=args.use_dice_loss,
+                low_res_loss=args.low_res_loss,
+                step_sample=args.step_sample,
+                profiler=profiler,
                 args=args)
     
\ No newline at end of file
@@ -1,5 +1,6 @@
 from object_pursuit.model.coeffnet.coeffnet import *
 from object_pursuit.model.deeplabv3.deeplab import *
+from object_pursuit.utils.profiling import label
 
 class Multinet(nn.Module):
     n_channels = 3
@@ -21,18 +22,19 @@ class Multinet(nn.Module):
                 for param in self.backbone.parameters():
                     param.requires_grad = False
         
-    def forward(self, input, ident):
+    def forward(self, input, ident, upsample=True):
         z = self.z[ident]
         # hypernet predict weights
         weights = self.hypernet(z)
         if not self.use_backbone:
             # forward
-            return deeplab_forward(input, weights), z
+            return deeplab_forward(input, weights, upsample), z
         else:
             # backbone forward
-            x, low_level_feat = self.backbone(input)
+            with label("backbone"):
+                x, low_level_feat = self.backbone(input)
             # decoder forward
-            return deeplab_forward_no_backbone(input, x, low_level_feat, weights), z
+            return deeplab_forward_no_backbone(input, x, low_level_feat, weights, upsample), z
         
 class MultiDeeplab(nn.Module):
     n_channels = 3
@@ -41,8 +43,8 @@ class MultiDeeplab(nn.Module):
         super(MultiDeeplab, self).__init__()
         self.main_net = DeepLab(num_classes = 1, backbone = 'resnetsub', output_stride = 16, freeze_backbone=freeze_backbone, pretrained_backbone=True)
         
-    def forward(self, input, ident):
-        return self.main_net(input), ident    
+    def forward(self, input, ident, upsample=True):
+        return self.main_net(input, upsample), ident    
         
         
 def get_multinet(model_type, class_num, z_dim, device="cuda", use_backbone=True, freeze_backbone=True):
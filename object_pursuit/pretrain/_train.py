@@ -8,8 +8,11 @@ import torch.nn.functional as F
 from fstring import fstring as f
 
 from object_pursuit.pretrain._eval import joint_eval
+from object_pursuit.loss.seg_loss import seg_loss
 
 from object_pursuit.utils.util import create_dir, write_log
+from object_pursuit.utils.step_profiler import StepTimer
+from object_pursuit.utils.profiling import begin_capture, label_iter, step as profile_step
 
 def joint_train(net,
                 device,
@@ -23,6 +26,9 @@ def joint_train(net,
                 n_val=-1,
                 save_ckpt=True,
                 use_dice=False,
+                low_res_loss=False,
+                step_sample=0,
+                profiler=None,
                 args=None):
     
     # init
@@ -60,42 +66,57 @@ def joint_train(net,
         Eval data num:   {n_val}
         save checkpoint: {save_ckpt}
         use dice loss:   {use_dice}
+        low res loss:    {low_res_loss}
+        step sampling:   {step_sample}
         parameter number of the network: {param_num}
     \n""")
     write_log(logf, info_text)
     
     # recorder
     max_eval_acc = 0
+    # sampled step timing (data wait / h2d / forward / loss / backward / optimizer), reported per epoch
+    step_timer = StepTimer(device, sample_every=step_sample, modules={"hypernet": getattr(net, "hypernet", None), "backbone": getattr(net, "backbone", None)},
+                           log=lambda s: write_log(logf, s))
     
     for epoch in range(epochs):
         net.train()
         loss_recorder = []
         write_log(logf, f("***********epoch {epoch} started**********"))
-        with tqdm(total=n_size, desc=f("Epoch {epoch + 1}/{epochs}', unit='img")) as pbar:
-            for batch in dataloader_train:
-                imgs = batch['image']
-                true_masks = batch['mask']
-                ident = batch['cls'][0].item() # assume that object class in one batch are same
+        # torch.profiler capture of the first epochs (with --profile)
+        with begin_capture(profiler, "joint_train_epoch", tag=epoch):
+            with tqdm(total=n_size, desc=f("Epoch {epoch + 1}/{epochs}', unit='img")) as pbar:
+                for batch in step_timer.iter(label_iter(dataloader_train)):
+                    imgs = batch['image']
+                    true_masks = batch['mask']
+                    ident = batch['cls'][0].item() # assume that object class in one batch are same
                 
-                assert imgs.shape[1] == 3 # deal with rgb image only (for now)
+                    assert imgs.shape[1] == 3 # deal with rgb image only (for now)
                 
-                imgs = imgs.to(device=device, dtype=torch.float32)
-                true_masks = true_masks.to(device=device, dtype=torch.float32)
+                    with step_timer.segment("h2d"):
+                        imgs = imgs.to(device=device, dtype=torch.float32)
+                        true_masks = true_masks.to(device=device, dtype=torch.float32)
                 
-                # forward
-                masks_pred, _ = net(imgs, ident)
-                loss = F.binary_cross_entropy_with_logits(masks_pred, true_masks)
+                    # forward (with low_res_loss, the loss is computed at the decoder resolution)
+                    with step_timer.segment("forward"):
+                        masks_pred, _ = net(imgs, ident, upsample=not low_res_loss)
+                    with step_timer.segment("loss"):
+                        loss = seg_loss(masks_pred, true_masks)
                 
-                # backward
-                pbar.set_postfix(**{'loss (batch)': loss.item()})
-                loss_recorder.append(loss.item())
-                optimizer.zero_grad()
-                loss.backward()
-                nn.utils.clip_grad_value_(net.parameters(), 0.1)
-                optimizer.step()
-                pbar.update(1)
+                    # backward
+                    pbar.set_postfix(**{'loss (batch)': loss.item()})
+                    loss_recorder.append(loss.item())
+                    with step_timer.segment("backward"):
+                        optimizer.zero_grad()
+                        loss.backward()
+                    with step_timer.segment("optimizer"):
+                        nn.utils.clip_grad_value_(net.parameters(), 0.1)
+                        optimizer.step()
+                    pbar.update(1)
+                    step_timer.step(imgs.shape[0])
+                    profile_step()
                 
         scheduler_lr.step()
+        step_timer.epoch_end(epoch)
         
         # eval & save
         write_log(logf, f("Specific loss list: {loss_recorder} \n"))  
@@ -114,5 +135,6 @@ def joint_train(net,
                     torch.save(net.state_dict(), os.path.join(ckpt_path, f("pretrain_best.pth")))
                     write_log(logf, f("checkpoint saved")) 
         
+    step_timer.close()
     write_log(logf, "Training ends!") 
     logf.close()  
\ No newline at end of file
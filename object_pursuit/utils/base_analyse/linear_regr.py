@@ -1,14 +1,19 @@
 import os
 import numpy as np
+import torch
+from object_pursuit.utils.basis import BasisProjector
    
-def get_regress_coeff(bases, target):
-    '''linear regression using least square'''
-    A = np.stack(bases, axis=1)
-    coeff_mat = np.matmul(A.T, A)
-    proj = np.matmul(A.T, target)
-    coeff = np.matmul(np.linalg.inv(coeff_mat), proj)
-    res = np.matmul(A, coeff)
-    return coeff, res
+def get_regress_coeff(bases, target, projector=None):
+    '''linear regression using least square (QR of the bases, see utils.basis.BasisProjector), 
+    target can be a single vector or a batch of row vectors.
+    A BasisProjector can be passed to reuse its (incrementally updated) factorization across calls.'''
+    bases = [torch.from_numpy(np.asarray(b, dtype=np.float64)) for b in bases]
+    if projector is None:
+        projector = BasisProjector(bases)
+    else:
+        projector.sync(bases)
+    res, coeff, _ = projector.project(torch.from_numpy(np.asarray(target, dtype=np.float64)))
+    return coeff.numpy(), res.numpy()
 
 def distance_r(src, tar):
     delta = tar - src
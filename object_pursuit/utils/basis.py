@@ -0,0 +1,275 @@
+'''Factorizations of the z bases (stacked as the columns of a z_dim*N matrix)'''
+import json
+import math
+import torch
+
+
+def stack_bases(bases):
+    """list of N z tensors (z_dim) -> z_dim*N matrix"""
+    if torch.is_tensor(bases):
+        return bases.t() if bases.dim() == 2 else bases.unsqueeze(1)
+    return torch.stack(list(bases), dim=1)
+
+
+class BasisFactorization(object):
+    """SVD of the stacked bases A = U*S*V^T (computed in double precision), used to compress the bases
+    into r << N orthogonal directions.
+
+    The compressed bases are the columns of U_r*S_r/sqrt(N), i.e. the principal directions scaled so that
+    their mean squared norm is the mean squared norm of the explained part of the original bases
+    (keeps Coeffnet's coefficient initialization and l1 regularization in a comparable range).
+
+    Args:
+        bases (list): list of z tensors (z_dim), or a N*z_dim tensor
+    """
+    def __init__(self, bases):
+        self.update(bases)
+
+    def update(self, bases):
+        """(re)factorize, call it when bases are added or removed"""
+        A = stack_bases(bases)
+        self.dtype = A.dtype
+        self.device = A.device
+        self.z_dim, self.base_num = A.size()
+        U, S, V = torch.svd(A.double(), some=True)
+        self.U, self.S, self.V = U, S, V
+        energy = S * S
+        total = energy.sum().item()
+        # cumulative explained variance of the first k directions, k = 1..min(z_dim, N)
+        self.explained = (energy.cumsum(0) / total).tolist() if total > 0 else [1.0] * len(S)
+        self.scale = math.sqrt(max(self.base_num, 1))
+
+    def choose_rank(self, energy=None, max_error=None, max_rank=None):
+        """smallest rank r with explained variance >= energy, or with relative (Frobenius) reconstruction error
+        of the bases <= max_error. Without any budget, the numerical rank is returned."""
+        rank = len(self.explained)
+        if energy is not None:
+            rank = next(i + 1 for i, e in enumerate(self.explained) if e >= energy - 1e-12 or i == rank - 1)
+        elif max_error is not None:
+            rank = next(i + 1 for i, e in enumerate(self.explained) if math.sqrt(max(1.0 - e, 0.0)) <= max_error or i == rank - 1)
+        else:
+            tol = self.S.max().item() * max(self.z_dim, self.base_num) * 1e-12 if len(self.S) > 0 else 0.0
+            rank = max(int((self.S > tol).sum().item()), 1)
+        if max_rank is not None:
+            rank = min(rank, max_rank)
+        return rank
+
+    def error(self, rank):
+        """relative reconstruction error of the bases with rank directions"""
+        return math.sqrt(max(1.0 - self.explained[rank - 1], 0.0))
+
+    def compressed_bases(self, rank):
+        """list of rank compressed bases (z tensors), in the dtype/device of the input bases"""
+        B = self.U[:, :rank] * (self.S[:rank] / self.scale)
+        return [b.to(device=self.device, dtype=self.dtype) for b in B.t()]
+
+    def from_base_coeffs(self, coeffs, rank):
+        """coefficients on the original bases (N or N*M) -> coefficients on the compressed bases (rank or rank*M),
+        exact for the part of A*coeffs within the compressed span"""
+        c = coeffs.double().to(self.V.device)
+        return (self.scale * torch.mm(self.V[:, :rank].t(), c.view(self.base_num, -1))).view(rank, *c.size()[1:]).to(dtype=self.dtype)
+
+    def express(self, zs, rank):
+        """express object zs in the compressed bases (least squares, the compressed bases are orthogonal)
+
+        Args:
+            zs (list or tensor): z (z_dim), list of zs or M*z_dim tensor
+            rank (int): number of compressed bases
+
+        Returns:
+            tuple: coeffs (M*rank), reconstructed zs (M*z_dim), relative distance of each z (M)
+        """
+        Z = stack_bases(zs).double().to(self.U.device)
+        Ur = self.U[:, :rank]
+        coeffs = torch.mm(Ur.t(), Z) * (self.scale / self.S[:rank]).unsqueeze(1)
+        recon = torch.mm(Ur, torch.mm(Ur.t(), Z))
+        dist = (Z - recon).norm(dim=0) / Z.norm(dim=0).clamp(min=1e-12)
+        return coeffs.t().to(dtype=self.dtype), recon.t().to(dtype=self.dtype), dist.to(dtype=self.dtype)
+
+    def info(self, rank):
+        return {
+            "base_num": self.base_num,
+            "rank": rank,
+            "explained": self.explained[rank - 1],
+            "error": self.error(rank),
+            "singular_values": self.S.tolist()
+        }
+
+    def save(self, file_path, rank):
+        with open(file_path, 'w') as f_basis:
+            json.dump(self.info(rank), f_basis)
+
+
+def compress_bases(bases, energy=None, max_error=None, max_rank=None):
+    """compressed bases of the smallest rank within the budget, see BasisFactorization
+
+    Returns:
+        tuple: compressed bases (list), factorization, rank
+    """
+    factorization = BasisFactorization(bases)
+    rank = factorization.choose_rank(energy=energy, max_error=max_error, max_rank=max_rank)
+    return factorization.compressed_bases(rank), factorization, rank
+
+
+def _solve_upper(R, B):
+    """R^-1 * B for an upper triangular R (torch.linalg where available)"""
+    linalg = getattr(torch, "linalg", None)
+    if linalg is not None and hasattr(linalg, "solve_triangular"):
+        return linalg.solve_triangular(R, B, upper=True)
+    return torch.triangular_solve(B, R, upper=True)[0]
+
+
+class BasisProjector(object):
+    """Least squares projections onto the span of the bases, with an incrementally updated QR factorization
+    A = Q*R of the active (linearly independent) bases, in double precision.
+    Appending a base is one CGS2 orthogonalization step, removing a base restores the triangular R with
+    Givens rotations. Bases (numerically) dependent on the active ones are kept inactive, with a zero coefficient.
+
+    Args:
+        bases (list, optional): initial bases (z tensors). Defaults to None.
+        tol (float, optional): relative norm below which an orthogonalized base is considered dependent. Defaults to 1e-8.
+    """
+    def __init__(self, bases=None, tol=1e-8):
+        self.tol = tol
+        self.bases = []
+        self.active = []
+        self.Q = None
+        self.R = None
+        if bases is not None:
+            for z in bases:
+                self.append(z)
+
+    def __len__(self):
+        return len(self.bases)
+
+    @property
+    def rank(self):
+        return sum(self.active)
+
+    def _orthogonalize(self, z):
+        """classical Gram-Schmidt with one reorthogonalization (CGS2): z = Q*r + rho*q"""
+        if self.Q is None:
+            return None, z, z.norm()
+        r = torch.mv(self.Q.t(), z)
+        v = z - torch.mv(self.Q, r)
+        r2 = torch.mv(self.Q.t(), v)
+        v = v - torch.mv(self.Q, r2)
+        return r + r2, v, v.norm()
+
+    def _push(self, z):
+        """try to add z to the factorization, return False if it's dependent on the active bases"""
+        r, v, rho = self._orthogonalize(z)
+        if rho.item() <= self.tol * max(z.norm().item(), 1e-30):
+            return False
+        q = (v / rho).unsqueeze(1)
+        if self.Q is None:
+            self.Q = q
+            self.R = rho.view(1, 1)
+        else:
+            k = self.R.size(0)
+            R = self.R.new_zeros((k + 1, k + 1))
+            R[:k, :k] = self.R
+            R[:k, k] = r
+            R[k, k] = rho
+            self.Q = torch.cat([self.Q, q], dim=1)
+            self.R = R
+        return True
+
+    def append(self, z):
+        z = z.detach().double().flatten()
+        if self.Q is not None:
+            z = z.to(self.Q.device)
+        self.bases.append(z)
+        self.active.append(self._push(z))
+
+    def remove(self, index):
+        """remove the base at index (in the order the bases were appended)"""
+        was_active = self.active[index]
+        col = sum(self.active[:index])
+        del self.bases[index]
+        del self.active[index]
+        if not was_active:
+            return
+        k = self.R.size(0)
+        if k == 1:
+            self.Q, self.R = None, None
+        else:
+            # deleting a column of R leaves it upper Hessenberg, zero the subdiagonal with Givens rotations
+            R = torch.cat([self.R[:, :col], self.R[:, col+1:]], dim=1)
+            Q = self.Q.clone()
+            for j in range(col, k - 1):
+                a, b = R[j, j].item(), R[j+1, j].item()
+                h = math.hypot(a, b)
+                if h == 0.0:
+                    continue
+                c, s = a / h, b / h
+                rows = R[j:j+2, j:].clone()
+                R[j, j:] = c * rows[0] + s * rows[1]
+                R[j+1, j:] = -s * rows[0] + c * rows[1]
+                cols = Q[:, j:j+2].clone()
+                Q[:, j] = c * cols[:, 0] + s * cols[:, 1]
+                Q[:, j+1] = -s * cols[:, 0] + c * cols[:, 1]
+            self.Q = Q[:, :k-1].contiguous()
+            self.R = R[:k-1, :].contiguous()
+            if not self._check():
+                self.rebuild()
+                return
+        # inactive bases may be independent now
+        for i in range(len(self.bases)):
+            if not self.active[i]:
+                self.rebuild()
+                return
+
+    def _check(self):
+        """the factors are still consistent (orthogonality of Q)"""
+        k = self.Q.size(1)
+        eye = torch.eye(k, dtype=self.Q.dtype, device=self.Q.device)
+        return (torch.mm(self.Q.t(), self.Q) - eye).abs().max().item() < 1e-6
+
+    def rebuild(self):
+        """refactorize from scratch (in the order of the bases)"""
+        bases = self.bases
+        self.bases, self.active = [], []
+        self.Q, self.R = None, None
+        for z in bases:
+            self.append(z)
+
+    def sync(self, bases):
+        """make the projector follow a list of bases that only grows by appending, rebuild otherwise"""
+        n = len(self.bases)
+        same = len(bases) >= n and all(torch.equal(self.bases[i], bases[i].detach().double().flatten().to(self.bases[i].device)) for i in range(n))
+        if not same:
+            self.bases, self.active = [], []
+            self.Q, self.R = None, None
+            n = 0
+        for z in bases[n:]:
+            self.append(z)
+
+    def project(self, targets):
+        """least squares projection of one or many targets onto the bases
+
+        Args:
+            targets (tensor): z (z_dim) or M*z_dim tensor
+
+        Returns:
+            tuple: projection (z_dim or M*z_dim), coefficients on all bases (N or M*N, 0 for inactive bases),
+                   relative residual distance (scalar or M)
+        """
+        single = targets.dim() == 1
+        T = targets.detach().double().view(-1, targets.size(-1)).t()
+        dtype, device = targets.dtype, targets.device
+        if self.Q is None:
+            coeff = T.new_zeros((len(self.bases), T.size(1)))
+            res = torch.zeros_like(T)
+        else:
+            T = T.to(self.Q.device)
+            QtT = torch.mm(self.Q.t(), T)
+            coeff_active = _solve_upper(self.R, QtT)
+            coeff = T.new_zeros((len(self.bases), T.size(1)))
+            coeff[torch.tensor(self.active, dtype=torch.bool, device=T.device)] = coeff_active
+            res = torch.mm(self.Q, QtT)
+        dist = (T - res).norm(dim=0) / T.norm(dim=0).clamp(min=1e-30)
+        res, coeff, dist = res.t().to(device=device, dtype=dtype), coeff.t().to(device=device, dtype=dtype), dist.to(device=device, dtype=dtype)
+        if single:
+            return res[0], coeff[0], dist[0]
+        return res, coeff, dist
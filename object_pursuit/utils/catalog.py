@@ -0,0 +1,201 @@
+'''SQLite catalog of a pursuit run: objects (with their verdicts), bases and evaluations'''
+import os
+import json
+import sqlite3
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    round INTEGER,
+    data_dir TEXT,
+    obj_name TEXT,
+    obj_index INTEGER,
+    z_file TEXT,
+    verdict TEXT,
+    acc REAL,
+    matched_z_file TEXT,
+    hypernet_version INTEGER,
+    timings TEXT,
+    fingerprint TEXT,
+    cached INTEGER DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS objects_obj_index ON objects (obj_index);
+CREATE INDEX IF NOT EXISTS objects_obj_name ON objects (obj_name);
+CREATE INDEX IF NOT EXISTS objects_data_dir ON objects (data_dir);
+CREATE INDEX IF NOT EXISTS objects_round ON objects (round);
+CREATE TABLE IF NOT EXISTS bases (
+    base_index INTEGER PRIMARY KEY,
+    obj_index INTEGER,
+    data_dir TEXT,
+    obj_name TEXT,
+    base_file TEXT,
+    z_file TEXT,
+    acc REAL,
+    valid INTEGER DEFAULT 1,
+    verdict TEXT
+);
+CREATE INDEX IF NOT EXISTS bases_obj_index ON bases (obj_index);
+CREATE TABLE IF NOT EXISTS verdict_cache (
+    fingerprint TEXT,
+    hypernet_version INTEGER,
+    basis_version INTEGER,
+    verdict TEXT,
+    acc REAL,
+    matched_z_file TEXT,
+    data_dir TEXT,
+    PRIMARY KEY (fingerprint, hypernet_version, basis_version)
+);
+CREATE TABLE IF NOT EXISTS evaluations (
+    obj_index INTEGER PRIMARY KEY,
+    metrics TEXT
+);
+"""
+
+# verdicts of the pursued objects
+VERDICTS = ("seen", "expressed", "redundant", "new_base", "unqualified")
+
+
+def obj_name_of(data_dir):
+    return os.path.basename(os.path.normpath(data_dir)) if data_dir is not None else None
+
+
+class ObjectCatalog(object):
+    """Catalog of the objects of a pursuit run (catalog.db in the output dir), with indexed lookups by object index,
+    object name and data dir. Replaces the z_info.json / base_info.json files rewritten after every object,
+    export_json writes them (in the same format) from the catalog.
+
+    Every object pursued gets a row in objects: its round, data dir, verdict (one of VERDICTS), acc, the z file
+    (objects with a z: expressed, redundant, new_base), the most similar z file (seen), the hypernet version it was
+    checked with, its phase timings (seconds) and its dataset fingerprint (cached: the verdict came from the cache).
+
+    The verdict cache maps (dataset fingerprint, hypernet version, basis version) to the verdict an exact repeat
+    of the object gets: "seen" (with its z) for objects that have a z, the verdict itself for seen / unqualified objects.
+
+    Args:
+        path (str): database file
+    """
+    file_name = "catalog.db"
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+
+    @classmethod
+    def of_run(cls, output_dir):
+        """the catalog of a pursuit output dir, None if the run has none (older runs only have the json files)"""
+        path = os.path.join(output_dir, cls.file_name)
+        return cls(path) if os.path.isfile(path) else None
+
+    def add_object(self, round_index, data_dir, verdict, acc=None, obj_index=None, z_file=None, matched_z_file=None, hypernet_version=None, timings=None, fingerprint=None, cached=False):
+        assert verdict in VERDICTS
+        cur = self.conn.execute(
+            "INSERT INTO objects (round, data_dir, obj_name, obj_index, z_file, verdict, acc, matched_z_file, hypernet_version, timings, fingerprint, cached) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (round_index, data_dir, obj_name_of(data_dir), obj_index, z_file, verdict, acc, matched_z_file, hypernet_version, json.dumps(timings) if timings is not None else None, fingerprint, int(cached)))
+        return cur.lastrowid
+
+    def cache_verdict(self, fingerprint, hypernet_version, basis_version, verdict, acc, matched_z_file=None, data_dir=None):
+        self.conn.execute("INSERT OR REPLACE INTO verdict_cache (fingerprint, hypernet_version, basis_version, verdict, acc, matched_z_file, data_dir) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                          (fingerprint, hypernet_version, basis_version, verdict, acc, matched_z_file, data_dir))
+
+    def cached_verdict(self, fingerprint, hypernet_version, basis_version):
+        """cached verdict (dict: verdict, acc, matched_z_file, data_dir), None on a miss"""
+        row = self.conn.execute("SELECT verdict, acc, matched_z_file, data_dir FROM verdict_cache WHERE fingerprint = ? AND hypernet_version = ? AND basis_version = ?",
+                                (fingerprint, hypernet_version, basis_version)).fetchone()
+        return dict(zip(row.keys(), tuple(row))) if row is not None else None
+
+    def add_base(self, base_index, obj_index, data_dir, base_file, z_file, acc=None):
+        self.conn.execute("INSERT OR REPLACE INTO bases (base_index, obj_index, data_dir, obj_name, base_file, z_file, acc) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                          (base_index, obj_index, data_dir, obj_name_of(data_dir), base_file, z_file, acc))
+
+    def set_base_verdict(self, base_index, valid, verdict):
+        self.conn.execute("UPDATE bases SET valid = ?, verdict = ? WHERE base_index = ?", (int(valid), verdict, base_index))
+
+    def add_evaluation(self, obj_index, metrics):
+        self.conn.execute("INSERT OR REPLACE INTO evaluations (obj_index, metrics) VALUES (?, ?)", (obj_index, json.dumps(metrics)))
+
+    def commit(self):
+        self.conn.commit()
+
+    def truncate(self, round_index, obj_counter):
+        """remove the records after round round_index / object index obj_counter (a resumed run pursues them again)"""
+        # cached verdicts of the removed objects may refer to zs that are removed too
+        self.conn.execute("DELETE FROM verdict_cache WHERE data_dir IN (SELECT data_dir FROM objects WHERE round > ?)", (round_index,))
+        self.conn.execute("DELETE FROM objects WHERE round > ?", (round_index,))
+        self.conn.execute("DELETE FROM bases WHERE obj_index >= ?", (obj_counter,))
+        self.conn.commit()
+
+    def z_info(self):
+        """objects with a z, in the format of z_info.json"""
+        rows = self.conn.execute("SELECT obj_index, data_dir, z_file FROM objects WHERE z_file IS NOT NULL ORDER BY obj_index, id")
+        return [{"index": r["obj_index"], "data_dir": r["data_dir"], "z_file": r["z_file"]} for r in rows]
+
+    def base_info(self, full=False):
+        """valid bases, in the format of base_info.json; if full, in the format of the base records of simplify_bases
+        (index is the base index)"""
+        rows = self.conn.execute("SELECT * FROM bases WHERE valid = 1 ORDER BY base_index")
+        if full:
+            return [{"index": r["base_index"], "base_index": r["base_index"], "obj_index": r["obj_index"], "data_dir": r["data_dir"], "obj_name": r["obj_name"],
+                     "base_file": r["base_file"], "z_file": r["z_file"], "acc": r["acc"]} for r in rows]
+        return [{"index": r["obj_index"], "data_dir": r["data_dir"], "base_file": r["base_file"], "z_file": r["z_file"]} for r in rows]
+
+    def base_indices(self):
+        """indices of all the bases recorded by the pursuit (valid or not)"""
+        return set(r["base_index"] for r in self.conn.execute("SELECT base_index FROM bases"))
+
+    def object_index(self, obj_name):
+        """z index of the last object with the name obj_name, None if there's none"""
+        row = self.conn.execute("SELECT obj_index FROM objects WHERE obj_name = ? AND obj_index IS NOT NULL ORDER BY id DESC LIMIT 1", (obj_name,)).fetchone()
+        return row["obj_index"] if row is not None else None
+
+    def find_objects(self, data_dir=None, obj_name=None):
+        """all records of an object (by data dir or name), in pursuit order"""
+        if data_dir is not None:
+            rows = self.conn.execute("SELECT * FROM objects WHERE data_dir = ? ORDER BY id", (data_dir,))
+        else:
+            rows = self.conn.execute("SELECT * FROM objects WHERE obj_name = ? ORDER BY id", (obj_name,))
+        res = []
+        for r in rows:
+            rec = dict(zip(r.keys(), tuple(r)))
+            rec["timings"] = json.loads(rec["timings"]) if rec["timings"] is not None else None
+            res.append(rec)
+        return res
+
+    def verdict_counts(self):
+        return {r["verdict"]: r["n"] for r in self.conn.execute("SELECT verdict, COUNT(*) AS n FROM objects GROUP BY verdict")}
+
+    def export_json(self, output_dir):
+        """write z_info.json and base_info.json"""
+        with open(os.path.join(output_dir, "z_info.json"), "w") as f_json:
+            json.dump(self.z_info(), f_json)
+        with open(os.path.join(output_dir, "base_info.json"), "w") as f_json:
+            json.dump(self.base_info(), f_json)
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+def load_z_info(output_dir):
+    """z info of a pursuit run, from its catalog or (older runs) from z_info.json"""
+    catalog = ObjectCatalog.of_run(output_dir)
+    if catalog is None:
+        with open(os.path.join(output_dir, "z_info.json"), 'r') as f_zinfo:
+            return json.load(f_zinfo)
+    z_info = catalog.z_info()
+    catalog.close()
+    return z_info
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Export the catalog of a pursuit run to z_info.json / base_info.json')
+    parser.add_argument('output_dir', type=str, help='pursuit output dir')
+    args = parser.parse_args()
+    catalog = ObjectCatalog(os.path.join(args.output_dir, ObjectCatalog.file_name))
+    catalog.export_json(args.output_dir)
+    print(catalog.verdict_counts())
+    catalog.close()
@@ -0,0 +1,83 @@
+'''Learning-curve based early stopping'''
+import math
+import numpy as np
+
+
+def fit_saturating_curve(epochs, accs, rates=np.logspace(-2, 0.5, 24)):
+    """least squares fit of acc(t) = a - b*exp(-c*t), linear in (a, b) for a fixed rate c,
+    c is searched on a grid
+
+    Returns:
+        tuple: (a, b, c), residual standard deviation
+    """
+    t = np.asarray(epochs, dtype=np.float64)
+    y = np.asarray(accs, dtype=np.float64)
+    best = None
+    for c in rates:
+        X = np.stack([np.ones_like(t), -np.exp(-c * t)], axis=1)
+        params, _, _, _ = np.linalg.lstsq(X, y, rcond=None)
+        sse = float(np.sum((X.dot(params) - y) ** 2))
+        if best is None or sse < best[0]:
+            best = (sse, params[0], params[1], c)
+    sse, a, b, c = best
+    dof = max(len(y) - 3, 1)
+    return (a, b, c), math.sqrt(sse / dof)
+
+
+class CurveStopper(object):
+    """Predict the final validation acc (at max_epochs) from the validation curve so far,
+    and decide early whether the run will end above or below a decision threshold.
+
+    Decisions (after min_epochs):
+        "reject": the predicted final acc + z*std is below threshold (after min_reject_epochs)
+        "accept": the best acc so far reaches threshold and the predicted further gain is below min_gain
+    The fit of a few points has almost no residual degrees of freedom, so its std is floored by the spread
+    (std) of the last noise_window validation accs.
+
+    Args:
+        threshold (float): decision threshold (e.g. the express threshold)
+        max_epochs (int): the epoch the prediction is made for
+        min_epochs (int, optional): number of epochs before any decision. Defaults to 4.
+        z (float, optional): confidence multiplier of the prediction std. Defaults to 2.0.
+        min_gain (float, optional): Defaults to 0.01.
+        min_reject_epochs (int, optional): number of epochs before a reject. Defaults to 6.
+        noise_window (int, optional): number of recent accs of the std floor. Defaults to 4.
+    """
+    def __init__(self, threshold, max_epochs, min_epochs=4, z=2.0, min_gain=0.01, min_reject_epochs=6, noise_window=4):
+        self.threshold = threshold
+        self.max_epochs = max_epochs
+        self.min_epochs = min_epochs
+        self.min_reject_epochs = max(min_reject_epochs, min_epochs)
+        self.noise_window = noise_window
+        self.z = z
+        self.min_gain = min_gain
+        self.epochs = []
+        self.accs = []
+        self.prediction = None
+        self.std = None
+
+    def predict(self):
+        (a, b, c), res_std = fit_saturating_curve(self.epochs, self.accs)
+        final = a - b * math.exp(-c * self.max_epochs)
+        # the curve can't be trusted beyond the observed range: widen the interval with the extrapolation distance
+        horizon = (self.max_epochs - self.epochs[-1]) / float(max(self.epochs[-1] - self.epochs[0], 1))
+        noise = float(np.std(self.accs[-self.noise_window:], ddof=1))
+        std = max(res_std, noise) * math.sqrt(1.0 + horizon)
+        # the best acc is kept anyway
+        return min(max(final, max(self.accs)), 1.0), std
+
+    def update(self, epoch, acc):
+        """add a validation result, returns None (continue), "accept" or "reject" """
+        self.epochs.append(epoch)
+        self.accs.append(acc)
+        if len(self.accs) < 3:
+            return None
+        self.prediction, self.std = self.predict()
+        if len(self.accs) < self.min_epochs:
+            return None
+        best = max(self.accs)
+        if len(self.accs) >= self.min_reject_epochs and self.prediction + self.z * self.std < self.threshold:
+            return "reject"
+        if best >= self.threshold and self.prediction - best < self.min_gain:
+            return "accept"
+        return None
@@ -0,0 +1,110 @@
+'''Per-phase cost breakdown of the events (utils/events.py) of one or more runs'''
+import os
+import json
+import argparse
+
+
+def load_events(paths):
+    """events of the given events files or run dirs (their events.jsonl), each with its run (the dir name)"""
+    events = []
+    for path in paths:
+        file_path = os.path.join(path, "events.jsonl") if os.path.isdir(path) else path
+        run = os.path.basename(os.path.dirname(os.path.abspath(file_path)))
+        with open(file_path) as f_events:
+            for line in f_events:
+                line = line.strip()
+                if len(line) == 0:
+                    continue
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    # the last line of an interrupted run may be partial
+                    continue
+                event.setdefault("run", run)
+                events.append(event)
+    return events
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+def _max(group, key):
+    values = [e[key] for e in group if e.get(key) is not None]
+    return max(values) if len(values) > 0 else None
+
+def summarize(events, by_run=False):
+    """per phase (and run): count, total / mean / p50 / p95 wall time, cpu time, samples and samples/s, epochs,
+    peak memory, io bytes, and the share of the wall time among the phases of the same depth
+
+    Returns:
+        list: one dict per group, sorted by total wall time
+    """
+    groups = {}
+    for event in events:
+        if "wall_time" not in event:
+            continue
+        key = (event.get("run") if by_run else None, event["phase"], event.get("depth", 0))
+        groups.setdefault(key, []).append(event)
+    depth_total = {}
+    for (run, _, depth), group in groups.items():
+        depth_total[(run, depth)] = depth_total.get((run, depth), 0.0) + sum(e["wall_time"] for e in group)
+    rows = []
+    for (run, phase, depth), group in groups.items():
+        walls = [e["wall_time"] for e in group]
+        total = sum(walls)
+        samples = sum(e.get("samples") or 0 for e in group)
+        row = {
+            "phase": phase,
+            "depth": depth,
+            "count": len(group),
+            "wall_total": total,
+            "wall_mean": total / len(group),
+            "wall_p50": _percentile(walls, 0.5),
+            "wall_p95": _percentile(walls, 0.95),
+            "cpu_total": sum(e.get("cpu_time") or 0.0 for e in group),
+            "share": total / depth_total[(run, depth)] if depth_total[(run, depth)] > 0 else None,
+            "samples": samples,
+            "samples_per_s": samples / total if samples > 0 and total > 0 else None,
+            "epochs": sum(e.get("epochs") or 0 for e in group),
+            "peak_rss_mb": _max(group, "peak_rss_mb"),
+            "cuda_peak_mb": _max(group, "cuda_peak_mb"),
+            "read_bytes": sum(e.get("read_bytes") or 0 for e in group),
+            "write_bytes": sum(e.get("write_bytes") or 0 for e in group)
+        }
+        if by_run:
+            row["run"] = run
+        rows.append(row)
+    rows.sort(key=lambda r: (r.get("run") or "", r["depth"], -r["wall_total"]))
+    return rows
+
+def format_table(rows):
+    columns = ["phase", "count", "wall_total", "wall_mean", "wall_p95", "cpu_total", "share", "samples_per_s", "epochs", "peak_rss_mb", "cuda_peak_mb", "read_bytes", "write_bytes"]
+    if len(rows) > 0 and "run" in rows[0]:
+        columns = ["run"] + columns
+    def cell(row, c):
+        v = row[c]
+        if c == "phase":
+            return "  " * row["depth"] + v
+        if v is None:
+            return "-"
+        if c == "share":
+            return "%.1f%%" % (100 * v)
+        if isinstance(v, float):
+            return "%.2f" % v
+        return str(v)
+    table = [columns] + [[cell(r, c) for c in columns] for r in rows]
+    widths = [max(len(line[i]) for line in table) for i in range(len(columns))]
+    return "\n".join("  ".join(v.ljust(w) for v, w in zip(line, widths)) for line in table)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per-phase cost breakdown of pursuit / training events')
+    parser.add_argument('paths', type=str, nargs='+', help='events.jsonl files or run dirs')
+    parser.add_argument('-by_run', '--by_run', dest='by_run', action="store_true", help='one breakdown per run')
+    parser.add_argument('-json', '--json', dest='json', type=str, default=None, help='also write the breakdown to this json file')
+    args = parser.parse_args()
+    rows = summarize(load_events(args.paths), by_run=args.by_run)
+    print(format_table(rows))
+    if args.json is not None:
+        with open(args.json, "w") as f_json:
+            json.dump(rows, f_json, indent=2)
@@ -0,0 +1,208 @@
+'''Structured phase events (one json line per phase): wall / cpu time, memory and io of pursuit and training phases'''
+import json
+import time
+import resource
+import threading
+
+try:
+    import torch
+except ImportError:
+    torch = None
+
+
+def _proc_io():
+    """io counters of this process (/proc/self/io, linux), None where they can't be read.
+    read_bytes / write_bytes are storage io, rchar / wchar include page cache hits.
+    Reads of DataLoader worker processes are not included."""
+    try:
+        with open("/proc/self/io") as f_io:
+            counters = dict(line.split(":") for line in f_io.read().splitlines() if ":" in line)
+        return {k: int(counters[k]) for k in ("rchar", "wchar", "read_bytes", "write_bytes")}
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+
+def _rss_mb():
+    try:
+        with open("/proc/self/statm") as f_statm:
+            return int(f_statm.read().split()[1]) * resource.getpagesize() / 2.0**20
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+def _peak_rss_mb():
+    # ru_maxrss is in KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def _cuda_enabled():
+    if torch is None or not torch.cuda.is_available():
+        return False
+    # don't initialize cuda in a process that doesn't use it
+    is_initialized = getattr(torch.cuda, "is_initialized", None)
+    return is_initialized() if is_initialized is not None else True
+
+def _cuda_max_allocated():
+    return torch.cuda.max_memory_allocated() if _cuda_enabled() else None
+
+def _cuda_reset_peak():
+    if _cuda_enabled():
+        reset = getattr(torch.cuda, "reset_peak_memory_stats", None) or getattr(torch.cuda, "reset_max_memory_allocated")
+        reset()
+
+
+class _EventSink(object):
+    """buffered jsonl file shared by an EventWriter and its bound views, with the stack of open phases"""
+    def __init__(self, file_path, buffer_size, flush_interval):
+        self.file = open(file_path, "a")
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.lines = []
+        self.last_flush = time.time()
+        self.lock = threading.Lock()
+        self.stack = []
+
+    def write(self, record):
+        line = json.dumps(record, default=str)
+        with self.lock:
+            self.lines.append(line)
+            if len(self.lines) >= self.buffer_size or time.time() - self.last_flush >= self.flush_interval:
+                self._flush()
+
+    def _flush(self):
+        if len(self.lines) > 0:
+            self.file.write("\n".join(self.lines) + "\n")
+            self.file.flush()
+            self.lines = []
+        self.last_flush = time.time()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def fold_cuda_peak(self):
+        """fold the device memory peak since the last reset into the open phases, then reset it (phases nest)"""
+        peak = _cuda_max_allocated()
+        if peak is None:
+            return
+        for phase in self.stack:
+            phase.cuda_peak = max(phase.cuda_peak or 0, peak)
+        _cuda_reset_peak()
+
+
+class Phase(object):
+    """An open phase of an EventWriter: begin() takes the counters, end() writes the event with their deltas.
+    update() adds fields (e.g. samples, epochs) to the event. Also a context manager (an exception ends the
+    phase with an error field)."""
+    def __init__(self, sink, phase, fields):
+        self.sink = sink
+        self.fields = fields
+        self.fields["phase"] = phase
+        self.done = False
+        self.cuda_peak = None
+        sink.fold_cuda_peak()
+        self.fields["depth"] = len(sink.stack)
+        sink.stack.append(self)
+        self.io = _proc_io()
+        self.start = time.time()
+        self.cpu_start = time.process_time()
+
+    def update(self, **fields):
+        self.fields.update(fields)
+
+    def end(self, **fields):
+        """write the event (once), returns its record"""
+        if self.done:
+            return self.fields
+        self.done = True
+        wall_time = time.time() - self.start
+        cpu_time = time.process_time() - self.cpu_start
+        self.sink.fold_cuda_peak()
+        if self in self.sink.stack:
+            self.sink.stack.remove(self)
+        io = _proc_io()
+        record = self.fields
+        record.update(fields)
+        record.update({
+            "time": self.start,
+            "wall_time": wall_time,
+            "cpu_time": cpu_time,
+            "rss_mb": _rss_mb(),
+            "peak_rss_mb": _peak_rss_mb(),
+            "cuda_peak_mb": self.cuda_peak / 2.0**20 if self.cuda_peak is not None else None
+        })
+        if io is not None and self.io is not None:
+            for k in io:
+                record[k] = io[k] - self.io[k]
+        self.sink.write(record)
+        return record
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is not None:
+            self.end(error=repr(exc_value))
+        else:
+            self.end()
+        return False
+
+
+class _NullPhase(object):
+    def update(self, **fields):
+        pass
+
+    def end(self, **fields):
+        return fields
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+
+class EventWriter(object):
+    """Writer of structured phase events to a jsonl file, buffered (written every buffer_size events or
+    flush_interval seconds, and on close). Every event has: phase, depth (number of enclosing open phases),
+    time (start), wall_time, cpu_time (seconds, all threads of the process), rss_mb, peak_rss_mb (process
+    high water mark), cuda_peak_mb (peak allocated device memory within the phase), rchar / wchar /
+    read_bytes / write_bytes (io of the process within the phase), the fields given to begin / end / update
+    and the fields bound to the writer (e.g. run, obj_index).
+
+    Args:
+        file_path (str): events file (appended)
+        buffer_size (int, optional): Defaults to 256.
+        flush_interval (float, optional): seconds. Defaults to 10.0.
+        fields: fields of every event
+    """
+    def __init__(self, file_path, buffer_size=256, flush_interval=10.0, **fields):
+        self.sink = _EventSink(file_path, buffer_size, flush_interval)
+        self.fields = fields
+
+    def bind(self, **fields):
+        """a view of the writer whose events also have fields"""
+        events = EventWriter.__new__(EventWriter)
+        events.sink = self.sink
+        events.fields = dict(self.fields, **fields)
+        return events
+
+    def begin(self, phase, **fields):
+        return Phase(self.sink, phase, dict(self.fields, **fields))
+
+    def emit(self, phase, **fields):
+        """a point event (no timing)"""
+        record = dict(self.fields, **fields)
+        record.update({"phase": phase, "time": time.time()})
+        self.sink.write(record)
+
+    def flush(self):
+        self.sink.flush()
+
+    def close(self):
+        self.sink.flush()
+        self.sink.file.close()
+
+
+def begin_phase(events, phase, **fields):
+    """events.begin(phase), a phase that records nothing if events is None"""
+    if events is None:
+        return _NullPhase()
+    return events.begin(phase, **fields)
@@ -0,0 +1,183 @@
+'''torch.profiler capture of selected phases (chrome traces and top operator tables), and the record_function
+labels of the models and training loops'''
+import os
+import json
+
+import torch
+
+try:
+    import torch.profiler as torch_profiler
+except ImportError:
+    # torch < 1.8.1: the phase is profiled as a whole with the autograd profiler
+    torch_profiler = None
+
+
+# open captures (innermost last): labels and steps are only recorded while a capture is open
+_captures = []
+
+
+class _NullContext(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+_NULL_CONTEXT = _NullContext()
+
+
+def label(name):
+    """record_function(name) while a phase is captured, a no-op context otherwise"""
+    if len(_captures) == 0:
+        return _NULL_CONTEXT
+    return torch.autograd.profiler.record_function(name)
+
+def label_iter(iterable, name="data_loading"):
+    """iterate over iterable (a data loader), the fetch of every item is labeled name while a phase is captured"""
+    if len(_captures) == 0:
+        return iter(iterable)
+    return _label_iter(iterable, name)
+
+def _label_iter(iterable, name):
+    it = iter(iterable)
+    while True:
+        with label(name):
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+        yield item
+
+def step():
+    """a step of the innermost captured phase (a batch, an evaluated z), drives the wait / warmup / active schedule"""
+    if len(_captures) > 0:
+        _captures[-1].step()
+
+
+class _Capture(object):
+    """a captured occurrence of a phase, writes its traces and tables to out_dir"""
+    def __init__(self, profiler, phase, out_dir):
+        self.profiler = profiler
+        self.phase = phase
+        self.out_dir = out_dir
+        self.cycles = 0
+        self.done = False
+        activities = None
+        use_cuda = torch.cuda.is_available()
+        if torch_profiler is not None:
+            activities = [torch_profiler.ProfilerActivity.CPU]
+            if use_cuda:
+                activities.append(torch_profiler.ProfilerActivity.CUDA)
+            self.prof = torch_profiler.profile(activities=activities,
+                                               schedule=torch_profiler.schedule(wait=profiler.wait, warmup=profiler.warmup, active=profiler.active, repeat=profiler.repeat),
+                                               on_trace_ready=self._export,
+                                               record_shapes=profiler.record_shapes,
+                                               profile_memory=profiler.profile_memory,
+                                               with_stack=profiler.with_stack)
+        else:
+            self.prof = torch.autograd.profiler.profile(use_cuda=use_cuda, record_shapes=profiler.record_shapes)
+        self.sort_by = "self_cuda_time_total" if use_cuda else "self_cpu_time_total"
+        self.prof.__enter__()
+        _captures.append(self)
+
+    def _export(self, prof):
+        trace_file = os.path.join(self.out_dir, "trace_%d.json" % self.cycles)
+        prof.export_chrome_trace(trace_file)
+        with open(os.path.join(self.out_dir, "ops_%d.txt" % self.cycles), "w") as f_ops:
+            f_ops.write(prof.key_averages().table(sort_by=self.sort_by, row_limit=self.profiler.row_limit))
+        self.cycles += 1
+
+    def step(self):
+        if torch_profiler is not None:
+            self.prof.step()
+
+    def end(self):
+        if self.done:
+            return
+        self.done = True
+        if self in _captures:
+            _captures.remove(self)
+        self.prof.__exit__(None, None, None)
+        if torch_profiler is None:
+            self._export(self.prof)
+        with open(os.path.join(self.out_dir, "capture.json"), "w") as f_info:
+            json.dump({"phase": self.phase, "cycles": self.cycles, "schedule": self.profiler.schedule_info()}, f_info)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.end()
+        return False
+
+
+class PhaseProfiler(object):
+    """torch.profiler capture of the chosen phases (e.g. have_seen, express_check, base_update, joint_train_epoch,
+    nshot_epoch). The first captures occurrences of each phase are profiled with a bounded schedule: of the steps of
+    the phase (step() in the loops), wait are skipped, warmup are traced and dropped, active are recorded (repeat
+    cycles). Every recorded cycle is exported to output_dir/<phase>_<tag>/: a chrome trace (trace_<cycle>.json,
+    chrome://tracing or perfetto) and a table of the top operators (ops_<cycle>.txt).
+    Phases that are not chosen, or past their captures, cost nothing; label() is a no-op outside captures.
+    Without torch.profiler (torch < 1.8.1), a captured phase is profiled as a whole by the autograd profiler.
+
+        profiler = PhaseProfiler(output_dir, ["have_seen"])
+        with profiler.begin("have_seen", tag=obj_index):
+            ...
+
+    Args:
+        output_dir (str): profile dir of the run
+        phases (list): captured phases
+        wait (int, optional): Defaults to 1.
+        warmup (int, optional): Defaults to 1.
+        active (int, optional): Defaults to 3.
+        repeat (int, optional): recorded cycles per capture. Defaults to 1.
+        captures (int, optional): captured occurrences per phase. Defaults to 1.
+        row_limit (int, optional): rows of the operator tables. Defaults to 30.
+    """
+    def __init__(self, output_dir, phases, wait=1, warmup=1, active=3, repeat=1, captures=1, row_limit=30,
+                 record_shapes=False, profile_memory=False, with_stack=False):
+        self.output_dir = output_dir
+        self.phases = set(phases)
+        self.wait = wait
+        self.warmup = warmup
+        self.active = active
+        self.repeat = repeat
+        self.captures = captures
+        self.row_limit = row_limit
+        self.record_shapes = record_shapes
+        self.profile_memory = profile_memory
+        self.with_stack = with_stack
+        self.counts = {}
+
+    def schedule_info(self):
+        return {"wait": self.wait, "warmup": self.warmup, "active": self.active, "repeat": self.repeat}
+
+    def enabled(self, phase):
+        return phase in self.phases and self.counts.get(phase, 0) < self.captures
+
+    def begin(self, phase, tag=None):
+        """capture of this occurrence of phase (a no-op context if it's not captured)"""
+        if not self.enabled(phase):
+            return _NULL_CAPTURE
+        self.counts[phase] = self.counts.get(phase, 0) + 1
+        out_dir = os.path.join(self.output_dir, "%s_%s" % (phase, tag if tag is not None else self.counts[phase] - 1))
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        return _Capture(self, phase, out_dir)
+
+
+class _NullCapture(_NullContext):
+    def step(self):
+        pass
+
+    def end(self):
+        pass
+
+_NULL_CAPTURE = _NullCapture()
+
+
+def begin_capture(profiler, phase, tag=None):
+    """profiler.begin(phase, tag), a no-op capture if profiler is None"""
+    if profiler is None:
+        return _NULL_CAPTURE
+    return profiler.begin(phase, tag)
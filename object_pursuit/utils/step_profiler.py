@@ -0,0 +1,221 @@
+'''Sampled per-step timing of training loops: data wait, host to device copy, forward (hypernet / backbone / decoder),
+loss, backward and optimizer step'''
+import time
+import bisect
+
+try:
+    import torch
+except ImportError:
+    torch = None
+
+
+# histogram bin edges (seconds): 4 bins per decade from 0.1ms to 10s
+BIN_EDGES = [10 ** (k / 4.0) * 1e-4 for k in range(21)]
+
+# segments of a step, in loop order (decoder is forward - hypernet - backbone)
+SEGMENTS = ("data_wait", "h2d", "forward", "hypernet", "backbone", "decoder", "loss", "backward", "optimizer")
+
+
+class Histogram(object):
+    """count / sum / max of durations with log spaced bins (BIN_EDGES), percentiles are bin upper edges"""
+    def __init__(self):
+        self.counts = [0] * (len(BIN_EDGES) + 1)
+        self.n = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(BIN_EDGES, value)] += 1
+        self.n += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, q):
+        if self.n == 0:
+            return None
+        rank = q * self.n
+        acc = 0
+        for i, c in enumerate(self.counts):
+            acc += c
+            if acc >= rank and c > 0:
+                return BIN_EDGES[i] if i < len(BIN_EDGES) else self.max
+        return self.max
+
+    def summary(self):
+        return {"n": self.n, "mean": self.total / self.n if self.n > 0 else None, "p50": self.percentile(0.5),
+                "p95": self.percentile(0.95), "max": self.max}
+
+
+class _Segment(object):
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.timer._sync()
+        self.timer.current = self.name
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.timer._sync()
+        self.timer.current = None
+        self.timer.sampled[self.name] = self.timer.sampled.get(self.name, 0.0) + time.time() - self.start
+        return False
+
+
+class _NullSegment(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+_NULL_SEGMENT = _NullSegment()
+
+
+class StepTimer(object):
+    """Opt-in step instrumentation of a training loop (disabled, it costs a function call per segment).
+
+    The time spent waiting for the loader (next(loader)) and the step time are measured on every step, without
+    synchronization. Every sample_every-th step is sampled: the device is synchronized at the segment boundaries and
+    the segments (h2d, forward, loss, backward, optimizer) are timed; forward hooks split the forward into the
+    hypernet (weight generation), the backbone and the rest (decoder). Durations go to per segment histograms.
+
+    epoch_end reports the images/s and the data wait fraction of the epoch (data wait / (data wait + step time),
+    evaluation between steps is not included) and the segment histograms, to log and as an event of events.
+
+        timer = StepTimer(device, sample_every=20, modules={"hypernet": hypernet, "backbone": backbone})
+        for batch in timer.iter(loader):
+            with timer.segment("h2d"):
+                ...
+            timer.step(batch_size)
+        timer.epoch_end(epoch)
+
+    Args:
+        device (torch.device or str): training device (synchronized on sampled steps)
+        sample_every (int, optional): sampling interval in steps, 0 disables the timer. Defaults to 20.
+        modules (dict, optional): name (hypernet / backbone) -> module, None entries are skipped. Defaults to None.
+        log (callable, optional): called with the report line of every epoch (e.g. lambda s: write_log(log_file, s)). Defaults to None.
+        events (EventWriter, optional): epoch reports are emitted as "train_steps" events. Defaults to None.
+    """
+    def __init__(self, device=None, sample_every=20, modules=None, log=None, events=None):
+        self.enabled = sample_every > 0
+        self.sample_every = sample_every
+        self.device = device
+        self.cuda = torch is not None and device is not None and getattr(device, "type", str(device).split(":")[0]) == "cuda"
+        self.log = log
+        self.events = events
+        self.sampling = False
+        self.current = None
+        self.sampled = {}
+        self.steps = 0
+        self.handles = []
+        self._reset_epoch()
+        if self.enabled and modules is not None:
+            for name, module in modules.items():
+                if module is not None:
+                    self._hook(name, module)
+
+    def _reset_epoch(self):
+        self.hists = {name: Histogram() for name in SEGMENTS}
+        self.step_hist = Histogram()
+        self.epoch_images = 0
+        self.epoch_wait = 0.0
+        self.epoch_step_time = 0.0
+
+    def _sync(self):
+        if self.cuda:
+            torch.cuda.synchronize(self.device)
+
+    def _hook(self, name, module):
+        # only the calls within the forward segment of a sampled step are timed
+        starts = []
+        def pre_hook(m, inputs):
+            if self.sampling and self.current == "forward":
+                self._sync()
+                starts.append(time.time())
+        def hook(m, inputs, output):
+            if self.sampling and self.current == "forward" and len(starts) > 0:
+                self._sync()
+                self.sampled[name] = self.sampled.get(name, 0.0) + time.time() - starts.pop()
+        self.handles.append(module.register_forward_pre_hook(pre_hook))
+        self.handles.append(module.register_forward_hook(hook))
+
+    def iter(self, loader):
+        """iterate over loader, timing the wait for every batch"""
+        if not self.enabled:
+            return iter(loader)
+        return self._iter(loader)
+
+    def _iter(self, loader):
+        it = iter(loader)
+        while True:
+            wait_start = time.time()
+            try:
+                batch = next(it)
+            except StopIteration:
+                return
+            now = time.time()
+            wait = now - wait_start
+            self.hists["data_wait"].add(wait)
+            self.epoch_wait += wait
+            self.step_start = now
+            self.sampling = self.steps % self.sample_every == 0
+            self.sampled = {}
+            yield batch
+
+    def segment(self, name):
+        """context of a segment of the current step (timed on sampled steps)"""
+        if not self.sampling:
+            return _NULL_SEGMENT
+        return _Segment(self, name)
+
+    def step(self, images):
+        """end of the step (before any evaluation), images: number of images of the batch"""
+        if not self.enabled:
+            return
+        if self.sampling:
+            self._sync()
+            for name, value in self.sampled.items():
+                self.hists[name].add(value)
+            if "forward" in self.sampled:
+                self.hists["decoder"].add(max(0.0, self.sampled["forward"] - self.sampled.get("hypernet", 0.0) - self.sampled.get("backbone", 0.0)))
+            self.sampling = False
+        step_time = time.time() - self.step_start
+        self.step_hist.add(step_time)
+        self.epoch_step_time += step_time
+        self.epoch_images += images
+        self.steps += 1
+
+    def epoch_end(self, epoch):
+        """report of the epoch (and reset of the epoch statistics), None if the timer is disabled
+
+        Returns:
+            dict: epoch, images, images_per_s, data_wait_fraction, step (histogram summary), segments (histogram summaries)
+        """
+        if not self.enabled:
+            return None
+        total = self.epoch_wait + self.epoch_step_time
+        report = {
+            "epoch": epoch,
+            "images": self.epoch_images,
+            "images_per_s": self.epoch_images / total if total > 0 else None,
+            "data_wait_fraction": self.epoch_wait / total if total > 0 else None,
+            "step": self.step_hist.summary(),
+            "segments": {name: h.summary() for name, h in self.hists.items() if h.n > 0}
+        }
+        if self.log is not None:
+            sampled = ", ".join("%s %.2fms" % (name, 1000 * s["mean"]) for name, s in report["segments"].items() if name != "data_wait")
+            self.log("  [steps] epoch %d: %.1f images/s, data wait %.1f%% of the step time, sampled step means: %s" % (
+                epoch, report["images_per_s"] or 0.0, 100 * (report["data_wait_fraction"] or 0.0), sampled))
+        if self.events is not None:
+            self.events.emit("train_steps", **report)
+        self._reset_epoch()
+        return report
+
+    def close(self):
+        """remove the forward hooks"""
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
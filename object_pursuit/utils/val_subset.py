@@ -0,0 +1,110 @@
+'''Validation on a stratified subset, sized by the confidence interval of the mean dice'''
+import math
+import random
+import torch
+from torch.utils.data.sampler import Sampler
+
+
+def stratified_order(n, strata=8, seed=None):
+    """a permutation of range(n) whose every prefix is stratified: the indices (frames in temporal order)
+    are split into contiguous strata, shuffled within each stratum and interleaved round robin"""
+    rng = random.Random(seed)
+    strata = max(1, min(strata, n))
+    bounds = [int(round(i * n / strata)) for i in range(strata + 1)]
+    groups = []
+    for i in range(strata):
+        group = list(range(bounds[i], bounds[i+1]))
+        rng.shuffle(group)
+        groups.append(group)
+    order = []
+    for k in range(max(len(g) for g in groups) if n > 0 else 0):
+        for group in groups:
+            if k < len(group):
+                order.append(group[k])
+    return order
+
+
+class IndexSampler(Sampler):
+    """Sampler of the given indices, in order. The indices can be replaced between iterations, so that a single
+    DataLoader (and its persistent workers) serves every validation subset."""
+    def __init__(self, indices=None):
+        self.indices = list(indices) if indices is not None else []
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+
+class AdaptiveValSubset(object):
+    """Validation subset of a dataset of n samples, sized so that the half width of the confidence interval of the
+    mean dice is at most target_width; the subset only grows further (up to all n samples) while threshold lies
+    within the interval, i.e. while the decision against threshold is still open.
+
+    Args:
+        n (int): number of samples
+        threshold (float, optional): decision threshold (e.g. the express threshold). Defaults to None.
+        target_width (float, optional): target half width of the confidence interval. Defaults to 0.02.
+        z (float, optional): normal quantile of the confidence level. Defaults to 1.96 (95%).
+        init_size (int, optional): size of the first subset. Defaults to 64.
+        strata (int, optional): number of temporal strata. Defaults to 8.
+    """
+    def __init__(self, n, threshold=None, target_width=0.02, z=1.96, init_size=64, strata=8, seed=None):
+        self.n = n
+        self.threshold = threshold
+        self.target_width = target_width
+        self.z = z
+        self.order = stratified_order(n, strata, seed)
+        self.size = min(init_size, n)
+        self.mean = None
+        self.half_width = None
+
+    def _stats(self, samples):
+        """mean and CI half width (of the best start for multi-start scores)"""
+        if samples.dim() == 2:
+            samples = samples[samples.mean(dim=1).argmax()]
+        m = samples.numel()
+        if m == 0:
+            return 0.0, float('inf')
+        mean = samples.mean().item()
+        std = samples.std().item() if m > 1 else 1.0
+        # finite population correction
+        fpc = math.sqrt(max(self.n - m, 0) / float(max(self.n - 1, 1)))
+        return mean, self.z * std / math.sqrt(m) * fpc
+
+    def _needed(self, samples, width):
+        if samples.dim() == 2:
+            samples = samples[samples.mean(dim=1).argmax()]
+        std = samples.std().item() if samples.numel() > 1 else 1.0
+        return int(math.ceil((self.z * std / max(width, 1e-6)) ** 2))
+
+    def evaluate(self, eval_fn):
+        """validate the current model
+
+        Args:
+            eval_fn (function): indices -> (score, per-sample dice tensor (m, or S*m for multi-start nets))
+
+        Returns:
+            score (mean dice, or a list of them for multi-start nets) over the evaluated subset
+        """
+        _, samples = eval_fn(self.order[:self.size])
+        m = self.size
+        while m < self.n:
+            mean, half_width = self._stats(samples)
+            if half_width > self.target_width:
+                target = self._needed(samples, self.target_width)
+            elif self.threshold is not None and abs(mean - self.threshold) < half_width:
+                target = max(2 * m, self._needed(samples, abs(mean - self.threshold)))
+            else:
+                break
+            target = min(max(target, m + 1), self.n)
+            _, new_samples = eval_fn(self.order[m:target])
+            samples = torch.cat([samples, new_samples], dim=-1)
+            m = target
+        # later validations start from the size reached here
+        self.size = m
+        self.mean, self.half_width = self._stats(samples)
+        if samples.dim() == 2:
+            return samples.mean(dim=1).tolist()
+        return samples.mean().item() if samples.numel() > 0 else 0.0